@@ -0,0 +1,137 @@
+
+import os
+import glob
+import logging
+import threading
+import multiprocessing
+import os.path as op
+
+# Environment variables that size the thread pools of OpenMP and the
+#  common BLAS libraries, in tools we run and in our own process
+THREAD_VARIABLES = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+                    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+NODE_ROOT = "/sys/devices/system/node"
+
+def parseCpuList( value ):
+    """
+    The CPUs of a Linux CPU list, e.g. '0-3,8,10-11'
+    """
+    cpus = set()
+    for part in value.strip().split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-', 1)
+            cpus.update( range(int(first), int(last) + 1) )
+        else:
+            cpus.add( int(part) )
+    return sorted(cpus)
+
+def formatCpuList( cpus ):
+    """
+    The inverse of parseCpuList, as accepted by taskset
+    """
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and cpu == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append( [cpu, cpu] )
+    return ",".join(str(first) if first == last else "{0}-{1}".format(first, last) for first, last in ranges)
+
+def allowedCpus():
+    """
+    The CPUs this process may run on, e.g. as restricted by a batch scheduler
+    """
+    try:
+        with open("/proc/self/status") as handle:
+            for line in handle:
+                if line.startswith("Cpus_allowed_list:"):
+                    return parseCpuList( line.split(':', 1)[1] )
+    except (IOError, OSError, ValueError):
+        pass
+    return range(multiprocessing.cpu_count())
+
+def numaNodes():
+    """
+    The CPUs of each NUMA node, or a single node of every CPU on systems
+    that don't report their topology
+    """
+    nodes = []
+    for path in sorted(glob.glob( op.join(NODE_ROOT, "node[0-9]*", "cpulist") )):
+        try:
+            with open( path ) as handle:
+                cpus = parseCpuList( handle.read() )
+        except (IOError, OSError, ValueError):
+            continue
+        if cpus:
+            nodes.append( cpus )
+    return nodes
+
+def threadEnvironment( nThreads, env=None ):
+    """
+    A copy of 'env' (by default our own environment) with the thread
+    pools of OpenMP and BLAS sized to 'nThreads'
+    """
+    env = dict(os.environ if env is None else env)
+    for variable in THREAD_VARIABLES:
+        env[variable] = str(nThreads)
+    return env
+
+def limitLibraryThreads( nThreads=1 ):
+    """
+    Keep the thread pools of any numerical libraries we load ourselves from
+    competing with the tools we run for CPUs, unless the user has already
+    sized them
+    """
+    for variable in THREAD_VARIABLES:
+        os.environ.setdefault( variable, str(nThreads) )
+
+class CpuAllocator(object):
+    """
+    Hand out sets of CPUs to the external tools we run concurrently, so that
+    each is pinned to CPUs of its own rather than every tool floating across
+    the whole machine.  Each set is the least-loaded CPUs available, taken
+    from one NUMA node whenever that's no more loaded than spanning nodes.
+    If more CPUs are asked for than are free, sets are shared as evenly as
+    possible rather than waiting
+    """
+
+    def __init__(self, cpus=None, nodes=None):
+        allowed = set(allowedCpus() if cpus is None else cpus)
+        nodes   = numaNodes() if nodes is None else nodes
+        self._cpus  = sorted(allowed)
+        self._nodes = [sorted(allowed.intersection( node )) for node in nodes]
+        self._nodes = [node for node in self._nodes if node]
+        self._load  = dict((cpu, 0) for cpu in self._cpus)
+        self._lock  = threading.Lock()
+        if not self._cpus:
+            msg = "No CPUs available to pin tools to"
+            logging.error( msg )
+            raise RuntimeError( msg )
+
+    @property
+    def cpus(self):
+        return list(self._cpus)
+
+    def _leastLoaded( self, cpus, n ):
+        chosen = sorted(cpus, key=lambda cpu: (self._load[cpu], cpu))[:n]
+        return sum(self._load[cpu] for cpu in chosen), chosen
+
+    def acquire( self, n ):
+        n = max(1, min(n, len(self._cpus)))
+        with self._lock:
+            # Candidates are ranked by load, then prefer staying on one node
+            candidates = [self._leastLoaded( node, n ) + (0,) for node in self._nodes if len(node) >= n]
+            candidates.append( self._leastLoaded( self._cpus, n ) + (1,) )
+            load, chosen, spansNodes = min(candidates, key=lambda c: (c[0], c[2]))
+            for cpu in chosen:
+                self._load[cpu] += 1
+        return sorted(chosen)
+
+    def release( self, cpus ):
+        with self._lock:
+            for cpu in cpus:
+                self._load[cpu] = max(0, self._load[cpu] - 1)
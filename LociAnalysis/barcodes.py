@@ -33,6 +33,8 @@
 import logging
 import itertools
 
+from collections import defaultdict
+
 def getDataSetBarcodes( dataset ):
     bcs = set()
 
@@ -47,6 +49,19 @@ def getDataSetBarcodes( dataset ):
     bcs = ["{0}--{1}".format(f, r) for f, r in sorted(list(bcs)) if f >= 0 if r >= 0]
     return bcs
 
+def getBarcodeReadCounts( dataset ):
+    """
+    Count the subreads assigned to each barcode-pair, keyed by None if the
+    dataset isn't barcoded
+    """
+    if not dataset.isBarcoded:
+        return {None: len(dataset.index.holeNumber)}
+    counts = defaultdict(int)
+    for f, r in itertools.izip(dataset.index.bcForward,
+                               dataset.index.bcReverse):
+        counts["{0}--{1}".format(f, r)] += 1
+    return dict(counts)
+
 def getDoBcBarcodes( bcStr ):
     if bcStr is None:
         return []
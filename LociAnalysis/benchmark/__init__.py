@@ -0,0 +1,3 @@
+from .synthetic import SyntheticDataSet, SyntheticSpec, makeSpec, generate, openSyntheticDataSet
+from .tools import installFakeTools
+from .benchmark import Workspace, runBenchmarks, compareToBaseline, main
@@ -0,0 +1,322 @@
+
+from __future__ import print_function
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import logging
+import argparse
+import resource
+import tempfile
+import traceback
+import os.path as op
+
+from LociAnalysis.process import currentRss
+from LociAnalysis.version import getLongAmpliconVersion
+from LociAnalysis.benchmark.synthetic import (SPEC_FIELDS, makeSpec, generate, writeM1,
+                                              writeLaaOutputs, lociNames, barcodeNames,
+                                              openSyntheticDataSet, subreads, subreadName,
+                                              zmwBarcode, zmwLocus)
+from LociAnalysis.benchmark.tools import installFakeTools
+
+BENCHMARKS = ["whitelistdb", "laaphaser.parse", "resultwriter", "main"]
+METRICS    = ["wallTime", "cpuTime", "maxRss"]
+
+# Differences smaller than these are treated as noise, however large in relative terms
+NOISE_FLOOR = {"wallTime": 0.05, "cpuTime": 0.05, "maxRss": 4 * 1024 * 1024}
+
+MB = 1024 * 1024
+
+def _maxRssBytes( ru_maxrss ):
+    # Linux reports ru_maxrss in kilobytes, OS X in bytes
+    if sys.platform == "darwin":
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+class Workspace(object):
+    """
+    The synthetic data, stand-in tools and pre-computed tool outputs
+    shared by every benchmark run
+    """
+
+    def __init__(self, spec, directory):
+        self.spec      = spec
+        self.directory = directory
+        self.data      = generate( spec, op.join(directory, "data") )
+        self.bin       = installFakeTools( op.join(directory, "bin") )
+        os.environ["PATH"] = self.bin + os.pathsep + os.environ.get("PATH", "")
+        # Detect the LAA version once, for every benchmark process to inherit
+        getLongAmpliconVersion()
+
+        # Pre-computed blasr and LAA outputs, so that the component
+        #  benchmarks time only our own code
+        self.m1Dir = op.join(directory, "m1")
+        os.makedirs( self.m1Dir )
+        for locus in lociNames( spec ):
+            writeM1( spec, locus, op.join(self.m1Dir, "{0}.{1}.m1".format(op.basename(self.data.dataset)[:-len(".subreadset.xml")], locus)) )
+
+        self.laaDir = op.join(directory, "laa")
+        reads = {}
+        for holeNumber, qStart, qEnd in subreads( spec ):
+            key = (zmwBarcode(spec, holeNumber), zmwLocus(spec, holeNumber))
+            reads.setdefault(key, []).append( subreadName(holeNumber, qStart, qEnd) )
+        self.laaRuns = []
+        for barcode in (barcodeNames( spec ) or [None]):
+            for locus in lociNames( spec ):
+                runDir = op.join(self.laaDir, "{0}.{1}".format(barcode, locus))
+                os.makedirs( runDir )
+                writeLaaOutputs( spec, barcode, reads.get((barcode, locus), []), runDir )
+                self.laaRuns.append( (barcode, locus, runDir) )
+
+    def scratch( self, name ):
+        return tempfile.mkdtemp(prefix=name + ".", dir=self.directory)
+
+def _parseLaaRuns( workspace ):
+    from LociAnalysis.phaser import LaaPhaser
+    results = []
+    for barcode, locus, runDir in workspace.laaRuns:
+        phaser = LaaPhaser(barcode, workspace.data.dataset, locus)
+        phaser._tmpdir = runDir
+        sequences = phaser._parseSequences()
+        results.append( phaser._formatResults(sequences, phaser._parseSummaryCsv(), phaser._parseSubreadCsv()) )
+    return results
+
+def setupWhitelistDb( workspace ):
+    from LociAnalysis.refdb import RefDb
+    alnDir = workspace.scratch("aln")
+    for m1 in glob.glob(op.join(workspace.m1Dir, "*.m1")):
+        shutil.copy( m1, alnDir )
+    return RefDb( workspace.data.reference ), alnDir
+
+def runWhitelistDb( workspace, state ):
+    from LociAnalysis.whitelistdb import WhitelistDb
+    refDb, alnDir = state
+    db = WhitelistDb(refDb, workspace.data.dataset, dataset=openSyntheticDataSet(workspace.data.dataset),
+                     alnDir=alnDir)
+    for barcode in (barcodeNames( workspace.spec ) or [None]):
+        for locus in db.keys():
+            db.readCount( barcode, locus )
+
+def setupLaaParse( workspace ):
+    # Keep the cost of the first imports out of the timings
+    import pbcore.io
+    import LociAnalysis.phaser
+
+def runLaaParse( workspace, state ):
+    _parseLaaRuns( workspace )
+
+def setupResultWriter( workspace ):
+    import LociAnalysis.results
+    return _parseLaaRuns( workspace ), workspace.scratch("results")
+
+def runResultWriter( workspace, state ):
+    from LociAnalysis.results import ResultWriter
+    results, outputDir = state
+    writer = ResultWriter( outputDir )
+    currBarcode = None
+    for runResults in results:
+        for result in runResults:
+            if result.barcode != currBarcode:
+                writer.finalizeSubreadCsv()
+                currBarcode = result.barcode
+            writer.writeResult( result )
+    writer.finalizeSubreadCsv()
+
+def setupMain( workspace ):
+    import LociAnalysis.main
+    LociAnalysis.main.openDataSet = openSyntheticDataSet
+    # Force the reads to be aligned and binned from scratch
+    shutil.rmtree( workspace.data.dataset + "_aln", ignore_errors=True )
+    sys.argv = ["LociAnalysis", workspace.data.reference, workspace.data.dataset,
+                "-o", workspace.scratch("main"), "--noHistory", "--quiet"]
+
+def runMain( workspace, state ):
+    import LociAnalysis.main
+    LociAnalysis.main.main()
+
+BENCHMARK_FUNCTIONS = {"whitelistdb":     (setupWhitelistDb, runWhitelistDb),
+                       "laaphaser.parse": (setupLaaParse, runLaaParse),
+                       "resultwriter":    (setupResultWriter, runResultWriter),
+                       "main":            (setupMain, runMain)}
+
+def _measure( workspace, name ):
+    """
+    Run one benchmark in this process and return its measurements
+    """
+    setup, run = BENCHMARK_FUNCTIONS[name]
+    state = setup( workspace )
+    startRss = currentRss( os.getpid() ) or 0
+    t0, start = time.time(), os.times()
+    run( workspace, state )
+    t1, end = time.time(), os.times()
+    return {"wallTime":     t1 - t0,
+            "cpuTime":      (end[0] - start[0]) + (end[1] - start[1]),
+            "toolCpuTime":  (end[2] - start[2]) + (end[3] - start[3]),
+            "startRss":     startRss,
+            "maxRss":       _maxRssBytes(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)}
+
+def runBenchmark( workspace, name ):
+    """
+    Run one benchmark in a forked child, so that its peak memory and any
+    state it leaves behind (e.g. class-level caches) are its own
+    """
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close( readFd )
+        status = 0
+        try:
+            output = json.dumps( _measure(workspace, name) )
+        except BaseException:
+            output = json.dumps({"error": traceback.format_exc()})
+            status = 1
+        with os.fdopen(writeFd, 'w') as handle:
+            handle.write( output )
+        os._exit( status )
+
+    os.close( writeFd )
+    with os.fdopen(readFd) as handle:
+        output = handle.read()
+    os.waitpid(pid, 0)
+    result = json.loads( output ) if output else {"error": "benchmark process died"}
+    if "error" in result:
+        msg = "Benchmark '{0}' failed:\n{1}".format(name, result["error"])
+        logging.error( msg )
+        raise RuntimeError( msg )
+    return result
+
+def runBenchmarks( workspace, names, repeat=3 ):
+    """
+    Run each benchmark 'repeat' times, keeping the best time and worst memory
+    """
+    results = {}
+    for name in names:
+        runs = [runBenchmark(workspace, name) for _ in range(repeat)]
+        results[name] = {"wallTime":    min(r["wallTime"] for r in runs),
+                         "cpuTime":     min(r["cpuTime"] for r in runs),
+                         "toolCpuTime": min(r["toolCpuTime"] for r in runs),
+                         "maxRss":      max(r["maxRss"] for r in runs),
+                         "startRss":    max(r["startRss"] for r in runs),
+                         "runs":        len(runs)}
+        logging.info("Finished benchmark '{0}' in {1}s".format(name, round(results[name]["wallTime"], 3)))
+    return results
+
+def compareToBaseline( results, baseline, tolerance ):
+    """
+    Return a message for each metric that is more than 'tolerance' (a
+    fraction) worse than in the baseline
+    """
+    regressions = []
+    for name, measured in sorted(results.iteritems()):
+        if name not in baseline:
+            continue
+        for metric in METRICS:
+            old, new = baseline[name].get(metric), measured.get(metric)
+            if old is None or new is None:
+                continue
+            if new > old * (1.0 + tolerance) and new - old > NOISE_FLOOR[metric]:
+                regressions.append("{0} {1}: {2} -> {3} (+{4}%)".format(name, metric, _format(metric, old),
+                                   _format(metric, new), int(round(100.0 * (new - old) / max(old, 1e-9)))))
+    return regressions
+
+def _format( metric, value ):
+    if metric == "maxRss":
+        return "{0}MB".format(round(float(value) / MB, 1))
+    return "{0}s".format(round(value, 3))
+
+def formatTable( results, baseline=None ):
+    lines = ["{0:<18}{1:>12}{2:>12}{3:>12}{4:>12}".format("Benchmark", "Wall", "CPU", "Tool CPU", "Peak RSS")]
+    for name in BENCHMARKS:
+        if name not in results:
+            continue
+        r = results[name]
+        lines.append("{0:<18}{1:>12}{2:>12}{3:>12}{4:>12}".format(name, _format("wallTime", r["wallTime"]),
+                     _format("cpuTime", r["cpuTime"]), _format("cpuTime", r["toolCpuTime"]),
+                     _format("maxRss", r["maxRss"])))
+        if baseline and name in baseline:
+            b = baseline[name]
+            lines.append("{0:<18}{1:>12}{2:>12}{3:>12}{4:>12}".format("  (baseline)", _format("wallTime", b["wallTime"]),
+                         _format("cpuTime", b["cpuTime"]), _format("cpuTime", b.get("toolCpuTime", 0)),
+                         _format("maxRss", b["maxRss"])))
+    return "\n".join(lines)
+
+def parseArguments( args=None ):
+    desc = "Time LociAnalysis on synthetic data, using stand-ins for the SMRT Analysis tools"
+    parser = argparse.ArgumentParser(description=desc)
+    scale = parser.add_argument_group("Synthetic Data Options")
+    scale.add_argument("--zmws", type=int, metavar="INT", help="Number of ZMWs")
+    scale.add_argument("--subreadsPerZmw", type=int, metavar="INT", help="Subreads from each ZMW")
+    scale.add_argument("--loci", type=int, metavar="INT", help="Number of loci in the reference")
+    scale.add_argument("--barcodes", type=int, metavar="INT", help="Number of barcodes, 0 for none")
+    scale.add_argument("--resultsPerLocus", type=int, metavar="INT", help="LAA results for each barcode and locus")
+    scale.add_argument("--ampliconLength", type=int, metavar="INT", help="Length of each amplicon")
+    scale.add_argument("--offTarget", type=float, metavar="FLOAT", help="Fraction of reads aligning weakly to each other locus")
+    scale.add_argument("--seed", type=int, metavar="INT", help="Random seed")
+
+    runs = parser.add_argument_group("Benchmark Options")
+    runs.add_argument("--benchmarks", type=lambda v: v.split(','), default=BENCHMARKS,
+                      help="Comma-separated benchmarks to run. Default = {0}".format(",".join(BENCHMARKS)))
+    runs.add_argument("--repeat", type=int, default=3, metavar="INT", help="Runs of each benchmark. Default = 3")
+    runs.add_argument("--baseline", metavar="STRING", help="JSON results to compare against")
+    runs.add_argument("--tolerance", type=float, default=0.2, metavar="FLOAT",
+                      help="Fractional slowdown or memory growth flagged as a regression. Default = 0.2")
+    runs.add_argument("--updateBaseline", action="store_true", help="Save these results as the new baseline")
+    runs.add_argument("--output", metavar="STRING", help="Write the results as JSON to this file")
+    runs.add_argument("--workDirectory", metavar="STRING", help="Keep the synthetic data in this directory")
+    runs.add_argument("--verbose", "-v", action="store_true", help="Log progress")
+    opts = parser.parse_args( args )
+
+    unknown = set(opts.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error("Unknown benchmark(s): {0}".format(", ".join(sorted(unknown))))
+    if opts.updateBaseline and not opts.baseline:
+        parser.error("--updateBaseline requires --baseline")
+    return opts
+
+def main( args=None ):
+    opts = parseArguments( args )
+    logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING,
+                        format=">|> %(asctime)s -|- %(levelname)s -|- %(message)s")
+
+    spec = makeSpec(**dict((f, getattr(opts, f)) for f in SPEC_FIELDS))
+    directory = opts.workDirectory or tempfile.mkdtemp(prefix="loci_analysis_benchmark.")
+    try:
+        workspace = Workspace( spec, directory )
+        results   = runBenchmarks( workspace, opts.benchmarks, opts.repeat )
+    finally:
+        if opts.workDirectory is None:
+            shutil.rmtree( directory, ignore_errors=True )
+
+    report = {"spec":     spec._asdict(),
+              "host":     socket.gethostname(),
+              "python":   sys.version.split()[0],
+              "time":     time.time(),
+              "results":  results}
+    if opts.output:
+        with open(opts.output, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+
+    baseline = None
+    if opts.baseline and op.isfile(opts.baseline):
+        with open(opts.baseline) as handle:
+            previous = json.load(handle)
+        if previous.get("spec") != report["spec"]:
+            logging.warn("Baseline was recorded with different synthetic data, comparisons may be meaningless")
+        baseline = previous.get("results", {})
+    print(formatTable( results, baseline ))
+
+    regressions = compareToBaseline( results, baseline, opts.tolerance ) if baseline else []
+    for regression in regressions:
+        print("REGRESSION: " + regression)
+
+    if opts.updateBaseline:
+        with open(opts.baseline, 'w') as handle:
+            json.dump(report, handle, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
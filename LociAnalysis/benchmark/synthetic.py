@@ -0,0 +1,213 @@
+
+import os
+import json
+import random
+import os.path as op
+
+from collections import namedtuple
+
+from pbcore.io import DataSet
+
+SPEC_FILE    = "synthetic.json"
+DATASET_FILE = "synthetic.subreadset.xml"
+MOVIE        = "m54000_160101_000000"
+ADAPTER      = 50       # Bases between consecutive subreads of a ZMW
+BASES        = "ACGT"
+
+SPEC_FIELDS = ["zmws", "subreadsPerZmw", "loci", "barcodes", "resultsPerLocus",
+               "ampliconLength", "offTarget", "seed"]
+
+DEFAULT_SPEC = {"zmws":            2000,
+                "subreadsPerZmw":  5,
+                "loci":            6,
+                "barcodes":        4,
+                "resultsPerLocus": 4,
+                "ampliconLength":  3000,
+                "offTarget":       0.2,
+                "seed":            42}
+
+SyntheticSpec = namedtuple("SyntheticSpec", SPEC_FIELDS)
+SyntheticData = namedtuple("SyntheticData", ["spec", "directory", "reference", "dataset"])
+
+def makeSpec( **kwargs ):
+    """
+    A SyntheticSpec with any unspecified fields set to their defaults.
+    Setting 'barcodes' to zero generates a dataset without barcodes
+    """
+    values = dict(DEFAULT_SPEC)
+    values.update( (k, v) for k, v in kwargs.iteritems() if v is not None )
+    return SyntheticSpec(**values)
+
+def readSpec( datasetFn ):
+    with open(op.join(op.dirname(op.abspath(datasetFn)), SPEC_FILE)) as handle:
+        return SyntheticSpec(**json.load(handle))
+
+def lociNames( spec ):
+    return ["Locus{0}".format(i) for i in range(spec.loci)]
+
+def barcodeNames( spec ):
+    return ["{0}--{0}".format(i) for i in range(spec.barcodes)]
+
+def subreadName( holeNumber, qStart, qEnd ):
+    return "{0}/{1}/{2}_{3}".format(MOVIE, holeNumber, qStart, qEnd)
+
+def zmwBarcode( spec, holeNumber ):
+    if spec.barcodes == 0:
+        return None
+    return "{0}--{0}".format(holeNumber % spec.barcodes)
+
+def zmwLocus( spec, holeNumber ):
+    return "Locus{0}".format((holeNumber // max(1, spec.barcodes)) % spec.loci)
+
+def subreads( spec ):
+    """
+    Generate the (holeNumber, qStart, qEnd) of every subread in the dataset.
+    Every ZMW is from a single barcode and locus, assigned round-robin
+    """
+    for holeNumber in range(spec.zmws):
+        for i in range(spec.subreadsPerZmw):
+            qStart = i * (spec.ampliconLength + ADAPTER)
+            yield holeNumber, qStart, qStart + spec.ampliconLength
+
+def _randomSequence( rng, length ):
+    return "".join(rng.choice(BASES) for _ in range(length))
+
+def _writeReference( spec, directory, rng ):
+    if not op.isdir( directory ):
+        os.makedirs( directory )
+    for locus in lociNames( spec ):
+        with open(op.join(directory, locus + ".fasta"), 'w') as handle:
+            for allele in range(3):
+                handle.write(">{0}*{1:02d}\n".format(locus, allele + 1))
+                sequence = _randomSequence(rng, spec.ampliconLength)
+                for i in range(0, len(sequence), 70):
+                    handle.write(sequence[i:i+70] + "\n")
+
+def generate( spec, directory ):
+    """
+    Write a synthetic dataset and a reference directory for it, and
+    return a SyntheticData describing them.  The reads themselves are
+    never written: the stand-in tools derive their outputs from the spec
+    """
+    rng = random.Random( spec.seed )
+    if not op.isdir( directory ):
+        os.makedirs( directory )
+    reference = op.join(directory, "reference")
+    _writeReference( spec, reference, rng )
+
+    with open(op.join(directory, SPEC_FILE), 'w') as handle:
+        json.dump(spec._asdict(), handle, indent=2, sort_keys=True)
+    dataset = op.join(directory, DATASET_FILE)
+    with open(dataset, 'w') as handle:
+        handle.write('<?xml version="1.0" encoding="utf-8"?>\n')
+        handle.write('<!-- Synthetic LociAnalysis benchmark data, see {0} -->\n'.format(SPEC_FILE))
+        handle.write('<SubreadSet Name="synthetic" />\n')
+    return SyntheticData(spec, directory, reference, dataset)
+
+def writeM1( spec, locus, filename ):
+    """
+    Write BLASR's m1 output for aligning every subread to one locus:
+    the subreads from that locus align well, and a fraction of the rest
+    align with a lower score
+    """
+    rng    = random.Random( "{0}:{1}".format(spec.seed, locus) )
+    length = spec.ampliconLength
+    with open( filename, 'w' ) as handle:
+        for holeNumber, qStart, qEnd in subreads( spec ):
+            if zmwLocus(spec, holeNumber) == locus:
+                score = -5 * length
+            elif rng.random() < spec.offTarget:
+                score = -2 * length
+            else:
+                continue
+            handle.write("{0} {1}*01 0 0 {2} 90.0 0 {3} {3} {4} {5} {3} 0\n".format(
+                         subreadName(holeNumber, qStart, qEnd), locus, score, length, qStart, qEnd))
+
+def writeLaaOutputs( spec, barcode, reads, directory ):
+    """
+    Write the outputs of an LAA run over 'reads' for one barcode (or the
+    whole dataset if 'barcode' is None) to 'directory', splitting the
+    reads between 'resultsPerLocus' results, the last of which is noise
+    """
+    rng = random.Random( "{0}:{1}:{2}".format(spec.seed, barcode, len(reads)) )
+    nResults = max(1, min(spec.resultsPerLocus, len(reads)))
+    groups   = [reads[i::nResults] for i in range(nResults)]
+    prefix   = "Barcode{0}".format("0--0" if barcode is None else barcode)
+    names    = ["{0}_Cluster0_Phase{1}_NumReads{2}".format(prefix, i, len(group))
+                for i, group in enumerate(groups)]
+    isJunk   = [nResults > 1 and i == nResults - 1 for i in range(nResults)]
+
+    good  = open(op.join(directory, "amplicon_analysis.fastq"), 'w')
+    junk  = open(op.join(directory, "amplicon_analysis_chimeras_noise.fastq"), 'w')
+    for name, noise in zip(names, isJunk):
+        sequence = _randomSequence(rng, spec.ampliconLength)
+        (junk if noise else good).write("@{0}\n{1}\n+\n{2}\n".format(name, sequence, "~" * len(sequence)))
+    good.close()
+    junk.close()
+
+    with open(op.join(directory, "amplicon_analysis_summary.csv"), 'w') as handle:
+        handle.write("BarcodeName,FastaName,CoarseCluster,Phase,TotalCoverage,SequenceLength,"
+                     "PredictedAccuracy,ConsensusConverged,NoiseSequence,IsDuplicate,DuplicateOf,"
+                     "IsChimera,ChimeraScore,ParentSequenceA,ParentSequenceB,CrossoverPosition\n")
+        for i, (name, noise) in enumerate(zip(names, isJunk)):
+            handle.write("{0},{1},0,{2},{3},{4},0.999,true,{5},false,N/A,false,0,,,\n".format(
+                         barcode or "0--0", name, i, len(groups[i]), spec.ampliconLength, str(noise).lower()))
+
+    if barcode is None:
+        subreadCsv = op.join(directory, "amplicon_analysis_subreads.csv")
+    else:
+        subreadCsv = op.join(directory, "amplicon_analysis_subreads.{0}.csv".format(barcode))
+    with open(subreadCsv, 'w') as handle:
+        handle.write("SubreadId," + ",".join(names) + "\n")
+        for i, group in enumerate(groups):
+            weights = ",".join("1.0" if j == i else "0.0" for j in range(nResults))
+            for read in group:
+                handle.write("{0},{1}\n".format(read, weights))
+    return names
+
+class _Columns(object):
+    """
+    Column-wise table, standing in for the record arrays of pbcore
+    """
+    def __init__(self, **columns):
+        for name, values in columns.iteritems():
+            setattr(self, name, values)
+
+class SyntheticDataSet(DataSet):
+    """
+    A SubreadSet for a synthetic dataset, implementing only the index
+    and read-group table that LociAnalysis reads, so that no BAM files
+    need be written
+    """
+
+    def __init__(self, filename):
+        self.fileName   = filename
+        self.spec       = readSpec( filename )
+        columns = dict((name, []) for name in ("qId", "holeNumber", "qStart", "qEnd", "bcForward", "bcReverse"))
+        for holeNumber, qStart, qEnd in subreads( self.spec ):
+            bc = holeNumber % self.spec.barcodes if self.spec.barcodes else -1
+            columns["qId"].append( 0 )
+            columns["holeNumber"].append( holeNumber )
+            columns["qStart"].append( qStart )
+            columns["qEnd"].append( qEnd )
+            columns["bcForward"].append( bc )
+            columns["bcReverse"].append( bc )
+        if not self.spec.barcodes:
+            del columns["bcForward"], columns["bcReverse"]
+        self._index     = _Columns(**columns)
+        self._readGroup = _Columns(ID=[0], MovieName=[MOVIE])
+
+    @property
+    def index(self):
+        return self._index
+
+    @property
+    def readGroupTable(self):
+        return self._readGroup
+
+    @property
+    def isBarcoded(self):
+        return self.spec.barcodes > 0
+
+def openSyntheticDataSet( filename ):
+    return SyntheticDataSet( filename )
@@ -0,0 +1,85 @@
+
+import os
+import sys
+import shutil
+import os.path as op
+
+from LociAnalysis.benchmark.synthetic import (readSpec, writeM1, writeLaaOutputs,
+                                              zmwBarcode)
+
+LAA_VERSION = "laa 2.3.0 (commit benchmark) | synthetic"
+
+TOOL_TEMPLATE = """#!{python}
+# Stand-in for '{tool}' generated by the LociAnalysis benchmark
+import sys
+sys.path.insert(0, {root!r})
+from LociAnalysis.benchmark.tools import {function}
+sys.exit({function}(sys.argv[1:]))
+"""
+
+def _parseArgs( args ):
+    """
+    Split a command line into a dict of '--key value' options and a list
+    of positional arguments
+    """
+    opts, positional = {}, []
+    i = 0
+    while i < len(args):
+        if args[i].startswith('-') and i + 1 < len(args):
+            opts[args[i].lstrip('-')] = args[i+1]
+            i += 2
+        else:
+            positional.append( args[i] )
+            i += 1
+    return opts, positional
+
+def fakeLaa( args ):
+    if "--version" in args:
+        print(LAA_VERSION)
+        return 0
+    opts, positional = _parseArgs( args )
+    spec    = readSpec( positional[-1] )
+    barcode = opts.get("doBc")
+    with open(opts["whitelist"]) as handle:
+        reads = [line.strip() for line in handle]
+    if barcode is not None:
+        reads = [r for r in reads if zmwBarcode(spec, int(r.split('/')[1])) == barcode]
+    reads = reads[:int(opts.get("maxReads", len(reads)))]
+    writeLaaOutputs( spec, barcode, reads, os.getcwd() )
+    return 0
+
+def fakeBlasr( args ):
+    opts, positional = _parseArgs( args )
+    query, reference = positional[:2]
+    locus = op.basename( reference ).split('.')[0]
+    writeM1( readSpec( query ), locus, opts["out"] )
+    return 0
+
+def fakeSawriter( args ):
+    open(args[0] + ".sa", 'w').close()
+    return 0
+
+def fakeDataset( args ):
+    # dataset create <output> <input>
+    shutil.copy( args[2], args[1] )
+    return 0
+
+TOOLS = {"laa":      "fakeLaa",
+         "blasr":    "fakeBlasr",
+         "sawriter": "fakeSawriter",
+         "dataset":  "fakeDataset"}
+
+def installFakeTools( directory ):
+    """
+    Write stand-ins for the SMRT Analysis tools LociAnalysis calls to
+    'directory', which should then be put at the front of PATH
+    """
+    if not op.isdir( directory ):
+        os.makedirs( directory )
+    root = op.dirname(op.dirname(op.dirname(op.abspath(__file__))))
+    for tool, function in TOOLS.iteritems():
+        path = op.join(directory, tool)
+        with open(path, 'w') as handle:
+            handle.write( TOOL_TEMPLATE.format(python=sys.executable, tool=tool, root=root, function=function) )
+        os.chmod(path, 0o755)
+    return directory
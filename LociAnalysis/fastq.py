@@ -0,0 +1,76 @@
+
+import itertools
+
+class FastqRecord(object):
+    """
+    A FASTQ record that keeps its quality values as the raw Phred+33 string
+    they were read as, so that records can be read, renamed and written
+    again without ever decoding them
+    """
+    __slots__ = ("header", "sequence", "qualityString")
+
+    def __init__(self, header, sequence, qualityString):
+        self.header        = header
+        self.sequence      = sequence
+        self.qualityString = qualityString
+
+    @property
+    def id(self):
+        return self.header.split(None, 1)[0]
+
+    @property
+    def quality(self):
+        return [ord(q) - 33 for q in self.qualityString]
+
+    def renamed( self, newId ):
+        return FastqRecord(newId, self.sequence, self.qualityString)
+
+    def __len__( self ):
+        return len(self.sequence)
+
+    def __eq__( self, other ):
+        return isinstance(other, FastqRecord) and \
+            (self.header, self.sequence, self.qualityString) == (other.header, other.sequence, other.qualityString)
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def __repr__( self ):
+        return "<FastqRecord: {0}>".format(self.header)
+
+    def __str__( self ):
+        return "@{0}\n{1}\n+\n{2}\n".format(self.header, self.sequence, self.qualityString)
+
+def readFastq( filename ):
+    """
+    Generate the records of a FASTQ file with one line each of sequence and
+    quality, as written by LAA
+    """
+    with open( filename ) as handle:
+        lines = (line.rstrip("\r\n") for line in handle)
+        for lineNum in itertools.count(1, 4):
+            header = next(lines, None)
+            if not header:
+                return
+            sequence, plus, quality = next(lines, None), next(lines, None), next(lines, None)
+            if not header.startswith("@") or plus is None or not plus.startswith("+") or \
+                    quality is None or len(quality) != len(sequence):
+                raise ValueError("Invalid FASTQ record at line {0} of {1}".format(lineNum, filename))
+            yield FastqRecord(header[1:], sequence, quality)
+
+class FastqWriter(object):
+    """
+    Write FastqRecords to a filename or an open file object
+    """
+
+    def __init__(self, f):
+        if isinstance(f, basestring):
+            self.file = open(f, 'w')
+        else:
+            self.file = f
+
+    def writeRecord( self, record ):
+        self.file.write( str(record) )
+
+    def close( self ):
+        self.file.close()
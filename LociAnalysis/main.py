@@ -3,35 +3,99 @@
 # Author: Brett Bowman
 
 from __future__ import absolute_import
+from __future__ import print_function
 
+import os
+import sys
 import logging
 import itertools
 import time
-
-from pbcore.io import openDataSet
+import os.path as op
 
 from LociAnalysis.options import (options,
                                   parseOptions)
-from LociAnalysis.barcodes import getBarcodes
+from LociAnalysis.barcodes import (getBarcodes, getBarcodeReadCounts, getDataSetBarcodes,
+                                   getDoBcBarcodes)
+from LociAnalysis.manifest import readManifest
+from LociAnalysis.shards import (ShardIndexWriter, assignShards, mergeMain,
+                                 readShardSpec, selectShardUnits, writeShardSpecs)
 from LociAnalysis.refdb import RefDb
-from LociAnalysis.whitelistdb import WhitelistDb
-from LociAnalysis.phaser import LaaPhaser
-from LociAnalysis.results import ResultWriter
-from LociAnalysis.version import (LONG_AMPLICON_VERSION,
-                                  SMRT_ANALYSIS_VERSION)
+from LociAnalysis.whitelistdb import WhitelistDb, getAligner
+from LociAnalysis.phaser import LaaPhaser, PhasingCache
+from LociAnalysis.results import ResultDb, ResultSink, ResultWriter
+from LociAnalysis.affinity import CpuAllocator, formatCpuList, limitLibraryThreads
+from LociAnalysis.process import setCpuAffinity, setToolTimeouts
+from LociAnalysis.profiling import profiler
+from LociAnalysis.progress import ProgressMonitor
+from LociAnalysis.scratch import ScratchManager
+from LociAnalysis.scheduler import (MemoryModel, PhasingScheduler, PhasingUnit,
+                                    Planner, RuntimeHistory)
+from LociAnalysis.sweep import SWEEP_TABLE, SweepReport, readSweep
+from LociAnalysis.watch import Chunk, ChunkBins, RunWatcher, writeChunkDataSet
+from LociAnalysis.version import (getLongAmpliconVersion,
+                                  getSmrtAnalysisVersion)
 
 import LociAnalysis.logger  # Enable TRACE-level logging
 
+MB = 1024 * 1024
+
+def openDataSet( fn ):
+    # pbcore is slow to import, so don't pay for it until we need it
+    from pbcore.io import openDataSet
+    return openDataSet( fn )
+
+PHASING_OPTIONS = ["rngSeed", "minBarcodeScore", "minLength", "maxLength", "minReadScore",
+                   "minSnr", "maxReads", "maxClusteringReads", "skipRate"]
+
+class AnalysisJob(object):
+    """
+    The state of the analysis of one input dataset: its reads, bins,
+    outputs and progress
+    """
+    def __init__(self, inputFn, outputDirectory, config=None):
+        self.inputFn         = inputFn
+        self.outputDirectory = outputDirectory
+        self.config          = config     # The SweepConfig of a job in a parameter sweep
+        self.dataset         = None
+        self.barcodes        = None
+        self.barcodeCounts   = None
+        self.whitelistDb     = None
+        self.resultWriter    = None
+        self.resultSink      = None
+        self.monitor         = None
+        self.shardIndex      = None
+        self.failures        = 0
+        self.finished        = False
+
+    @property
+    def name(self):
+        return op.basename( self.inputFn )
+
+class UnitMonitor(object):
+    """
+    Forward the start and end of each unit to the progress monitor of
+    the job it belongs to
+    """
+    def unitStarted( self, unit ):
+        if unit.job.monitor is not None:
+            unit.job.monitor.unitStarted( unit )
+
+    def unitFinished( self, unit ):
+        if unit.job.monitor is not None:
+            unit.job.monitor.unitFinished( unit )
+
 class LociAnalysis(object):
     """
     The main driver class for locus-specific Amplicon Analysis
     """
     def __init__(self):
-        self._inputFn     = None
-        self._inputDs     = None
-        self._barcodes    = None
+        self._jobs        = []
         self._refDb       = None
-        self._whitelistDb = None
+        self._scratch     = None
+        self._cache       = None
+        self._sweepReport = None
+        self._failures    = 0
+        self._failedJobs  = 0
 
     def _setupLogging(self):
         if options.quiet:
@@ -48,68 +112,495 @@ class LociAnalysis(object):
         logging.Formatter.converter = time.gmtime
         logging.basicConfig(level=logLevel, format=logFormat)
 
-    def main(self):
-        parseOptions()
+    def main(self, args=None):
+        # Our concurrency comes from the tools we run, so keep any numerical
+        #  libraries we load from starting a thread per core of their own
+        limitLibraryThreads()
+        parseOptions( args )
         self._setupLogging()
+        setToolTimeouts(options.toolTimeouts, options.stallTimeouts)
+        if options.pinCpus:
+            self._pinCpus()
 
-        self._inputFn      = options.inputFilename
-        self._inputDs      = self._openDataSet(options.inputFilename)
-        self._resultWriter = ResultWriter(options.outputDirectory)
-        self._barcodes     = getBarcodes(self._inputDs, options.doBc)
-        self._refDb        = RefDb(options.referenceDirectory)
-        self._whitelistDb  = WhitelistDb(self._refDb, self._inputFn,
-                                         dataset=self._inputDs,
-                                         combined=options.combineLoci,
-                                         nproc=options.nproc)
-
-        logging.info("Found LAA v{0} from SMRT Analysis v{1}".format(LONG_AMPLICON_VERSION, SMRT_ANALYSIS_VERSION))
-
-        if self._barcodes:
-            for barcode in self._barcodes:
-                self._phaseSample( barcode )
-                self._resultWriter.finalizeSubreadCsv()
-        else:
-            self._phaseSample( None )
-            self._resultWriter.finalizeSubreadCsv()
+        if options.profile or options.cProfile or options.trace:
+            profiler.enable( cProfile=options.cProfile )
+        try:
+            self._analyze()
+        except:
+            for job in self._jobs:
+                if job.resultSink is not None and not job.finished:
+                    job.resultSink.abort()
+                if job.monitor is not None and not job.finished:
+                    job.monitor.setStage("failed")
+            raise
+        finally:
+            if self._scratch is not None:
+                self._scratch.cleanup()
+            self._writeProfile()
+
+    def _pinCpus(self):
+        allocator = CpuAllocator( options.cpuSet )
+        logging.info("Pinning external tools to CPUs {0}".format(formatCpuList( allocator.cpus )))
+        if options.concurrentLoci * options.nproc > len(allocator.cpus):
+            logging.warn("{0} concurrent loci of {1} thread(s) each need more than the {2} CPU(s) available, "
+                         "so some will share CPUs".format(options.concurrentLoci, options.nproc, len(allocator.cpus)))
+        setCpuAffinity( allocator )
+
+    def _writeProfile(self):
+        if options.profile:
+            profiler.writeReport( op.join(options.outputDirectory, "loci_analysis_profile.json") )
+        if options.cProfile:
+            profiler.writeCProfile( op.join(options.outputDirectory, "loci_analysis_profile.pstats") )
+        if options.trace:
+            profiler.writeTrace( op.join(options.outputDirectory, "loci_analysis_trace.json") )
+
+    def _readJobs(self):
+        if options.sweep:
+            configs = readSweep( options.sweep, PHASING_OPTIONS )
+            logging.info("Read {0} configuration(s) from sweep '{1}'".format(len(configs), options.sweep))
+            self._sweepReport = SweepReport( configs )
+            return [AnalysisJob(options.inputFilename, op.join(options.outputDirectory, config.label), config=config)
+                    for config in configs]
+        if not options.batch:
+            return [AnalysisJob(options.inputFilename, options.outputDirectory)]
+        entries = readManifest( options.inputFilename, options.outputDirectory )
+        logging.info("Read {0} input(s) from manifest '{1}'".format(len(entries), options.inputFilename))
+        return [AnalysisJob(e.inputFilename, e.outputDirectory) for e in entries]
+
+    def _analyze(self):
+        self._jobs         = self._readJobs()
+        self._refDb        = self._buildRefDb()
+        self._scratch      = ScratchManager(options.scratchDir,
+                                            minFree=options.scratchMinFree * MB,
+                                            keepFailed=options.keepFailedScratch)
+        self._history      = RuntimeHistory(None if options.noHistory else options.historyFile)
+        self._planner      = Planner(self._history, slots=options.concurrentLoci)
+
+        if options.dryRun:
+            for job in self._jobs:
+                self._openJob( job )
+                job.barcodeCounts = getBarcodeReadCounts( job.dataset )
+                if options.batch or options.sweep:
+                    print("{0} -> {1}".format(job.inputFn, job.outputDirectory))
+                print(self._planner.report( list(self._phasingUnits( job )) ))
+            return
 
-    def _phaseSample(self, barcode):
-        if barcode is not None:
-            logging.info("Processing loci for barcode '{0}'".format(barcode))
+        if options.writeShards:
+            self._writeShards( self._jobs[0] )
+            return
+
+        logging.info("Found LAA v{0} from SMRT Analysis v{1}".format(getLongAmpliconVersion(), getSmrtAnalysisVersion()))
+        if options.phasingCache:
+            self._cache    = PhasingCache(options.phasingCache, getLongAmpliconVersion())
+
+        self._memoryModel  = MemoryModel(options.memoryModel,
+                                         observations=self._history.memoryObservations())
+        self._scheduler    = PhasingScheduler(self._phaseUnit,
+                                              maxUnits=options.concurrentLoci,
+                                              memoryLimit=options.memoryLimit * MB,
+                                              memoryModel=self._memoryModel,
+                                              history=self._history,
+                                              monitor=UnitMonitor(),
+                                              scratch=self._scratch)
+
+        # Results are written by each job's ResultSink as units finish, so
+        #  here we only need to notice failures and the end of each job
+        currJob = None
+        if options.watch:
+            units = self._watchedUnits()
+        elif options.sweep:
+            units = self._sweepUnits()
         else:
-            logging.info("Processing loci for full dataset")
+            units = self._plannedUnits()
+        for unit in self._scheduler.run( units ):
+            if unit.job is not currJob:
+                if currJob is not None:
+                    self._finishJob( currJob )
+                currJob = unit.job
+            self._unitFinished( unit )
+        for job in self._jobs:
+            if not job.finished:
+                self._finishJob( job )
+        self._memoryModel.save()
+        if self._cache is not None:
+            logging.info("Restored {0} locus/barcode pair(s) from the phasing cache".format(self._cache.hits))
+        if self._sweepReport is not None:
+            table = self._sweepReport.write( op.join(options.outputDirectory, SWEEP_TABLE) )
+            logging.info("Wrote the comparison of {0} configuration(s) to '{1}'".format(len(self._jobs), table))
+
+        if options.batch and self._failures:
+            logging.warn("{0} locus/barcode pair(s) could not be phased across {1} input(s)".format(self._failures, len(self._jobs)))
+        if self._failedJobs:
+            logging.warn("{0} of {1} input(s) could not be analyzed".format(self._failedJobs, len(self._jobs)))
+
+    def _openJob(self, job):
+        job.dataset = self._openDataSet( job.inputFn )
+        with profiler.stage("barcodes", unit=job.name) as stage:
+            job.barcodes = getBarcodes(job.dataset, options.doBc)
+            stage.count("barcodes", len(job.barcodes))
+
+    def _prepareJob(self, job, start=0):
+        """
+        Open a dataset, bin its reads by locus and open its outputs, which
+        will start with the unit indexed 'start'
+        """
+        self._openMonitor( job )
+        self._openJob( job )
+        self._openOutputs( job, start=start )
+        job.whitelistDb = self._buildWhitelistDb( job )
 
-        for locus, locusWl in self._whitelistDb.iteritems():
-            if options.doLoci is not None and locus not in options.doLoci:
-                logging.debug("Locus '{0}' not specified by the user, skipping".format(locus))
+    def _openMonitor(self, job):
+        if not op.isdir( job.outputDirectory ):
+            os.makedirs( job.outputDirectory )
+        if not options.noStatusFile:
+            statusFile = options.statusFile if not (options.batch or options.sweep) else None
+            statusFile = statusFile or op.join(job.outputDirectory, "loci_analysis_status.prom")
+            job.monitor = ProgressMonitor(statusFile, label=job.outputDirectory)
+            job.monitor.setStage("binning")
+
+    def _openOutputs(self, job, start=0):
+        resultDb = None
+        if options.resultDb:
+            name = options.runName if options.runName and not options.batch else job.name
+            if job.config is not None:
+                name = "{0}.{1}".format(name, job.config.label)
+            resultDb = ResultDb(options.resultDb, name, inputFn=job.inputFn,
+                                outputDirectory=job.outputDirectory, subreads=options.resultDbSubreads)
+        job.resultWriter = ResultWriter(job.outputDirectory, compress=options.compress,
+                                        threads=options.compressThreads,
+                                        subreadFormat=options.subreadFormat,
+                                        resultDb=resultDb,
+                                        barcodeOutputs=options.barcodeOutputs)
+        job.resultSink   = ResultSink(job.resultWriter, first=start, name=op.basename( job.outputDirectory ))
+
+    def _writeShards(self, job):
+        """
+        Bin the reads and split the planned units between shards
+        """
+        self._openJob( job )
+        job.whitelistDb = self._buildWhitelistDb( job )
+        units = self._planner.plan( list(self._phasingUnits( job )) )
+        assigned = assignShards( units, options.shards )
+        for filename in writeShardSpecs( options.writeShards, assigned, len(units),
+                                         job.inputFn, options.referenceDirectory ):
+            logging.info("Wrote shard specification '{0}'".format(filename))
+
+    def _buildRefDb(self):
+        return RefDb(options.referenceDirectory)
+
+    def _buildWhitelistDb(self, job):
+        return WhitelistDb(self._refDb, job.inputFn,
+                           dataset=job.dataset,
+                           alnDir=self._alignmentDir( job.inputFn ),
+                           combined=options.combineLoci,
+                           nproc=options.nproc,
+                           aligner=getAligner( options.aligner, options.alignmentFormat ))
+
+    def _alignmentDir(self, inputFn):
+        # By default alignments are kept next to the input
+        if options.scratchDir:
+            return self._scratch.alignmentDir( inputFn )
+        return None
+
+    def _plannedUnits(self):
+        """
+        Generate the units of every job, binning each job's reads only
+        once the scheduler has started all of the units before it, so
+        that binning one dataset overlaps with phasing the last.  In batch
+        mode a dataset that can't be opened or binned is skipped, and the
+        rest of the batch still analyzed
+        """
+        index = 0
+        for job in self._jobs:
+            try:
+                self._prepareJob( job, start=index )
+                units = list(self._phasingUnits( job, start=index ))
+                if options.shardSpec:
+                    spec = readShardSpec( options.shardSpec )
+                    units, indices = selectShardUnits( spec, units, job.inputFn, options.referenceDirectory )
+                    job.shardIndex = ShardIndexWriter( job.outputDirectory, spec, indices )
+            except Exception as error:
+                if not options.batch or options.failFast:
+                    raise
+                self._jobFailed( job, error )
                 continue
-            if options.ignoreLoci is not None and locus in options.ignoreLoci:
-                logging.debug("User elected to ignore Locus '{0}', skipping".format(locus))
+            index += len(units)
+            if job.monitor is not None:
+                job.monitor.setReadsBinned( job.whitelistDb.binnedReads )
+                job.monitor.addUnits( len(units) )
+                job.monitor.setStage("phasing")
+            for unit in self._planner.plan( units ):
+                yield unit
+
+    def _sweepUnits(self):
+        """
+        Bin the reads once and plan the units of every configuration of a
+        sweep together, so that each whitelist is shared by every
+        configuration and their LAA runs share the same workers
+        """
+        first = self._jobs[0]
+        self._prepareJob( first )
+        units = []
+        for job in self._jobs:
+            if job is not first:
+                self._openMonitor( job )
+                job.dataset, job.barcodes = first.dataset, first.barcodes
+                job.whitelistDb = first.whitelistDb
+                self._openOutputs( job, start=len(units) )
+            jobUnits = list(self._phasingUnits( job, start=len(units) ))
+            if job.monitor is not None:
+                job.monitor.setReadsBinned( job.whitelistDb.binnedReads )
+                job.monitor.addUnits( len(jobUnits) )
+                job.monitor.setStage("phasing")
+            units.extend( jobUnits )
+        return self._planner.plan( units )
+
+    def _watchedUnits(self):
+        """
+        Bin the BAMs of a sequencing run as they are written, and generate
+        the units of each barcode as soon as all of its reads are binned:
+        with --watchByBarcode once the one BAM holding them has been, and
+        otherwise once the whole run has
+        """
+        job = self._jobs[0]
+        self._openMonitor( job )
+        self._openOutputs( job )
+        watchDir = op.join(job.outputDirectory, "loci_analysis_watch")
+        if not op.isdir( watchDir ):
+            os.makedirs( watchDir )
+        watcher = RunWatcher(job.inputFn, pattern=options.watchPattern, done=options.watchDone,
+                             expected=options.watchChunks, idle=options.watchIdle, poll=options.watchPoll,
+                             exclude=job.outputDirectory)
+
+        chunks, phased, index = [], set(), 0
+        job.barcodes = []
+        for filename in watcher:
+            chunk = self._binChunk( filename, watchDir )
+            chunks.append( chunk )
+            if job.monitor is not None:
+                job.monitor.setReadsBinned( sum(c.whitelistDb.binnedReads for c in chunks) )
+            if not options.watchByBarcode:
                 continue
+            barcodes = [bc for bc in chunk.barcodes if bc not in phased]
+            if len(barcodes) < len(chunk.barcodes):
+                logging.warn("Some barcodes in '{0}' were already phased from an earlier BAM, "
+                             "ignoring their reads in it".format(chunk.name))
+            if barcodes:
+                phased.update( barcodes )
+                for unit in self._chunkUnits( job, [chunk], barcodes, index, watchDir ):
+                    index += 1
+                    yield unit
+
+        # Whatever is left is phased from every BAM that holds any of it
+        barcodes = sorted(set(bc for chunk in chunks for bc in chunk.barcodes) - phased)
+        if barcodes:
+            chunks = [c for c in chunks if set(c.barcodes) & set(barcodes)]
+        if chunks and (barcodes or not phased):
+            for unit in self._chunkUnits( job, chunks, barcodes, index, watchDir ):
+                yield unit
+
+    def _binChunk(self, filename, watchDir):
+        logging.info("Binning the reads of '{0}'".format(filename))
+        dataset  = self._openDataSet( filename )
+        barcodes = getDataSetBarcodes( dataset )
+        if options.doBc:
+            barcodes = [bc for bc in barcodes if bc in getDoBcBarcodes( options.doBc )]
+        alnDir = self._alignmentDir( filename ) or op.join(watchDir, op.basename( filename ) + "_aln")
+        whitelistDb = WhitelistDb(self._refDb, filename,
+                                  dataset=dataset,
+                                  alnDir=alnDir,
+                                  combined=options.combineLoci,
+                                  nproc=options.nproc,
+                                  aligner=getAligner( options.aligner, options.alignmentFormat ))
+        return Chunk(filename, barcodes, whitelistDb)
+
+    def _chunkUnits(self, job, chunks, barcodes, start, watchDir):
+        """
+        Plan the units of some barcodes, phasing them from just the BAMs
+        that hold their reads
+        """
+        if len(chunks) == 1:
+            inputFn, job.whitelistDb = chunks[0].filename, chunks[0].whitelistDb
+        else:
+            name    = "chunks.{0}".format(start)
+            inputFn = writeChunkDataSet( chunks, op.join(watchDir, name + ".subreadset.xml") )
+            job.whitelistDb = ChunkBins( chunks, op.join(watchDir, name) )
+        job.barcodes = sorted(job.barcodes + barcodes)
+        units = list(self._phasingUnits( job, start=start, barcodes=barcodes, inputFn=inputFn ))
+        logging.info("Phasing {0} barcode(s) from {1} BAM(s)".format(len(barcodes), len(chunks)))
+        if job.monitor is not None:
+            job.monitor.addUnits( len(units) )
+            job.monitor.setStage("phasing")
+        return self._planner.plan( units )
+
+    def _jobFailed(self, job, error):
+        """
+        Give up on a job of a batch that couldn't be prepared, leaving the
+        outputs of the others untouched
+        """
+        job.finished = True
+        self._failedJobs += 1
+        if job.resultSink is not None:
+            job.resultSink.abort()
+        if job.monitor is not None:
+            job.monitor.setStage("failed")
+        logging.error("Could not analyze '{0}', skipping it: {1}".format(job.inputFn, error))
 
+    def _finishJob(self, job):
+        job.finished = True
+        if job.resultSink is not None:
+            job.resultSink.close()
+        if job.shardIndex is not None:
+            job.shardIndex.close()
+        if job.monitor is not None:
+            job.monitor.setStage("done")
+        if job.failures:
+            logging.warn("{0} locus/barcode pair(s) could not be phased, see '{1}'".format(job.failures,
+                         job.resultWriter.outputPath("loci_analysis_failures.csv")))
+
+    def _phasingUnits(self, job, start=0, barcodes=None, inputFn=None):
+        """
+        Generate the LAA runs to perform for a job, in the order their results
+        are written, by default of all of its barcodes and from its input
+        """
+        index = start
+        barcodes = job.barcodes if barcodes is None else barcodes
+        for barcode in (barcodes if barcodes else [None]):
             if barcode is not None:
-                logging.info("Phasing locus '{0}' for barcode '{1}'".format(locus, barcode))
+                logging.info("Processing loci for barcode '{0}'".format(barcode))
             else:
-                logging.info("Phasing locus '{0}'".format(locus))
-
-            rngSeed            = self._getOption( locus, "rngSeed" )
-            minBarcodeScore    = self._getOption( locus, "minBarcodeScore" )
-            minLength          = self._getOption( locus, "minLength" )
-            maxLength          = self._getOption( locus, "maxLength" )
-            minReadScore       = self._getOption( locus, "minReadScore" )
-            minSnr             = self._getOption( locus, "minSnr" )
-            maxReads           = self._getOption( locus, "maxReads" )
-            maxClusteringReads = self._getOption( locus, "maxClusteringReads" )
-            skipRate           = self._getOption( locus, "skipRate" )
-
-            with LaaPhaser(barcode, self._inputFn, locus, nproc=options.nproc,
-                           whitelist=locusWl, rngSeed=rngSeed, minLength=minLength,
-                           maxLength=maxLength, minReadScore=minReadScore,
-                           minSnr=minSnr, maxReads=maxReads, skipRate=skipRate,
-                           maxClusteringReads=maxClusteringReads,
-                           minBarcodeScore=minBarcodeScore) as phaser:
-                for result in phaser:
-                    self._resultWriter.writeResult( result )
+                logging.info("Processing loci for full dataset")
+
+            for locus, locusWl in self._loci( job ):
+                if options.doLoci is not None and locus not in options.doLoci:
+                    logging.debug("Locus '{0}' not specified by the user, skipping".format(locus))
+                    continue
+                if options.ignoreLoci is not None and locus in options.ignoreLoci:
+                    logging.debug("User elected to ignore Locus '{0}', skipping".format(locus))
+                    continue
+
+                yield PhasingUnit(index, barcode, locus, locusWl, self._getPhasingOptions( locus, job.config ),
+                                  nReads=self._readCount( job, barcode, locus ),
+                                  length=self._ampliconLength( locus ),
+                                  nproc=options.nproc, job=job, inputFn=inputFn)
+                index += 1
+
+    def _loci(self, job):
+        if job.whitelistDb is not None:
+            return job.whitelistDb.items()
+        # If we haven't binned the reads yet, we only know which loci exist
+        loci = set(self._refDb.keys())
+        if options.combineLoci:
+            loci.update( options.combineLoci.keys() )
+        return [(locus, None) for locus in sorted(loci)]
+
+    def _readCount(self, job, barcode, locus):
+        if job.whitelistDb is not None:
+            return job.whitelistDb.readCount( barcode, locus )
+        # Without binning, assume each barcode's reads are split evenly between loci
+        return job.barcodeCounts.get(barcode, 0) // max(1, len(list(self._refDb.keys())))
+
+    def _ampliconLength(self, locus):
+        if locus in self._refDb.keys():
+            return self._refDb.referenceLength( locus )
+        # Combined loci are as long as their longest constituent
+        loci = options.combineLoci.get(locus, []) if options.combineLoci else []
+        lengths = [self._refDb.referenceLength(l) for l in loci if l in self._refDb.keys()]
+        return max(lengths) if lengths else options.minLength
+
+    def _writeUnit(self, unit):
+        """
+        Hand a finished unit's results (or failure) over to its job's
+        ResultSink, from whichever worker thread ran it
+        """
+        resultSink = unit.job.resultSink
+        if unit.error is not None:
+            resultSink.writeFailure( unit.index, unit.barcode, unit.locus, unit.attempts, unit.kwargs,
+                                     unit.error, name=unit.name )
+        else:
+            resultSink.writeResults( unit.index, unit.barcode, unit.results, name=unit.name )
+
+    def _unitFinished(self, unit):
+        if self._sweepReport is not None:
+            self._sweepReport.addUnit( unit.job.config.label, unit )
+        if unit.job.shardIndex is not None:
+            unit.job.shardIndex.writeUnit( unit )
+        if unit.error is not None:
+            self._failures += 1
+            unit.job.failures += 1
+            if options.failFast:
+                msg = "Could not phase {0} after {1} attempt(s)".format(unit.name, unit.attempts)
+                logging.error( msg )
+                raise RuntimeError( msg )
+
+    def _getPhasingOptions( self, locus, config=None ):
+        kwargs = {}
+        for opt in PHASING_OPTIONS:
+            kwargs[opt] = self._getOption( locus, opt )
+        # A sweep's values take precedence over any given on the command line
+        overrides = config.overrides if config is not None else {}
+        for opt, value in overrides.iteritems():
+            if not isinstance(value, dict):
+                kwargs[opt] = value
+            elif locus in value:
+                kwargs[opt] = value[locus]
+        return kwargs
+
+    def _degradeOptions( self, kwargs ):
+        """
+        Scale down the number of reads LAA is allowed to use, since the
+        most common cause of failure is running out of memory or time
+        while clustering a large or messy bin
+        """
+        degraded = dict(kwargs)
+        maxReads           = int(kwargs["maxReads"])
+        maxClusteringReads = int(kwargs["maxClusteringReads"])
+        degraded["maxReads"]           = max(1, int(maxReads * options.retryScale))
+        degraded["maxClusteringReads"] = max(1, min(degraded["maxReads"],
+                                                    int(maxClusteringReads * options.retryScale)))
+        return degraded
+
+    def _phaseUnit( self, unit ):
+        """
+        Run LAA on a single locus, retrying with degraded settings if it
+        fails.  Loci that fail every attempt are recorded as such rather
+        than raising, so that one pathological bin doesn't take down an
+        otherwise good run
+        """
+        logging.info("Phasing {0}".format(unit.name))
+        with profiler.stage("phase", unit=unit.name, reads=unit.nReads) as stage:
+            self._phaseUnitAttempts( unit )
+            stage.count("attempts", unit.attempts)
+        self._writeUnit( unit )
+        return unit
+
+    def _phaseUnitAttempts( self, unit ):
+        attempts = options.maxRetries + 1
+        for attempt in range(1, attempts + 1):
+            unit.attempts = attempt
+            # Keyed by the options of this attempt, so the results of a degraded
+            #  retry are never mistaken for those of the full settings
+            cacheKey = None
+            if self._cache is not None:
+                cacheKey = self._cache.key( unit.inputFn, unit.barcode, unit.locus, unit.whitelist, unit.kwargs )
+            try:
+                with LaaPhaser(unit.barcode, unit.inputFn, unit.locus, nproc=unit.nproc,
+                               onStart=unit.started, scratch=self._scratch, cache=self._cache,
+                               cacheKey=cacheKey, whitelist=unit.whitelist, **unit.kwargs) as phaser:
+                    unit.results = list(phaser)
+                    unit.process = phaser.process
+                    unit.error   = None
+                    return unit
+            except Exception as error:
+                unit.error = error
+                logging.warn("Attempt {0} of {1} failed for {2}: {3}".format(attempt, attempts, unit.name, error))
+                if attempt < attempts:
+                    unit.kwargs = self._degradeOptions( unit.kwargs )
+                    logging.info("Retrying {0} with maxReads={1} and maxClusteringReads={2}".format(
+                        unit.name, unit.kwargs["maxReads"], unit.kwargs["maxClusteringReads"]))
 
+        logging.error("Giving up on {0} after {1} attempt(s)".format(unit.name, unit.attempts))
+        return unit
 
     def _openDataSet( self, fn ):
         try:
@@ -131,10 +622,12 @@ class LociAnalysis(object):
 
     @property
     def barcodes(self):
-        return self._barcodes
+        return self._jobs[0].barcodes if self._jobs else None
 
 
 def main():
+    if sys.argv[1:2] == ["merge"]:
+        return mergeMain( sys.argv[2:] )
     LociAnalysis().main()
 
 if __name__ == "__main__":
@@ -0,0 +1,58 @@
+
+import re
+import logging
+import os.path as op
+
+from collections import namedtuple
+
+ManifestEntry = namedtuple("ManifestEntry", ["inputFilename", "outputDirectory"])
+
+def _defaultOutput( inputFn, outputRoot ):
+    # e.g. 'movie.subreadset.xml' or 'movie.subreads.bam' -> 'movie'
+    name = op.basename( inputFn )
+    name = re.sub(r"\.(subreadset\.xml|subreads\.bam|xml|bam)$", "", name)
+    return op.join( outputRoot, name )
+
+def readManifest( filename, outputRoot ):
+    """
+    Read a batch manifest: one input BAM or DataSet per line, optionally
+    followed by a tab and its output directory.  Blank lines and lines
+    starting with '#' are ignored, relative paths are relative to the
+    manifest, and inputs without an output directory are written to a
+    sub-directory of 'outputRoot' named after the input
+    """
+    root = op.dirname( op.abspath( filename ) )
+    entries = []
+    with open( filename ) as handle:
+        for lineNum, line in enumerate(handle, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split('\t')
+            if len(parts) > 2:
+                msg = "Invalid manifest line {0}, expected 'Input<TAB>OutputDirectory': {1}".format(lineNum, line)
+                logging.error( msg )
+                raise RuntimeError( msg )
+
+            inputFn = op.join( root, op.expanduser(parts[0].strip()) )
+            if not op.isfile( inputFn ):
+                msg = "Input file from manifest line {0} not found: {1}".format(lineNum, inputFn)
+                logging.error( msg )
+                raise RuntimeError( msg )
+            if len(parts) == 2 and parts[1].strip():
+                outputDir = op.join( root, op.expanduser(parts[1].strip()) )
+            else:
+                outputDir = _defaultOutput( inputFn, outputRoot )
+            entries.append( ManifestEntry(op.abspath(inputFn), op.abspath(outputDir)) )
+
+    outputs = [e.outputDirectory for e in entries]
+    duplicates = sorted(set(o for o in outputs if outputs.count(o) > 1))
+    if duplicates:
+        msg = "Manifest entries share output directories: {0}".format(", ".join(duplicates))
+        logging.error( msg )
+        raise RuntimeError( msg )
+    if not entries:
+        msg = "Manifest lists no input files: {0}".format(filename)
+        logging.error( msg )
+        raise RuntimeError( msg )
+    return entries
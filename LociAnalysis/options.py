@@ -36,16 +36,28 @@ import os
 import os.path as op
 import sys
 
+from LociAnalysis.affinity import parseCpuList
+from LociAnalysis.results.result_writer import SUBREAD_FORMATS
+from LociAnalysis.whitelistdb.aligners import ALIGNERS, PARSERS
+
 PRESETS = ["classI", "fiveLoci", "gendx"]
 
 options = argparse.Namespace()
 
-def parseOptions():
+def parseOptions(args=None, namespace=None):
     """
-    Parse and sanity-check the options
+    Parse and sanity-check the options, by default from the command-line
+    into the module-level 'options'.  If another namespace is given, e.g.
+    for a job submitted to the service, invalid options raise a ValueError
+    rather than exiting
     """
     desc = "Run Long Amplicon Analysis v2 indepedently on different loci and combine the results"
     parser = argparse.ArgumentParser(description=desc, add_help=True)
+    opts = options if namespace is None else namespace
+    if namespace is not None:
+        def raiseError(message):
+            raise ValueError(message)
+        parser.error = raiseError
 
     def canonicalizedFilePath(path):
         return op.abspath(op.expanduser(path))
@@ -120,6 +132,161 @@ def parseOptions():
         default=1,
         help="The number of processors to be used")
 
+    batch = parser.add_argument_group("Batch Options",
+        "In batch mode the input is a manifest of datasets to analyze, one "
+        "per line, each optionally followed by a tab and its output "
+        "directory (by default a sub-directory of the output folder named "
+        "after the dataset).  The references are indexed once, and the LAA "
+        "runs for every dataset share the same concurrency and memory limits.")
+    batch.add_argument(
+        "--batch",
+        dest="batch",
+        action="store_true",
+        help="Treat the input as a manifest of datasets")
+
+    sweep = parser.add_argument_group("Sweep Options",
+        "A parameter sweep runs LAA with several configurations of its options "
+        "on one input, binning the reads only once.  The sweep is a JSON file, "
+        "either an object mapping options to lists of values to try in every "
+        "combination, e.g. {\"maxReads\": [500, 1000], \"skipRate\": [0.5, 1.0]}, "
+        "or a list of configurations, each an object of option values with an "
+        "optional \"label\".  Values may also be objects of per-locus values, "
+        "e.g. {\"A\": 800}.  The results of each configuration are written to a "
+        "sub-directory of the output folder named after its label, and compared "
+        "in 'loci_analysis_sweep.csv'.")
+    sweep.add_argument(
+        "--sweep",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="JSON file of the option configurations to sweep. Default = None")
+
+    output = parser.add_argument_group("Output Options")
+    output.add_argument(
+        "--compress",
+        dest="compress",
+        action="store_true",
+        help="Write the FASTQ and CSV outputs BGZF-compressed, with a '.gz' suffix")
+    output.add_argument(
+        "--compressThreads",
+        type=int,
+        metavar="INT",
+        default=4,
+        help="Number of threads to compress outputs on. Default = 4")
+    output.add_argument(
+        "--subreadFormat",
+        choices=SUBREAD_FORMATS,
+        default="dense",
+        help="Format of the subread weights: a dense CSV matrix, a long CSV of the non-zero "
+             "(subread, result, weight) entries, or a memory-mappable binary sparse matrix. Default = dense")
+    output.add_argument(
+        "--barcodeOutputs",
+        dest="barcodeOutputs",
+        action="store_true",
+        help="Also write each barcode's outputs to 'barcodes/<barcode>' as soon as all of its loci are "
+             "phased, marked complete by a 'loci_analysis.done' file")
+
+    database = parser.add_argument_group("Results Database Options",
+        "Results can also be appended to an SQLite database shared between "
+        "runs, with tables of runs, results, failures and optionally subread "
+        "weights, indexed by run, barcode and locus.")
+    database.add_argument(
+        "--resultDb",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="SQLite database to add the results of this run to")
+    database.add_argument(
+        "--resultDbSubreads",
+        dest="resultDbSubreads",
+        action="store_true",
+        help="Also add the subread weights of each result to the database")
+    database.add_argument(
+        "--runName",
+        metavar="STRING",
+        help="Name of this run in the database, ignored in batch mode. Default = the input's filename")
+
+    sharding = parser.add_argument_group("Sharding Options",
+        "A run can be split between several machines by first planning it "
+        "with --shards and --writeShards, then running each shard "
+        "specification with --shardSpec and its own output directory, and "
+        "finally combining the shards with 'LociAnalysis merge OUTPUT SHARD...'.")
+    sharding.add_argument(
+        "--shards",
+        type=int,
+        metavar="INT",
+        default=1,
+        help="Number of shards to plan. Default = 1")
+    sharding.add_argument(
+        "--writeShards",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="Bin the reads, then write a specification for each shard to this directory and exit")
+    sharding.add_argument(
+        "--shardSpec",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="Run only the LAA runs of this shard specification")
+
+    watch = parser.add_argument_group("Watch Options",
+        "In watch mode the input is the directory of a sequencing run still "
+        "in progress.  Each BAM matching --watchPattern is binned as soon as "
+        "its .pbi index has been written, and each barcode is phased once all "
+        "of its reads have been binned: when the run is finished, or with "
+        "--watchByBarcode as soon as the one BAM holding it has been binned.  "
+        "The run is finished once --watchChunks BAMs have been found, once "
+        "the --watchDone file exists, or after --watchIdle seconds without a "
+        "new BAM.")
+    watch.add_argument(
+        "--watch",
+        dest="watch",
+        action="store_true",
+        help="Treat the input as the directory of a run in progress")
+    watch.add_argument(
+        "--watchPattern",
+        metavar="STRING",
+        default="*.subreads.bam",
+        help="Filename pattern of the BAMs to bin. Default = *.subreads.bam")
+    watch.add_argument(
+        "--watchDone",
+        metavar="STRING",
+        help="File, relative to the run directory, whose existence means the run is finished")
+    watch.add_argument(
+        "--watchChunks",
+        type=int,
+        metavar="INT",
+        help="Number of BAMs the run will write")
+    watch.add_argument(
+        "--watchIdle",
+        type=int,
+        metavar="INT",
+        default=3600,
+        help="Seconds without a new BAM after which the run is assumed finished, 0 to wait forever. Default = 3600")
+    watch.add_argument(
+        "--watchPoll",
+        type=int,
+        metavar="INT",
+        default=60,
+        help="Seconds between scans of the run directory. Default = 60")
+    watch.add_argument(
+        "--watchByBarcode",
+        dest="watchByBarcode",
+        action="store_true",
+        help="Each barcode's reads are all in one BAM, e.g. demultiplexed data, so phase each "
+             "barcode as soon as its BAM is binned")
+
+    binning = parser.add_argument_group("Binning Options",
+        "Reads are binned by the locus whose reference they align to best. "
+        "BLASR can write m1, m4 or SAM alignments and minimap2 PAF or SAM, "
+        "the first of each being its default.")
+    binning.add_argument(
+        "--aligner",
+        choices=sorted(ALIGNERS),
+        default="blasr",
+        help="Aligner used to bin reads by locus. Default = blasr")
+    binning.add_argument(
+        "--alignmentFormat",
+        choices=sorted(PARSERS),
+        help="Format of the alignments to write and parse. Default = the aligner's default")
+
     barcoding = parser.add_argument_group("Barcode Options")
     barcoding.add_argument(
         "--doBc",
@@ -232,6 +399,163 @@ def parseOptions():
         type=parseDict,
         help="Per-locus minimum SNR of input reads. Default = 3.75")
 
+    failures = parser.add_argument_group("Failure Handling Options",
+        "Loci that fail to phase are retried with progressively fewer reads, "
+        "and reported in 'loci_analysis_failures.csv' if they still fail.")
+    failures.add_argument(
+        "--maxRetries",
+        type=int,
+        metavar="INT",
+        default=1,
+        help="Number of times to retry a failed locus before giving up on it. Default = 1")
+    failures.add_argument(
+        "--retryScale",
+        type=float,
+        metavar="FLOAT",
+        default=0.5,
+        help="Factor applied to maxReads and maxClusteringReads on each retry. Default = 0.5")
+    failures.add_argument(
+        "--failFast",
+        dest="failFast",
+        action="store_true",
+        help="Abort the whole run on the first locus that cannot be phased")
+
+    concurrency = parser.add_argument_group("Concurrency Options",
+        "Loci are phased by concurrent LAA processes, each using --nproc "
+        "processors.  New processes are only started while the estimated "
+        "memory of those running stays under --memoryLimit.")
+    concurrency.add_argument(
+        "--concurrentLoci",
+        type=int,
+        metavar="INT",
+        default=1,
+        help="Maximum number of LAA processes to run at once. Default = 1")
+    concurrency.add_argument(
+        "--memoryLimit",
+        type=int,
+        metavar="INT",
+        default=0,
+        help="Memory ceiling in MB for concurrent LAA processes, set <1 to disable. Default = 0")
+    concurrency.add_argument(
+        "--pinCpus",
+        dest="pinCpus",
+        action="store_true",
+        help="Pin each LAA, BLASR or minimap2 process to --nproc CPUs of its own, from one NUMA node where possible")
+    concurrency.add_argument(
+        "--cpuSet",
+        metavar="STRING",
+        type=parseCpuList,
+        help="CPUs to pin processes to with --pinCpus, e.g. '0-15,32-47'. Default = every CPU we may run on")
+    concurrency.add_argument(
+        "--memoryModel",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="JSON file of past LAA memory usage, used to calibrate estimates and updated "
+             "at the end of the run. Default = None")
+
+    scratch = parser.add_argument_group("Scratch Options",
+        "Each LAA run works in a temporary directory, and the alignments of "
+        "the input are kept for reuse next to it.  Both can be moved to fast "
+        "local storage, such as tmpfs or an NVMe disk.")
+    scratch.add_argument(
+        "--scratchDir",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="Directory for LAA workspaces and alignments. Default = the system temp directory, with alignments next to the input")
+    scratch.add_argument(
+        "--scratchMinFree",
+        type=int,
+        metavar="INT",
+        default=1024,
+        help="Free space (MB) the scratch directory must have to start another LAA run. Default = 1024")
+    scratch.add_argument(
+        "--keepFailedScratch",
+        dest="keepFailedScratch",
+        action="store_true",
+        help="Keep the workspaces of failed LAA runs for debugging")
+
+    caching = parser.add_argument_group("Caching Options",
+        "The results of each LAA run can be cached between runs, keyed by its "
+        "reads, barcode, locus, effective options and the version of LAA, so "
+        "that re-running with a few changed settings only repeats the LAA runs "
+        "they affect.")
+    caching.add_argument(
+        "--phasingCache",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="Directory of cached LAA results to reuse and add to. Default = None")
+
+    planning = parser.add_argument_group("Planning Options",
+        "The wall time, CPU time and memory of every LAA run are recorded in a "
+        "local history, which is used to predict the cost of future runs and "
+        "start the longest ones first.")
+    planning.add_argument(
+        "--historyFile",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        default=op.join("~", ".LociAnalysis", "history.jsonl"),
+        help="File of past LAA runtimes. Default = ~/.LociAnalysis/history.jsonl")
+    planning.add_argument(
+        "--noHistory",
+        dest="noHistory",
+        action="store_true",
+        help="Neither read nor update the runtime history")
+    planning.add_argument(
+        "--dryRun",
+        dest="dryRun",
+        action="store_true",
+        help="Print the planned LAA runs and their estimated runtime without running them")
+
+    profiling = parser.add_argument_group("Profiling Options")
+    profiling.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Write the timing, CPU, memory and I/O of each stage to 'loci_analysis_profile.json'")
+    profiling.add_argument(
+        "--cProfile",
+        dest="cProfile",
+        action="store_true",
+        help="Write a cProfile dump of the Python code to 'loci_analysis_profile.pstats'")
+    profiling.add_argument(
+        "--trace",
+        dest="trace",
+        action="store_true",
+        help="Write a timeline of every stage and external process to 'loci_analysis_trace.json', "
+             "viewable in chrome://tracing or Perfetto")
+
+    progress = parser.add_argument_group("Progress Options",
+        "While running, the number of LAA runs pending, running and finished, "
+        "the number of reads binned and an estimated time to completion are "
+        "kept in a status file in the Prometheus textfile format, suitable "
+        "for the node exporter's textfile collector.")
+    progress.add_argument(
+        "--statusFile",
+        metavar="STRING",
+        type=canonicalizedFilePath,
+        help="Status file to update, ignored in batch mode. Default = 'loci_analysis_status.prom' in the output directory")
+    progress.add_argument(
+        "--noStatusFile",
+        dest="noStatusFile",
+        action="store_true",
+        help="Don't write a status file")
+
+    tools = parser.add_argument_group("External Tool Options",
+        "Limits on the external tools (laa, blasr, minimap2, bam2fasta, sawriter "
+        "and dataset) are specified in the form 'Tool:Seconds', e.g. "
+        "laa:7200,blasr:36000. "
+        "A tool that exceeds a limit is killed and treated as having failed.")
+    tools.add_argument(
+        "--toolTimeouts",
+        metavar="STRING",
+        type=parseDict,
+        help="Per-tool maximum wall-clock time. Default = None")
+    tools.add_argument(
+        "--stallTimeouts",
+        metavar="STRING",
+        type=parseDict,
+        help="Per-tool maximum time without writing any output. Default = None")
+
     presets = parser.add_argument_group("Preset Design Options",
         "Though LociAnalysis is designed to support any arbitrary "
         "combination of amplicon targets and sizes, a couple of presets "
@@ -252,17 +576,70 @@ def parseOptions():
         action="store_true",
         help="Set defaults for the GenDx NGSgo kit, containing A,B,C,DQA,DQB,DPA,DPB,DRB1 and DRB345")
 
-    parser.parse_args(namespace=options)
+    parser.parse_args(args, namespace=opts)
 
     # Check that we don't have multiple competing presets
-    optDict = vars(options)
+    optDict = vars(opts)
     for i in range(len(PRESETS)-1):
         fst = PRESETS[i]
         for snd in PRESETS[i+1:]:
             if optDict[fst] and optDict[snd]:
                 parser.error("Contradictory Options: {0} and {1} cannot both be True".format(fst, snd))
 
+    # Check that retries can actually make progress
+    if opts.maxRetries < 0:
+        parser.error("Invalid Option: maxRetries must be non-negative")
+    if not 0.0 < opts.retryScale <= 1.0:
+        parser.error("Invalid Option: retryScale must be in the range (0, 1]")
+
+    # Timeouts are in seconds, and zero disables a tool's limit
+    for opt in ("toolTimeouts", "stallTimeouts"):
+        for tool, seconds in sorted((optDict[opt] or {}).items()):
+            try:
+                valid = float(seconds) >= 0
+            except ValueError:
+                valid = False
+            if not valid:
+                parser.error("Invalid Option: {0} must be a non-negative number of seconds, not '{1}:{2}'".format(opt, tool, seconds))
+
+    if opts.concurrentLoci < 1:
+        parser.error("Invalid Option: concurrentLoci must be at least 1")
+
+    if opts.cpuSet and not opts.pinCpus:
+        parser.error("Invalid Option: cpuSet is only used with pinCpus")
+
+    if opts.compressThreads < 1:
+        parser.error("Invalid Option: compressThreads must be at least 1")
+
+    if opts.alignmentFormat and opts.alignmentFormat not in ALIGNERS[opts.aligner].formats:
+        parser.error("Contradictory Options: {0} cannot write {1} alignments".format(opts.aligner, opts.alignmentFormat))
+
+    if opts.shards < 1:
+        parser.error("Invalid Option: shards must be at least 1")
+    if opts.batch and (opts.writeShards or opts.shardSpec):
+        parser.error("Contradictory Options: batch mode cannot be sharded")
+    if opts.barcodeOutputs and opts.shardSpec:
+        parser.error("Contradictory Options: a shard may hold only some of a barcode's loci, so cannot write barcodeOutputs")
+    if opts.writeShards and opts.shardSpec:
+        parser.error("Contradictory Options: writeShards and shardSpec cannot both be set")
+
+    if opts.sweep and (opts.batch or opts.watch or opts.writeShards or opts.shardSpec):
+        parser.error("Contradictory Options: a sweep cannot be combined with batch, watch or sharded runs")
+    if opts.sweep:
+        checkInputFile(opts.sweep)
+
+    if opts.watch and (opts.batch or opts.writeShards or opts.shardSpec or opts.dryRun):
+        parser.error("Contradictory Options: watch mode cannot be combined with batch, sharded or dry runs")
+    if opts.watch and not (opts.watchDone or opts.watchChunks or opts.watchIdle):
+        parser.error("Invalid Option: watch mode needs watchDone, watchChunks or watchIdle to know when to stop")
+    if opts.watchPoll < 1:
+        parser.error("Invalid Option: watchPoll must be at least 1")
+
     # Validate expected inputs and output directory
-    checkInputDirectory(options.referenceDirectory)
-    checkInputFile(options.inputFilename)
-    checkOutputDirectory(options.outputDirectory)
+    checkInputDirectory(opts.referenceDirectory)
+    if opts.watch:
+        checkInputDirectory(opts.inputFilename)
+    else:
+        checkInputFile(opts.inputFilename)
+    checkOutputDirectory(opts.outputDirectory)
+    return opts
@@ -1 +1,2 @@
 from .laaphaser import LaaPhaser
+from .cache     import PhasingCache
@@ -0,0 +1,83 @@
+
+import os
+import gzip
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+import os.path as op
+
+# Bump to invalidate every entry written by an older LociAnalysis
+CACHE_VERSION = 1
+
+class PhasingCache(object):
+    """
+    An on-disk cache of LAA's outputs, shared between runs, so that a
+    rerun only repeats the LAA runs whose inputs have changed.  Entries
+    are keyed by everything that determines what LAA does: the reads it
+    is given (the input's path, size and modification time, and the
+    contents of the whitelist), the barcode and locus, the LAA options of
+    the attempt and the version of LAA
+    """
+
+    def __init__(self, directory, laaVersion):
+        self.directory   = directory
+        self._laaVersion = laaVersion
+        self._lock       = threading.Lock()
+        self.hits        = 0
+        self.misses      = 0
+        if not op.isdir( directory ):
+            try:
+                os.makedirs( directory )
+            except OSError:
+                msg = "Could not create phasing cache directory: {0}".format(directory)
+                logging.error( msg )
+                raise RuntimeError( msg )
+
+    def key( self, inputFn, barcode, locus, whitelist, kwargs ):
+        digest = hashlib.sha1()
+        stat = os.stat( inputFn )
+        digest.update( json.dumps([CACHE_VERSION, self._laaVersion, op.realpath( inputFn ), stat.st_size,
+                                   stat.st_mtime, barcode, locus,
+                                   sorted((k, str(v)) for k, v in kwargs.iteritems())]) )
+        if whitelist is not None:
+            with open( whitelist, 'rb' ) as handle:
+                for chunk in iter(lambda : handle.read( 1 << 20 ), ""):
+                    digest.update( chunk )
+        return digest.hexdigest()
+
+    def _filename( self, key ):
+        return op.join( self.directory, key[:2], key + ".json.gz" )
+
+    def load( self, key ):
+        """
+        The (sequences, summaries, subreads) LAA output stored under 'key',
+        or None if there isn't one
+        """
+        filename = self._filename( key )
+        try:
+            with gzip.open( filename ) as handle:
+                entry = json.load( handle )
+        except (IOError, OSError, ValueError, EOFError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return entry["sequences"], entry["summaries"], entry["subreads"]
+
+    def store( self, key, sequences, summaries, subreads ):
+        filename  = self._filename( key )
+        directory = op.dirname( filename )
+        try:
+            if not op.isdir( directory ):
+                os.makedirs( directory )
+            handle, tmpName = tempfile.mkstemp(prefix=".entry.", dir=directory)
+            with os.fdopen(handle, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb') as tmp:
+                    json.dump({"sequences": sequences, "summaries": summaries, "subreads": subreads}, tmp)
+            os.rename( tmpName, filename )
+        except (IOError, OSError) as error:
+            # A cache we can't write to only costs us time
+            logging.warn("Could not add to the phasing cache '{0}': {1}".format(self.directory, error))
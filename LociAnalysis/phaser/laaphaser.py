@@ -5,29 +5,35 @@ import csv
 import logging
 import os
 import os.path
+import sys
 
 from collections import namedtuple
-from subprocess import Popen, PIPE
-from shutil import rmtree
-from tempfile import mkdtemp
 
-from pbcore.io import FastqReader
-
-from LociAnalysis.results import PhasingResult
+from LociAnalysis.fastq import FastqRecord, readFastq
+from LociAnalysis.results import PhasingResult, ResultSummary
 from LociAnalysis.which import which
-from LociAnalysis.version import SMRT_ANALYSIS_VERSION
+from LociAnalysis.process import runProcess
+from LociAnalysis.profiling import profiler
+from LociAnalysis.scratch import ScratchManager
+from LociAnalysis.version import getSmrtAnalysisVersion
 
 ILLEGAL_OPTS = set(["--doBc", "--resultFile", "--reportsFile", "--subreadsReportPrefix", "--noChimeraFilter"])
 
 class LaaPhaser(object):
 
-    def __init__(self, barcode, dataset, locus=None, nproc=1, **kwargs):
-        self._barcode = barcode
-        self._dataset = dataset
-        self._locus   = locus
-        self._nproc   = nproc
+    def __init__(self, barcode, dataset, locus=None, nproc=1, onStart=None, scratch=None, cache=None,
+                 cacheKey=None, **kwargs):
+        self._barcode  = barcode
+        self._dataset  = dataset
+        self._locus    = locus
+        self._nproc    = nproc
+        self._onStart  = onStart
+        self._scratch  = scratch or ScratchManager()
+        self._cache    = cache if cacheKey is not None else None
+        self._cacheKey = cacheKey
         self._tmpdir  = None
         self._records = None
+        self._process = None
         self._kwargs  = self._validateKwargs(kwargs)
 
     def _validateKwargs( self, kwargs ):
@@ -35,7 +41,7 @@ class LaaPhaser(object):
         if invalidOpts:
             raise RuntimeError("invalid options for laa: '{0}'".format(" ".join(invalidOpts)))
         # Filter out options not present in older version
-        if SMRT_ANALYSIS_VERSION in ["3.1.0", "3.1.1"]:
+        if getSmrtAnalysisVersion() in ["3.1.0", "3.1.1"]:
             del kwargs["skipRate"]
         return kwargs
 
@@ -59,19 +65,19 @@ class LaaPhaser(object):
             crossover    = hdr.index("CrossoverPosition")
             for row in rdr:
                 recId = row[1]
-                data  = {"cluster":      row[cluster],
-                         "phase":        row[phase],
-                         "coverage":     row[coverage],
-                         "readQuality":  row[readQuality],
-                         "didConverge":  row[didConverge],
-                         "isNoise":      row[isNoise],
-                         "isDup":        row[isDup] if isDup >= 0 else "N/A",
-                         "dupOf":        row[dupOf] if dupOf >= 0 else "N/A",
-                         "isChimera":    row[isChimera],
-                         "chimeraScore": row[chimeraScore],
-                         "parentA":      row[parentA],
-                         "parentB":      row[parentB],
-                         "crossover":    row[crossover]}
+                data  = ResultSummary(cluster=      row[cluster],
+                                      phase=        row[phase],
+                                      coverage=     row[coverage],
+                                      readQuality=  row[readQuality],
+                                      didConverge=  row[didConverge],
+                                      isNoise=      row[isNoise],
+                                      isDup=        row[isDup] if isDup >= 0 else "N/A",
+                                      dupOf=        row[dupOf] if dupOf >= 0 else "N/A",
+                                      isChimera=    row[isChimera],
+                                      chimeraScore= row[chimeraScore],
+                                      parentA=      row[parentA],
+                                      parentB=      row[parentB],
+                                      crossover=    row[crossover])
                 recData[recId] = data
         return recData
 
@@ -113,7 +119,7 @@ class LaaPhaser(object):
         """
         records = []
         for fname, isJunk in (("amplicon_analysis.fastq", False), ("amplicon_analysis_chimeras_noise.fastq", True)):
-            for record in FastqReader(os.path.join(self._tmpdir, fname)):
+            for record in readFastq(os.path.join(self._tmpdir, fname)):
                 records.append( (record, isJunk) )
         return records
 
@@ -126,36 +132,81 @@ class LaaPhaser(object):
             records.append(PhasingResult(self._barcode, self._locus, seqRecord, summary, subreads, isJunk))
         return records
 
+    def _storeResults( self, sequences, summaryData, subreadData ):
+        self._cache.store( self._cacheKey,
+                           [[record.header, record.sequence, record.qualityString, isJunk]
+                            for record, isJunk in sequences],
+                           dict((recId, list(summary)) for recId, summary in summaryData.iteritems()),
+                           subreadData )
+
+    def _restoreResults( self, sequences, summaries, subreads ):
+        # JSON gives us back unicode, where LAA's outputs gave us str
+        sequences   = [(FastqRecord(str(header), str(sequence), str(quality)), isJunk)
+                       for header, sequence, quality, isJunk in sequences]
+        summaryData = dict((str(recId), ResultSummary(*[str(field) for field in summary]))
+                           for recId, summary in summaries.iteritems())
+        subreadData = dict((str(recId), dict((str(subread), weight) for subread, weight in weights.iteritems()))
+                           for recId, weights in subreads.iteritems())
+        return self._formatResults( sequences, summaryData, subreadData )
+
     def __enter__(self):
-        self._tmpdir = mkdtemp()
+        unit = "{0}:{1}".format(self._locus, self._barcode)
+        if self._cache is not None:
+            entry = self._cache.load( self._cacheKey )
+            if entry is not None:
+                with profiler.stage("laa.restore", unit=unit) as stage:
+                    self._results = self._restoreResults( *entry )
+                    stage.count("results", len(self._results))
+                logging.debug("Restored {0} result(s) for locus '{1}' from the phasing cache".format(
+                              len(self._results), self._locus))
+                return self
+
         laa = which("laa")
         if not laa:
             raise RuntimeError("laa not on PATH")
+        self._tmpdir = self._scratch.create( prefix="laa.{0}.".format(self._locus) )
         cmd = [laa, "-n", str(self._nproc)]
         if self._barcode is not None:
             cmd.extend([ "--doBc", self._barcode ])
         for key, value in self._kwargs.iteritems():
             cmd.extend([ "--{0}".format(key), str(value) ])
         cmd.append(self._dataset)
-        logging.trace("running `{0}` in '{1}'".format(" ".join(cmd), self._tmpdir))
-        proc = Popen(cmd, cwd=self._tmpdir, stderr=PIPE, close_fds=True)
-        proc.wait()
-        if proc.returncode != 0:
-            raise RuntimeError("`{0}` failed with exit code {1}:\n{2}".format(' '.join(cmd), proc.returncode, proc.stderr.read()))
-
-        # Parse the various expected output files, then combine them into PhasingResults
-        sequences     = self._parseSequences()
-        summaryData   = self._parseSummaryCsv()
-        subreadData   = self._parseSubreadCsv()
-        self._results = self._formatResults( sequences, summaryData, subreadData)
+        try:
+            with profiler.stage("laa.run", unit=unit):
+                self._process = runProcess(cmd, tool="laa", cwd=self._tmpdir, check=True,
+                                           onStart=self._onStart, unit=unit, nproc=self._nproc)
+
+            # Parse the various expected output files, then combine them into PhasingResults
+            with profiler.stage("laa.parse", unit=unit) as stage:
+                sequences     = self._parseSequences()
+                summaryData   = self._parseSummaryCsv()
+                subreadData   = self._parseSubreadCsv()
+                self._results = self._formatResults( sequences, summaryData, subreadData)
+                stage.count("results", len(self._results))
+            if self._cache is not None:
+                with profiler.stage("laa.store", unit=unit):
+                    self._storeResults( sequences, summaryData, subreadData )
+        except:
+            # __exit__ is never called if we fail here, so clean up after ourselves
+            excInfo = sys.exc_info()
+            self.__exit__( *excInfo )
+            raise excInfo[0], excInfo[1], excInfo[2]
 
         return self
 
     def __exit__(self, typ, val, traceback):
-        rmtree(self._tmpdir)
+        if self._tmpdir is not None:
+            self._scratch.release( self._tmpdir, failed=typ is not None )
         self._tmpdir = None
         self._records = None
 
+    @property
+    def process(self):
+        """
+        The ProcessResult of the LAA run, with its timing and resource usage
+        """
+        return self._process
+
     def __iter__(self):
         if self._results is None:
             raise RuntimeError("LaaPhaser is a context object! Use it as such to generate records")
@@ -163,7 +214,6 @@ class LaaPhaser(object):
 
 # for testing purposes
 if __name__ == "__main__":
-    import sys
     bc, ds = sys.argv[1:]
     logging.basicConfig(level=logging.INFO)
     with LaaPhaser(bc, os.path.abspath(ds)) as lp:
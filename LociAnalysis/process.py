@@ -0,0 +1,231 @@
+
+import os
+import sys
+import time
+import logging
+import threading
+
+from collections import namedtuple, deque
+from subprocess import Popen, PIPE
+
+import LociAnalysis.logger  # Enable TRACE-level logging
+from LociAnalysis.affinity import formatCpuList, threadEnvironment
+from LociAnalysis.profiling import profiler
+from LociAnalysis.which import which
+
+# Tools may be run before logging has been configured (e.g. to detect the
+#  LAA version), so avoid the module-level functions that call basicConfig
+log = logging.getLogger(__name__)
+
+# Per-tool limits, in seconds, set from the command-line.  A missing or
+#  zero-valued entry means that limit is disabled for that tool
+TOOL_TIMEOUTS  = {}
+STALL_TIMEOUTS = {}
+
+# The CpuAllocator that multi-threaded tools are pinned with, if any
+CPU_ALLOCATOR  = None
+
+STDERR_TAIL     = 200    # Number of trailing stderr lines kept for error messages
+HEARTBEAT       = 60.0   # Seconds between "still running" messages
+MAX_POLL        = 0.5    # Longest interval between checks on a running child
+KILL_GRACE      = 10.0   # Seconds to wait after SIGTERM before sending SIGKILL
+
+ProcessResult = namedtuple("ProcessResult", ["cmd", "tool", "pid", "returncode", "stdout", "stderr",
+                                             "startTime", "wallTime", "userTime", "systemTime", "maxRss",
+                                             "bytesRead", "bytesWritten", "timedOut"])
+
+def setToolTimeouts( wallTimeouts=None, stallTimeouts=None ):
+    """
+    Configure the wall-clock and no-output limits, in seconds, for each tool
+    """
+    for target, values in ((TOOL_TIMEOUTS, wallTimeouts), (STALL_TIMEOUTS, stallTimeouts)):
+        target.clear()
+        if values is None:
+            continue
+        for tool, seconds in values.iteritems():
+            target[tool] = float(seconds)
+
+def setCpuAffinity( allocator=None ):
+    """
+    Pin each tool run with 'nproc' to CPUs of its own from 'allocator', or
+    let tools run anywhere if it's None.  We can't set the affinity of a
+    child directly from Python 2, so tools are started with taskset
+    """
+    global CPU_ALLOCATOR
+    if allocator is not None and which("taskset") is None:
+        log.warn("Could not find 'taskset', external tools will not be pinned to CPUs")
+        allocator = None
+    CPU_ALLOCATOR = allocator
+
+def currentRss( pid ):
+    """
+    Return the current resident set size of a process in bytes, or None
+    if it can't be determined (e.g. the process has already exited)
+    """
+    try:
+        with open("/proc/{0}/status".format(pid)) as handle:
+            for line in handle:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return None
+
+def _maxRssBytes( ru_maxrss ):
+    # Linux reports ru_maxrss in kilobytes, OS X in bytes
+    if sys.platform == "darwin":
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+def _exitCode( status ):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+class _StreamDrainer(threading.Thread):
+    """
+    Read a child's output stream line-by-line until EOF, logging each line
+    and keeping either all of it or a bounded tail.  Draining the pipes in
+    the background is what stops a chatty child from filling the pipe
+    buffer and blocking forever
+    """
+    def __init__(self, stream, label, level, keepAll, activity):
+        super(_StreamDrainer, self).__init__()
+        self.daemon    = True
+        self._stream   = stream
+        self._label    = label
+        self._level    = level
+        self._lines    = [] if keepAll else deque(maxlen=STDERR_TAIL)
+        self._activity = activity
+
+    def run(self):
+        logLines = log.isEnabledFor(self._level)
+        for line in iter(self._stream.readline, b''):
+            self._activity[0] = time.time()
+            self._lines.append( line )
+            if logLines:
+                log.log(self._level, "%s: %s", self._label, line.rstrip())
+        self._stream.close()
+
+    @property
+    def output(self):
+        return "".join(self._lines)
+
+def runProcess( cmd, tool=None, cwd=None, env=None, captureStdout=False, check=False, onStart=None, unit=None,
+                nproc=None ):
+    """
+    Run an external tool to completion while concurrently draining and
+    logging its stdout and stderr, enforcing any wall-clock or no-output
+    limits configured for it, and recording the child's CPU time and peak
+    memory usage.  Returns a ProcessResult, or raises a RuntimeError if
+    'check' is set and the tool failed or was killed.  If given, 'onStart'
+    is called with the PID of the child as soon as it has been launched,
+    and 'unit' labels the run in the profiling report.  A tool run with
+    'nproc' threads has its OpenMP and BLAS thread pools sized to match,
+    and is pinned to that many CPUs if setCpuAffinity has been called
+    """
+    cpus = None
+    if nproc is not None:
+        if CPU_ALLOCATOR is not None:
+            cpus = CPU_ALLOCATOR.acquire( nproc )
+        env = threadEnvironment( nproc if cpus is None else len(cpus), env )
+    try:
+        return _runProcess( cmd, tool, cwd, env, captureStdout, check, onStart, unit, cpus )
+    finally:
+        if cpus is not None:
+            CPU_ALLOCATOR.release( cpus )
+
+def _runProcess( cmd, tool, cwd, env, captureStdout, check, onStart, unit, cpus ):
+    tool = os.path.basename(cmd[0]) if tool is None else tool
+    wallLimit  = TOOL_TIMEOUTS.get(tool, 0.0)
+    stallLimit = STALL_TIMEOUTS.get(tool, 0.0)
+
+    # The CPUs are only part of how it's run, so results still report the tool's own command
+    fullCmd = cmd if cpus is None else ["taskset", "-c", formatCpuList( cpus )] + list(cmd)
+    log.log(logging.TRACE, "Running `{0}`{1}".format(" ".join(fullCmd), "" if cwd is None else " in '{0}'".format(cwd)))
+    tStart = time.time()
+    proc = Popen(fullCmd, cwd=cwd, env=env, stdout=PIPE, stderr=PIPE, bufsize=-1, close_fds=True)
+    label = "{0}[{1}]".format(tool, proc.pid)
+    if onStart is not None:
+        onStart( proc.pid )
+
+    activity = [tStart]
+    drainers = [_StreamDrainer(proc.stdout, label, logging.TRACE, captureStdout, activity),
+                _StreamDrainer(proc.stderr, label, logging.DEBUG, False, activity)]
+    for drainer in drainers:
+        drainer.start()
+
+    # Reap the child ourselves with wait4() so that we get its resource usage
+    timedOut  = None
+    killTime  = None
+    heartbeat = tStart + HEARTBEAT
+    interval  = 0.01
+    drained   = False
+    while True:
+        pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+        if pid != 0:
+            break
+        # Tools almost always exit right after closing their output streams,
+        #  so waiting on the drainers lets us notice that without delay
+        alive = [drainer for drainer in drainers if drainer.is_alive()]
+        if alive:
+            alive[0].join(interval)
+        else:
+            # Poll quickly at first once the streams close, but back off
+            #  again for a tool that carries on without them
+            if not drained:
+                drained  = True
+                interval = 0.001
+            time.sleep(interval)
+        interval = min(interval * 2, MAX_POLL)
+
+        now = time.time()
+        if timedOut is None:
+            if wallLimit > 0 and now - tStart > wallLimit:
+                timedOut = "exceeded the {0}s wall-clock limit".format(wallLimit)
+            elif stallLimit > 0 and now - activity[0] > stallLimit:
+                timedOut = "produced no output for {0}s".format(stallLimit)
+            if timedOut is not None:
+                log.error("{0} {1}, terminating it".format(label, timedOut))
+                proc.terminate()
+                killTime = now + KILL_GRACE
+        elif now > killTime:
+            log.error("{0} ignored SIGTERM, killing it".format(label))
+            proc.kill()
+            killTime = float("inf")
+
+        if now > heartbeat:
+            rss = currentRss(proc.pid)
+            log.debug("{0} still running after {1}s, RSS {2}MB".format(label, int(now - tStart),
+                          "?" if rss is None else rss // (1024 * 1024)))
+            heartbeat = now + HEARTBEAT
+    proc.returncode = _exitCode(status)
+    tEnd = time.time()
+
+    # Orphaned grandchildren of a killed tool may hold its pipes open
+    for drainer in drainers:
+        drainer.join(None if timedOut is None else KILL_GRACE)
+
+    result = ProcessResult(cmd, tool, proc.pid, proc.returncode,
+                           drainers[0].output, drainers[1].output,
+                           tStart, tEnd - tStart, rusage.ru_utime, rusage.ru_stime,
+                           _maxRssBytes(rusage.ru_maxrss), rusage.ru_inblock * 512,
+                           rusage.ru_oublock * 512, timedOut)
+    profiler.recordProcess( result, unit )
+    log.debug("{0} finished with exit code {1} in {2}s (CPU {3}s, peak RSS {4}MB)".format(
+                  label, result.returncode, round(result.wallTime, 3),
+                  round(result.userTime + result.systemTime, 3), result.maxRss // (1024 * 1024)))
+
+    if check:
+        checkProcess( result )
+    return result
+
+def checkProcess( result ):
+    """
+    Raise a RuntimeError describing the failure if a tool didn't succeed
+    """
+    if result.timedOut is not None:
+        raise RuntimeError("`{0}` {1} and was killed:\n{2}".format(' '.join(result.cmd), result.timedOut, result.stderr))
+    if result.returncode != 0:
+        raise RuntimeError("`{0}` failed with exit code {1}:\n{2}".format(' '.join(result.cmd), result.returncode, result.stderr))
+    return result
@@ -0,0 +1,222 @@
+
+import os
+import sys
+import json
+import time
+import logging
+import resource
+import threading
+
+from contextlib import contextmanager
+
+from LociAnalysis.profiling.trace import writeTrace
+
+def _maxRssBytes( ru_maxrss ):
+    # Linux reports ru_maxrss in kilobytes, OS X in bytes
+    if sys.platform == "darwin":
+        return ru_maxrss
+    return ru_maxrss * 1024
+
+def _ioCounters():
+    """
+    Bytes read and written by this process so far, preferring the Linux
+    per-process I/O accounting (which includes cached I/O) to the block
+    I/O counts from rusage
+    """
+    try:
+        counters = {}
+        with open("/proc/self/io") as handle:
+            for line in handle:
+                key, value = line.split(':')
+                counters[key] = int(value)
+        return counters["rchar"], counters["wchar"]
+    except (IOError, OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+class _Snapshot(object):
+    """
+    Resource counters for this process and its reaped children at an instant
+    """
+    def __init__(self):
+        self.time     = time.time()
+        self.self     = resource.getrusage(resource.RUSAGE_SELF)
+        self.children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        self.io       = _ioCounters()
+
+class Stage(object):
+    """
+    A single timed stage of the pipeline, to which counts (e.g. of reads)
+    can be attached while it runs
+    """
+    def __init__(self, name, unit=None, **counts):
+        self.name   = name
+        self.unit   = unit
+        self.counts = dict(counts)
+
+    def count( self, key, value ):
+        self.counts[key] = value
+
+    def _finish( self, start, end ):
+        self.record = {"stage":        self.name,
+                       "unit":         self.unit,
+                       "thread":       threading.current_thread().name,
+                       "threadId":     threading.current_thread().ident,
+                       "start":        round(start.time, 6),
+                       "wallTime":     round(end.time - start.time, 6),
+                       "userTime":     round(end.self.ru_utime - start.self.ru_utime, 6),
+                       "systemTime":   round(end.self.ru_stime - start.self.ru_stime, 6),
+                       "childUserTime":   round(end.children.ru_utime - start.children.ru_utime, 6),
+                       "childSystemTime": round(end.children.ru_stime - start.children.ru_stime, 6),
+                       "maxRss":       _maxRssBytes(end.self.ru_maxrss),
+                       "childMaxRss":  _maxRssBytes(end.children.ru_maxrss),
+                       "bytesRead":    end.io[0] - start.io[0],
+                       "bytesWritten": end.io[1] - start.io[1],
+                       "counts":       self.counts}
+        return self.record
+
+class Profiler(object):
+    """
+    Collects per-stage timings and resource usage, plus the resources used
+    by every external process, and writes them out as a JSON report.  It
+    is disabled by default, in which case stages cost next to nothing.
+
+    Own-process CPU time and I/O are process-wide, so stages that overlap
+    (e.g. concurrent LAA units) each include the others' usage; the child
+    process records are exact, as they come from wait4()
+    """
+
+    def __init__(self):
+        self._enabled   = False
+        self._lock      = threading.Lock()
+        self._stages    = []
+        self._processes = []
+        self._cProfiles = []
+        self._start     = None
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def enable( self, cProfile=False ):
+        self._enabled = True
+        self._start   = _Snapshot()
+        if cProfile:
+            import cProfile as cProfileModule
+            self._cProfileModule = cProfileModule
+            self._mainProfile = cProfileModule.Profile()
+            self._mainProfile.enable()
+            self._cProfiles.append( self._mainProfile )
+
+    def begin( self, name, unit=None, **counts ):
+        """
+        Start timing a stage, for code where a 'with' block is awkward
+        """
+        stage = Stage(name, unit, **counts)
+        if self._enabled:
+            stage._start = _Snapshot()
+        return stage
+
+    def finish( self, stage ):
+        if not self._enabled:
+            return
+        record = stage._finish( stage._start, _Snapshot() )
+        with self._lock:
+            self._stages.append( record )
+
+    @contextmanager
+    def stage( self, name, unit=None, **counts ):
+        stage = self.begin( name, unit, **counts )
+        try:
+            yield stage
+        finally:
+            self.finish( stage )
+
+    @contextmanager
+    def threadProfile( self ):
+        """
+        cProfile only sees the thread it was enabled in, so worker threads
+        need profiles of their own, which are merged into the final dump
+        """
+        if not self._enabled or not self._cProfiles:
+            yield
+            return
+        profile = self._cProfileModule.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                self._cProfiles.append( profile )
+
+    def recordProcess( self, result, unit=None ):
+        """
+        Record the resources used by an external tool, from its ProcessResult
+        """
+        if not self._enabled:
+            return
+        record = {"tool":         result.tool,
+                  "unit":         unit,
+                  "pid":          result.pid,
+                  "returncode":   result.returncode,
+                  "start":        round(result.startTime, 6),
+                  "wallTime":     round(result.wallTime, 6),
+                  "userTime":     round(result.userTime, 6),
+                  "systemTime":   round(result.systemTime, 6),
+                  "maxRss":       result.maxRss,
+                  "bytesRead":    result.bytesRead,
+                  "bytesWritten": result.bytesWritten,
+                  "timedOut":     result.timedOut}
+        with self._lock:
+            self._processes.append( record )
+
+    def _totals( self ):
+        end = _Snapshot()
+        return {"wallTime":        round(end.time - self._start.time, 6),
+                "userTime":        round(end.self.ru_utime - self._start.self.ru_utime, 6),
+                "systemTime":      round(end.self.ru_stime - self._start.self.ru_stime, 6),
+                "childUserTime":   round(end.children.ru_utime - self._start.children.ru_utime, 6),
+                "childSystemTime": round(end.children.ru_stime - self._start.children.ru_stime, 6),
+                "maxRss":          _maxRssBytes(end.self.ru_maxrss),
+                "childMaxRss":     _maxRssBytes(end.children.ru_maxrss),
+                "bytesRead":       end.io[0] - self._start.io[0],
+                "bytesWritten":    end.io[1] - self._start.io[1]}
+
+    def writeReport( self, filename ):
+        if not self._enabled:
+            return
+        with self._lock:
+            report = {"command":   sys.argv,
+                      "pid":       os.getpid(),
+                      "totals":    self._totals(),
+                      "stages":    list(self._stages),
+                      "processes": list(self._processes)}
+        with open( filename, 'w' ) as handle:
+            json.dump( report, handle, indent=2, sort_keys=True )
+        logging.info("Wrote profiling report to '{0}'".format(filename))
+
+    def writeTrace( self, filename ):
+        """
+        Write the stages and external processes as a Chrome trace timeline
+        """
+        if not self._enabled:
+            return
+        with self._lock:
+            stages, processes = list(self._stages), list(self._processes)
+        writeTrace( filename, stages, processes, self._start.time )
+        logging.info("Wrote trace timeline to '{0}'".format(filename))
+
+    def writeCProfile( self, filename ):
+        if not self._cProfiles:
+            return
+        import pstats
+        self._mainProfile.disable()
+        with self._lock:
+            stats = pstats.Stats( self._cProfiles[0] )
+            for profile in self._cProfiles[1:]:
+                stats.add( profile )
+        stats.dump_stats( filename )
+        logging.info("Wrote Python profile to '{0}'".format(filename))
+
+profiler = Profiler()
@@ -0,0 +1,127 @@
+
+import os
+import sys
+import json
+
+from collections import defaultdict
+
+# Trace-event "processes" that group the tracks of the timeline
+PIPELINE_PID = 1
+TOOLS_PID    = 2
+
+MAIN_THREAD  = "MainThread"
+
+def _micros( seconds ):
+    return int(round(seconds * 1e6))
+
+def _packLanes( intervals ):
+    """
+    Assign each (start, end, key) interval to the lowest lane that is free
+    by the time it starts, so that work that never overlaps shares a track
+    and an idle lane shows as a gap.  Returns a dict of key -> lane
+    """
+    laneEnds, lanes = [], {}
+    for start, end, key in sorted(intervals):
+        for lane, laneEnd in enumerate(laneEnds):
+            if laneEnd <= start:
+                break
+        else:
+            lane = len(laneEnds)
+            laneEnds.append( end )
+        laneEnds[lane] = end
+        lanes[key] = lane
+    return lanes
+
+def _metadata( pid, tid, kind, **args ):
+    return {"ph": "M", "pid": pid, "tid": tid, "name": kind, "args": args}
+
+def _threadKey( stage ):
+    # Names needn't be unique, e.g. of concurrent jobs' ResultSinks, so
+    #  threads are told apart by their ident
+    if stage["thread"] == MAIN_THREAD:
+        return MAIN_THREAD
+    return stage.get("threadId", stage["thread"])
+
+def _threadLanes( stages ):
+    """
+    Threads are started per LAA run, so pack the threads whose lifetimes
+    don't overlap onto shared worker tracks, with the main thread's own
+    track first.  Returns a dict of thread key -> lane
+    """
+    spans = defaultdict(list)
+    for stage in stages:
+        spans[_threadKey( stage )].append( (stage["start"], stage["start"] + stage["wallTime"]) )
+    intervals = [(min(s for s, e in times), max(e for s, e in times), thread)
+                 for thread, times in spans.iteritems() if thread != MAIN_THREAD]
+    lanes = dict((thread, lane + 1) for thread, lane in _packLanes( intervals ).iteritems())
+    lanes[MAIN_THREAD] = 0
+    return lanes
+
+def _counterEvents( processes, origin ):
+    """
+    The number of each tool running over time, as a counter track
+    """
+    changes = []
+    for process in processes:
+        changes.append( (process["start"], 1, process["tool"]) )
+        changes.append( (process["start"] + process["wallTime"], -1, process["tool"]) )
+    running = dict((process["tool"], 0) for process in processes)
+    events  = []
+    # Ends sort before starts at the same instant, so back-to-back runs don't double-count
+    for time, change, tool in sorted(changes):
+        running[tool] += change
+        events.append( {"ph": "C", "name": "running", "pid": TOOLS_PID, "tid": 0,
+                        "ts": _micros(time - origin), "args": dict(running)} )
+    return events
+
+def traceEvents( stages, processes, origin ):
+    """
+    Convert the stage and process records of a Profiler into Chrome trace
+    events: the stages on one track per worker thread of the pipeline, each
+    external tool on one track per concurrent run, and a counter of the
+    tools running, all timed relative to 'origin'
+    """
+    events = [_metadata( PIPELINE_PID, 0, "process_name", name="LociAnalysis (pid {0})".format(os.getpid()) ),
+              _metadata( TOOLS_PID, 0, "process_name", name="External tools" ),
+              _metadata( PIPELINE_PID, 0, "process_sort_index", sort_index=0 ),
+              _metadata( TOOLS_PID, 0, "process_sort_index", sort_index=1 )]
+
+    threadLanes = _threadLanes( stages )
+    for lane in sorted(set(threadLanes.values())):
+        events.append( _metadata( PIPELINE_PID, lane, "thread_name",
+                                 name="main" if lane == 0 else "worker {0}".format(lane) ) )
+        events.append( _metadata( PIPELINE_PID, lane, "thread_sort_index", sort_index=lane ) )
+    for stage in stages:
+        args = dict(stage["counts"])
+        args.update( unit=stage["unit"], thread=stage["thread"],
+                     cpuTime=round(stage["userTime"] + stage["systemTime"], 6),
+                     bytesRead=stage["bytesRead"], bytesWritten=stage["bytesWritten"] )
+        events.append( {"ph": "X", "name": stage["stage"], "cat": stage["stage"].split('.')[0],
+                        "pid": PIPELINE_PID, "tid": threadLanes[_threadKey( stage )],
+                        "ts": _micros(stage["start"] - origin), "dur": _micros(stage["wallTime"]),
+                        "args": args} )
+
+    processLanes = _packLanes( [(p["start"], p["start"] + p["wallTime"], i) for i, p in enumerate(processes)] )
+    for lane in sorted(set(processLanes.values())):
+        events.append( _metadata( TOOLS_PID, lane + 1, "thread_name", name="tool {0}".format(lane + 1) ) )
+        events.append( _metadata( TOOLS_PID, lane + 1, "thread_sort_index", sort_index=lane + 1 ) )
+    for i, process in enumerate(processes):
+        args = dict((key, process[key]) for key in ("unit", "pid", "returncode", "userTime", "systemTime",
+                                                   "maxRss", "bytesRead", "bytesWritten", "timedOut"))
+        events.append( {"ph": "X", "name": process["tool"], "cat": "process",
+                        "pid": TOOLS_PID, "tid": processLanes[i] + 1,
+                        "ts": _micros(process["start"] - origin), "dur": _micros(process["wallTime"]),
+                        "args": args} )
+    events.extend( _counterEvents( processes, origin ) )
+    return events
+
+def writeTrace( filename, stages, processes, origin ):
+    """
+    Write a Chrome trace-event JSON file, which can be opened with
+    chrome://tracing or https://ui.perfetto.dev
+    """
+    trace = {"traceEvents":     traceEvents( stages, processes, origin ),
+             "displayTimeUnit": "ms",
+             "otherData":       {"command": " ".join(sys.argv)}}
+    with open( filename, 'w' ) as handle:
+        json.dump( trace, handle )
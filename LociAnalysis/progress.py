@@ -0,0 +1,139 @@
+
+import os
+import time
+import logging
+import tempfile
+import threading
+import os.path as op
+
+REFRESH = 30.0   # Seconds between rewrites of the status file while nothing happens
+
+STAGES = ["starting", "binning", "phasing", "done", "failed"]
+
+class ProgressMonitor(object):
+    """
+    Track the progress of a run and publish it as a status file in the
+    Prometheus textfile-collector format, rewritten atomically whenever a
+    unit starts or finishes (and periodically, to keep the ETA current)
+    so that it can be scraped by a node exporter at any time
+    """
+
+    def __init__(self, filename, label=None):
+        self._filename    = filename
+        self._label       = label
+        self._lock        = threading.Lock()
+        self._stage       = "starting"
+        self._startTime   = time.time()
+        self._phaseStart  = None
+        self._readsBinned = 0
+        self._readsPhased = 0
+        self._pending     = 0
+        self._running     = 0
+        self._done        = 0
+        self._failed      = 0
+        self._stop        = threading.Event()
+
+        self._refresher = threading.Thread(target=self._refresh)
+        self._refresher.daemon = True
+        self._refresher.start()
+        self.write()
+
+    def _refresh( self ):
+        while not self._stop.wait( REFRESH ):
+            self.write()
+
+    def setStage( self, stage ):
+        with self._lock:
+            self._stage = stage
+            if stage == "phasing" and self._phaseStart is None:
+                self._phaseStart = time.time()
+        self.write()
+        if stage in ("done", "failed"):
+            self.close()
+
+    def close( self ):
+        """
+        Stop the periodic refresh, leaving the last status in place
+        """
+        self._stop.set()
+        if self._refresher.is_alive() and self._refresher is not threading.current_thread():
+            self._refresher.join()
+
+    def setReadsBinned( self, count ):
+        with self._lock:
+            self._readsBinned = count
+        self.write()
+
+    def addUnits( self, count ):
+        with self._lock:
+            self._pending += count
+        self.write()
+
+    def unitStarted( self, unit ):
+        with self._lock:
+            self._pending -= 1
+            self._running += 1
+        self.write()
+
+    def unitFinished( self, unit ):
+        with self._lock:
+            self._running -= 1
+            if unit.error is not None or unit.excInfo is not None:
+                self._failed += 1
+            else:
+                self._done += 1
+                self._readsPhased += unit.nReads
+        self.write()
+
+    def _eta( self, now ):
+        """
+        Seconds until all units are finished, at the rate they have been
+        completing so far, or -1 if we can't estimate it yet
+        """
+        finished = self._done + self._failed
+        if self._phaseStart is None or finished == 0:
+            return -1
+        rate = finished / max(now - self._phaseStart, 1e-6)
+        return (self._pending + self._running) / rate
+
+    def _metrics( self ):
+        now = time.time()
+        labels = '' if self._label is None else 'output="{0}"'.format(self._label.replace('"', '\\"'))
+        def fmt( name, value, extra='' ):
+            allLabels = ",".join(l for l in (labels, extra) if l)
+            return "{0}{1} {2}".format(name, "{" + allLabels + "}" if allLabels else "", value)
+
+        lines = ["# HELP loci_analysis_units Number of LAA units (barcode/locus pairs) in each state",
+                 "# TYPE loci_analysis_units gauge"]
+        for state, count in (("pending", self._pending), ("running", self._running),
+                             ("done", self._done), ("failed", self._failed)):
+            lines.append( fmt("loci_analysis_units", count, 'state="{0}"'.format(state)) )
+        lines += ["# HELP loci_analysis_stage Whether the run is currently in each stage",
+                  "# TYPE loci_analysis_stage gauge"]
+        for stage in STAGES:
+            lines.append( fmt("loci_analysis_stage", int(stage == self._stage), 'stage="{0}"'.format(stage)) )
+        for name, kind, desc, value in (
+                ("loci_analysis_reads_binned", "gauge", "Subreads with at least one good alignment", self._readsBinned),
+                ("loci_analysis_reads_phased", "gauge", "Subreads in units that have finished phasing", self._readsPhased),
+                ("loci_analysis_eta_seconds", "gauge", "Estimated seconds until phasing finishes, -1 if unknown", round(self._eta(now), 1)),
+                ("loci_analysis_start_time_seconds", "gauge", "Unix time the run started", round(self._startTime, 3)),
+                ("loci_analysis_last_update_time_seconds", "gauge", "Unix time of this update", round(now, 3))):
+            lines += ["# HELP {0} {1}".format(name, desc),
+                      "# TYPE {0} {1}".format(name, kind),
+                      fmt(name, value)]
+        return "\n".join(lines) + "\n"
+
+    def write( self ):
+        """
+        Atomically replace the status file, so a scraper never sees it half-written
+        """
+        with self._lock:
+            content = self._metrics()
+            try:
+                handle, tmpName = tempfile.mkstemp(prefix=".loci_analysis_status.", dir=op.dirname(self._filename) or ".")
+                with os.fdopen(handle, 'w') as tmp:
+                    tmp.write( content )
+                os.chmod(tmpName, 0o644)
+                os.rename(tmpName, self._filename)
+            except (IOError, OSError) as error:
+                logging.warn("Could not update status file '{0}': {1}".format(self._filename, error))
@@ -1,24 +1,24 @@
 
 import logging
-import subprocess
 import os.path
 import time
 
 from glob import glob
 
+from LociAnalysis.process import runProcess, checkProcess
+from LociAnalysis.profiling import profiler
+
 
 def CallSaWriter( inputFasta ):
     saWriterCmd = ['sawriter', inputFasta]
 
     logging.debug("Calling sawriter with command line '%s'", ' '.join(saWriterCmd))
-    proc = subprocess.Popen(saWriterCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+    result = runProcess(saWriterCmd, tool="sawriter", unit=os.path.basename(inputFasta), nproc=1)
     logging.debug("Finished running sawriter")
 
-    if proc.returncode != 0:
-        logging.error("sawriter failed. Stderr was %s", stderr)
-        raise RuntimeError(" exited with returncode {e}"
-                           .format(e=proc.returncode))
+    if result.returncode != 0 or result.timedOut is not None:
+        logging.error("sawriter failed. Stderr was %s", result.stderr)
+        checkProcess( result )
 
     return True
 
@@ -28,6 +28,7 @@ class RefDb(object):
     def __init__(self, dbPath, writeSuffixArrays=True):
         logging.info("Building reference database from path '{0}'".format(dbPath))
         tStart = time.time()
+        stage  = profiler.begin("refdb")
 
         fastas = []
         for suffix in ("fa", "fna", "fasta"):
@@ -47,7 +48,8 @@ class RefDb(object):
 
             if not os.path.exists(suffixArray):
                 if writeSuffixArrays:
-                    CallSaWriter( fasta )
+                    with profiler.stage("refdb.sawriter", unit=loci):
+                        CallSaWriter( fasta )
                 else:
                     logging.warn("missing suffix array for : '{0}'".format(fasta))
                     suffixArray = None
@@ -60,8 +62,11 @@ class RefDb(object):
             refs[loci] = (fasta, suffixArray)
 
         self._refs = refs
+        self._lengths = dict()
         logging.debug("Found references for the following loci : {0}".format(", ".join(sorted(self._refs.keys()))))
 
+        stage.count("loci", len(refs))
+        profiler.finish( stage )
         tEnd = time.time()
         logging.info("Finished building reference database in {0}s".format(round(tEnd - tStart, 3)))
 
@@ -80,6 +85,24 @@ class RefDb(object):
     def __getitem__(self, name):
         return self._refs[name]
 
+    def referenceLength(self, locus):
+        """
+        The median length of the reference sequences for a locus, which
+        we use as a proxy for the length of its amplicon
+        """
+        if locus not in self._lengths:
+            fasta, _ = self._refs[locus]
+            lengths = []
+            with open(fasta) as handle:
+                for line in handle:
+                    if line.startswith('>'):
+                        lengths.append(0)
+                    elif lengths:
+                        lengths[-1] += len(line.strip())
+            lengths.sort()
+            self._lengths[locus] = lengths[len(lengths) // 2] if lengths else 0
+        return self._lengths[locus]
+
 if __name__ == "__main__":
     import sys
 
@@ -1,2 +1,6 @@
-from .phasing_result import PhasingResult
-from .result_writer  import ResultWriter
+from .phasing_result import PhasingResult, ResultSummary
+from .result_writer  import ResultWriter, SubreadMatrix
+from .result_sink    import ResultSink
+from .bgzf           import BgzfWriter
+from .sparse         import SparseSubreadMatrix
+from .result_db      import ResultDb
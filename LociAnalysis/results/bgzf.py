@@ -0,0 +1,110 @@
+
+import zlib
+import struct
+import collections
+
+from multiprocessing.pool import ThreadPool
+
+# BGZF files are a series of gzip members of at most 64KB each, with the
+#  size of each member recorded in an extra field so that readers can seek
+#  between them.  Any gzip reader can read them as ordinary gzip files
+BLOCK_SIZE   = 0xff00       # Uncompressed bytes per block, as in samtools
+SUFFIX       = ".gz"
+EOF_BLOCK    = ("\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00\x42\x43"
+                "\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00")
+MAX_PENDING  = 16           # Blocks queued for compression per file
+
+def compressBlock( data, level=6 ):
+    """
+    Compress up to BLOCK_SIZE bytes into a single BGZF block
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress( data ) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6,
+                         ord('B'), ord('C'), 2, len(deflated) + 25)
+    footer = struct.pack("<II", zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + footer
+
+def compressionPool( threads ):
+    """
+    A pool of threads to compress blocks on, or None to compress them in the
+    writing thread.  zlib releases the GIL, so the threads run in parallel
+    """
+    return ThreadPool( threads ) if threads > 1 else None
+
+class BgzfWriter(object):
+    """
+    A write-only file object that BGZF-compresses everything written to
+    it, handing whole blocks to 'pool' (if given) so that compression
+    overlaps with the writer producing more data.  Blocks are written in
+    order, and at most MAX_PENDING are held in memory at a time
+    """
+
+    def __init__(self, filename, pool=None, level=6):
+        self.name      = filename
+        self._handle   = open(filename, 'wb')
+        self._pool     = pool
+        self._level    = level
+        self._buffer   = []
+        self._buffered = 0
+        self._blocks   = collections.deque()
+
+    def __enter__( self ):
+        return self
+
+    def __exit__( self, excType, excValue, traceback ):
+        self.close()
+
+    @property
+    def closed(self):
+        return self._handle.closed
+
+    def read( self, *args ):
+        raise IOError("File not open for reading")
+
+    def write( self, data ):
+        self._buffer.append( data )
+        self._buffered += len(data)
+        if self._buffered >= BLOCK_SIZE:
+            self._compressBuffer( final=False )
+
+    def writelines( self, lines ):
+        for line in lines:
+            self.write( line )
+
+    def flush( self ):
+        """
+        Write out any blocks that have finished compressing.  Data short of
+        a full block stays buffered, so flushing often doesn't cost us
+        compression
+        """
+        self._writeBlocks( wait=False )
+        self._handle.flush()
+
+    def close( self ):
+        if self._handle.closed:
+            return
+        self._compressBuffer( final=True )
+        self._writeBlocks( wait=True )
+        self._handle.write( EOF_BLOCK )
+        self._handle.close()
+
+    def _compressBuffer( self, final ):
+        data = "".join( self._buffer )
+        whole = len(data) if final else len(data) - len(data) % BLOCK_SIZE
+        for start in range(0, whole, BLOCK_SIZE):
+            self._submit( data[start:start+BLOCK_SIZE] )
+        rest = data[whole:]
+        self._buffer   = [rest] if rest else []
+        self._buffered = len(rest)
+
+    def _submit( self, chunk ):
+        if self._pool is None:
+            self._handle.write( compressBlock( chunk, self._level ) )
+            return
+        self._blocks.append( self._pool.apply_async( compressBlock, (chunk, self._level) ) )
+        self._writeBlocks( wait=False )
+
+    def _writeBlocks( self, wait ):
+        while self._blocks and (wait or len(self._blocks) > MAX_PENDING or self._blocks[0].ready()):
+            self._handle.write( self._blocks.popleft().get() )
@@ -1,25 +1,31 @@
-
 import logging
 
-from pbcore.io import FastqRecord
+from collections import namedtuple
 
-class PhasingResult(object):
+from LociAnalysis.fastq import FastqRecord
+
+# The fields of LAA's summary CSV for one result, as the strings LAA wrote
+ResultSummary = namedtuple("ResultSummary", ["cluster", "phase", "coverage", "readQuality", "didConverge",
+                                             "isNoise", "isDup", "dupOf", "isChimera", "chimeraScore",
+                                             "parentA", "parentB", "crossover"])
 
-    _record   = None
-    _locus    = None
-    _summary  = None
-    _subreads = None
+class PhasingResult(object):
+    """
+    One consensus sequence from LAA.  There can be hundreds of thousands of
+    these per run, so they're kept as compact as possible
+    """
+    __slots__ = ("_barcode", "_locus", "_record", "_summary", "_subreads", "_isJunk")
 
     def __init__(self, barcode, locus, record, summary, subreads, isJunk ):
         self._barcode  = "0" if barcode is None else barcode
         self._locus    = locus
         self._record   = self._formatRecord( record )
-        self._locus    = locus
         self._summary  = summary
         self._subreads = subreads
         self._isJunk   = isJunk
 
         self._validateRecord()
+        self._validateSummary()
         self._validateIsJunk()
 
     def _formatRecord( self, record ):
@@ -29,12 +35,16 @@ class PhasingResult(object):
         """
         idParts = record.id.split('_', 1)
         newId = "{0}_Locus{1}_{2}".format(idParts[0], self._locus, idParts[1])
-        return FastqRecord(newId, record.sequence, record.quality)
+        return record.renamed( newId )
 
     def _validateRecord( self ):
         if not isinstance( self._record, FastqRecord ):
             raise RuntimeError("Sequence record is not a valid FASTQ!")
 
+    def _validateSummary( self ):
+        if not isinstance( self._summary, ResultSummary ):
+            raise RuntimeError("Summary argument must be a ResultSummary!")
+
     def _validateIsJunk( self ):
         if not isinstance( self._isJunk, bool ):
             raise RuntimeError("IsJunk argument must be boolean!")
@@ -0,0 +1,158 @@
+
+import os
+import time
+import logging
+import sqlite3
+import os.path as op
+
+BATCH_SIZE = 500    # Results buffered before they're written in a single transaction
+TIMEOUT    = 60.0   # Seconds to wait for another run writing to the same database
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id              INTEGER PRIMARY KEY,
+    name            TEXT NOT NULL,
+    input           TEXT,
+    outputDirectory TEXT,
+    started         REAL,
+    finished        REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    id              INTEGER PRIMARY KEY,
+    run             INTEGER NOT NULL REFERENCES runs(id),
+    barcode         TEXT NOT NULL,
+    locus           TEXT NOT NULL,
+    name            TEXT NOT NULL,
+    coarseCluster   INTEGER,
+    phase           INTEGER,
+    totalCoverage   INTEGER,
+    sequenceLength  INTEGER,
+    accuracy        REAL,
+    converged       INTEGER,
+    noise           INTEGER,
+    isJunk          INTEGER,
+    isDuplicate     INTEGER,
+    duplicateOf     TEXT,
+    isChimera       INTEGER,
+    chimeraScore    REAL,
+    parentA         TEXT,
+    parentB         TEXT,
+    crossover       INTEGER,
+    sequence        TEXT,
+    quality         TEXT
+);
+CREATE TABLE IF NOT EXISTS failures (
+    run                 INTEGER NOT NULL REFERENCES runs(id),
+    barcode             TEXT NOT NULL,
+    locus               TEXT NOT NULL,
+    attempts            INTEGER,
+    maxReads            INTEGER,
+    maxClusteringReads  INTEGER,
+    error               TEXT
+);
+CREATE TABLE IF NOT EXISTS subreadWeights (
+    result          INTEGER NOT NULL REFERENCES results(id),
+    subread         TEXT NOT NULL,
+    weight          REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS resultsByRun ON results(run);
+CREATE INDEX IF NOT EXISTS resultsByBarcode ON results(barcode, locus);
+CREATE INDEX IF NOT EXISTS resultsByLocus ON results(locus, barcode);
+CREATE INDEX IF NOT EXISTS failuresByRun ON failures(run);
+CREATE INDEX IF NOT EXISTS failuresByLocus ON failures(locus, barcode);
+CREATE INDEX IF NOT EXISTS subreadWeightsByResult ON subreadWeights(result);
+CREATE INDEX IF NOT EXISTS subreadWeightsBySubread ON subreadWeights(subread);
+"""
+
+RESULT_COLUMNS = ["run", "barcode", "locus", "name", "coarseCluster", "phase", "totalCoverage",
+                  "sequenceLength", "accuracy", "converged", "noise", "isJunk", "isDuplicate",
+                  "duplicateOf", "isChimera", "chimeraScore", "parentA", "parentB", "crossover",
+                  "sequence", "quality"]
+
+def _value( value, convert ):
+    # LAA leaves fields it doesn't have blank or 'N/A'
+    if value is None or value in ("", "N/A"):
+        return None
+    try:
+        return convert( value )
+    except ValueError:
+        return None
+
+def _bool( value ):
+    if value in (True, False):
+        return int(value)
+    return int(str(value).lower() == "true")
+
+class ResultDb(object):
+    """
+    An SQLite database of the results of any number of runs, each of which
+    appends its own rows tagged with a new run id.  Rows are buffered and
+    written in batches, each in a single short transaction, so that several
+    runs can write to the same database at once
+    """
+
+    def __init__(self, filename, name, inputFn=None, outputDirectory=None, subreads=False):
+        self.filename  = filename
+        self._subreads = subreads
+        self._results  = []
+        self._failures = []
+        directory = op.dirname( op.abspath( filename ) )
+        if not op.isdir( directory ):
+            os.makedirs( directory )
+        try:
+            self._db = sqlite3.connect( filename, timeout=TIMEOUT, check_same_thread=False )
+            with self._db:
+                self._db.executescript( SCHEMA )
+                cursor = self._db.execute("INSERT INTO runs (name, input, outputDirectory, started) VALUES (?, ?, ?, ?)",
+                                          (name, inputFn, outputDirectory, time.time()))
+                self.run = cursor.lastrowid
+        except sqlite3.Error as error:
+            msg = "Could not open results database '{0}': {1}".format(filename, error)
+            logging.error( msg )
+            raise RuntimeError( msg )
+
+    def addResult( self, result ):
+        s = result.summary
+        row = (self.run, result.barcode, result.locus, result.id,
+               _value(s.cluster, int), _value(s.phase, int), _value(s.coverage, int), len(result.sequence),
+               _value(s.readQuality, float), _value(s.didConverge, _bool), _value(s.isNoise, _bool),
+               int(result.isJunk), _value(s.isDup, _bool), _value(s.dupOf, str), _value(s.isChimera, _bool),
+               _value(s.chimeraScore, float), _value(s.parentA, str), _value(s.parentB, str),
+               _value(s.crossover, int), result.sequence, result.qualityString)
+        weights = sorted(result.subreads.iteritems()) if self._subreads else []
+        self._results.append( (row, weights) )
+        if len(self._results) >= BATCH_SIZE:
+            self.flush()
+
+    def addFailure( self, barcode, locus, attempts, maxReads, maxClusteringReads, error ):
+        self._failures.append( (self.run, barcode, locus, attempts, _value(maxReads, int),
+                                _value(maxClusteringReads, int), error) )
+
+    def flush( self ):
+        """
+        Write everything buffered so far in a single transaction
+        """
+        if not self._results and not self._failures:
+            return
+        insert = "INSERT INTO results ({0}) VALUES ({1})".format(", ".join(RESULT_COLUMNS),
+                                                                  ", ".join("?" * len(RESULT_COLUMNS)))
+        try:
+            with self._db:
+                for row, weights in self._results:
+                    resultId = self._db.execute( insert, row ).lastrowid
+                    if weights:
+                        self._db.executemany("INSERT INTO subreadWeights (result, subread, weight) VALUES (?, ?, ?)",
+                                             ((resultId, subread, weight) for subread, weight in weights))
+                self._db.executemany("INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?, ?)", self._failures)
+        except sqlite3.Error as error:
+            msg = "Could not write to results database '{0}': {1}".format(self.filename, error)
+            logging.error( msg )
+            raise RuntimeError( msg )
+        self._results  = []
+        self._failures = []
+
+    def close( self ):
+        self.flush()
+        with self._db:
+            self._db.execute("UPDATE runs SET finished = ? WHERE id = ?", (time.time(), self.run))
+        self._db.close()
@@ -0,0 +1,144 @@
+
+import sys
+import Queue
+import logging
+import threading
+
+from LociAnalysis.profiling import profiler
+from LociAnalysis.results.result_writer import SubreadMatrix
+
+MAX_PENDING = 16    # Units that may be queued for the writer thread before producers block
+
+_CLOSE = object()
+_ABORT = object()
+
+class ResultSink(object):
+    """
+    Write the results of many concurrent producers through a ResultWriter on
+    a dedicated thread.  Each producer hands over all of the results of one
+    unit at once, tagged with the unit's index in the output order; units
+    are buffered until every unit before them has arrived, so the outputs
+    are written in the same order as a serial run would write them no
+    matter the order in which the units finish.  Subread data is gathered
+    per-sample as soon as it arrives, and each sample's matrix is written
+    once the output order moves past it
+    """
+
+    def __init__(self, writer, first=0, maxPending=MAX_PENDING, name=None):
+        self._writer   = writer
+        self._queue    = Queue.Queue( maxPending )
+        self._lock     = threading.Lock()
+        self._closed   = False
+        self._aborted  = False
+        self._pending  = {}         # Reorder buffer of units waiting on an earlier index
+        self._next     = first      # Index of the next unit to write
+        self._matrices = {}         # Subread data of each sample, by barcode
+        self._current  = None       # Barcode of the last unit written
+        self._excInfo  = None
+        self._thread   = threading.Thread(target=self._run,
+                                          name="ResultSink" if name is None else "ResultSink-{0}".format(name))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def writeResults( self, index, barcode, results, name=None ):
+        self._put( (index, barcode, list(results), None, name) )
+
+    def writeFailure( self, index, barcode, locus, attempts, kwargs, error, name=None ):
+        self._put( (index, barcode, [], (locus, attempts, kwargs, error), name) )
+
+    def _put( self, item ):
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Results written after their ResultSink was closed")
+        self._raiseError()
+        self._queue.put( item )
+
+    def _raiseError( self ):
+        if self._excInfo is not None:
+            raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+
+    def close( self ):
+        """
+        Write out everything handed over so far and close the outputs,
+        raising any error from the writer thread
+        """
+        self._stop( _CLOSE )
+        self._raiseError()
+        if self._pending:
+            msg = "Results for units {0} were never written, missing unit {1}".format(
+                  ", ".join(str(i) for i in sorted(self._pending)), self._next)
+            logging.error( msg )
+            raise RuntimeError( msg )
+
+    def abort( self ):
+        """
+        Stop writing, discarding anything still queued, and leave the
+        outputs as they were when the last unit in order was written
+        """
+        self._aborted = True
+        self._stop( _ABORT )
+
+    def _stop( self, sentinel ):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put( sentinel )
+        self._thread.join()
+
+    def _run( self ):
+        while True:
+            item = self._queue.get()
+            if item is _CLOSE or item is _ABORT:
+                break
+            # After an error, keep draining the queue so producers never block
+            if self._excInfo is not None or self._aborted:
+                continue
+            try:
+                self._accept( *item )
+            except Exception:
+                self._excInfo = sys.exc_info()
+
+        try:
+            if item is _CLOSE and self._excInfo is None and not self._pending:
+                self._finalize( self._current )
+                for barcode in sorted(self._matrices):
+                    self._finalize( barcode )
+        except Exception:
+            self._excInfo = sys.exc_info()
+        finally:
+            self._writer.close()
+
+    def _accept( self, index, barcode, results, failure, name ):
+        for order, result in enumerate(results):
+            matrix = self._matrices.get( result.barcode )
+            if matrix is None:
+                matrix = self._matrices[result.barcode] = SubreadMatrix( result.barcode )
+            matrix.add( result, order=(index, order) )
+
+        self._pending[index] = (barcode, results, failure, name)
+        while self._next in self._pending:
+            self._write( *self._pending.pop( self._next ) )
+            self._next += 1
+
+    def _write( self, barcode, results, failure, name ):
+        # Each sample's units are contiguous, so once we reach the units of
+        #  another sample, the last one's subread data is complete
+        barcode = "0" if barcode is None else barcode
+        if barcode != self._current:
+            self._finalize( self._current )
+            self._current = barcode
+
+        with profiler.stage("results.write", unit=name) as stage:
+            if failure is not None:
+                self._writer.writeFailure( barcode, *failure )
+            for result in results:
+                self._writer.writeRecord( result )
+            stage.count("results", len(results))
+
+    def _finalize( self, barcode ):
+        matrix = self._matrices.pop( barcode, None )
+        if matrix is not None:
+            self._writer.writeSubreadMatrix( matrix )
+        if barcode is not None:
+            self._writer.finishBarcode( barcode )
@@ -1,19 +1,105 @@
 
 import csv
+import json
+import time
 import logging
 import os
 import os.path as op
 
 from collections import defaultdict
 
-from pbcore.io import FastqWriter, FastqRecord
+from LociAnalysis.fastq import FastqWriter
+from LociAnalysis.profiling import profiler
+from LociAnalysis.results.bgzf import BgzfWriter, SUFFIX, compressionPool
+from LociAnalysis.results.sparse import writeSparseMatrix
 
 SUMMARY_HEADER = ["BarcodeName", "FastaName", "CoarseCluster", "Phase", "TotalCoverage", "SequenceLength",
                   "PredictedAccuracy", "ConsensusConverged", "NoiseSequence", "IsDuplicate", "DuplicateOf",
                   "IsChimera", "ChimeraScore", "ParentSequenceA", "ParentSequenceB", "CrossoverPosition"]
 
+FAILURE_HEADER = ["BarcodeName", "Locus", "Attempts", "MaxReads", "MaxClusteringReads", "Error"]
+
 NumReadsLambda = lambda x: int(x.split('NumReads')[1])
 
+# Subread weights can be written as a dense matrix, a long (subread, result,
+#  weight) table of the non-zero weights, or a binary sparse matrix
+SUBREAD_FORMATS = ["dense", "long", "sparse"]
+SUBREAD_ROOTS   = {"dense":  "loci_analysis_subreads.",
+                   "long":   "loci_analysis_subreads_long.",
+                   "sparse": "loci_analysis_subreads_sparse."}
+SUBREAD_SUFFIX  = {"dense": ".csv", "long": ".csv", "sparse": ".bin"}
+
+# With per-barcode outputs, each barcode's results are also written to a
+#  directory of its own, which is complete once its marker file exists
+BARCODE_ROOT   = "barcodes"
+BARCODE_MARKER = "loci_analysis.done"
+
+class SubreadMatrix(object):
+    """
+    The weight of each subread of one sample in each of its results.  Results
+    are ordered by 'order' if given, otherwise in the order they were added
+    """
+
+    def __init__(self, barcode):
+        self.barcode = barcode
+        self._cols   = []
+        self._ids    = set()
+        self._data   = defaultdict(lambda : defaultdict(int))
+
+    def __len__( self ):
+        return len(self._data)
+
+    @property
+    def columns(self):
+        # Result ids in descending order of read count, ties in result order
+        ids = [rid for _, rid in sorted(self._cols)]
+        return sorted(ids, key=NumReadsLambda, reverse=True)
+
+    def add( self, result, order=None ):
+        # All columns (ResultIds) must be unique for us to store data correctly
+        if result.id in self._ids:
+            msg = "Duplicate Result Id: {0}".format(result.id)
+            logging.error( msg )
+            raise RuntimeError( msg )
+        self._ids.add( result.id )
+        self._cols.append( (len(self._cols) if order is None else order, result.id) )
+
+        # We store the weight for a subread-result pair with the subread first
+        #  for fast row-wise access during writing
+        for subread, weight in result.subreads.iteritems():
+            self._data[subread][result.id] = weight
+
+    def rows( self ):
+        """
+        The non-zero weights of each subread, in order, as lists of
+        (column index, weight) pairs
+        """
+        index = dict((rid, i) for i, rid in enumerate(self.columns))
+        for subread in sorted(self._data):
+            yield subread, sorted((index[rid], weight) for rid, weight in self._data[subread].iteritems() if weight)
+
+    def writeLong( self, csv ):
+        cols = self.columns
+        csv.writerow( ["SubreadId", "ResultId", "Weight"] )
+        for subread, row in self.rows():
+            for i, weight in row:
+                csv.writerow( [subread, cols[i], weight] )
+
+    def writeSparse( self, handle ):
+        subreads = sorted(self._data)
+        writeSparseMatrix( handle, subreads, self.columns, (row for _, row in self.rows()) )
+
+    def write( self, csv ):
+        # Header is "SubreadId" followed by result ids in descending order
+        cols = self.columns
+        csv.writerow( ["SubreadId"] + cols )
+
+        # Each row is the data for one subread, sorted so that the
+        #  subread files of separate shards can be merged as streams
+        for subread in sorted(self._data):
+            colData = self._data[subread]
+            csv.writerow( [subread] + [colData[rid] for rid in cols] )
+
 class ResultWriter(object):
 
     # Primary class-variables
@@ -21,26 +107,41 @@ class ResultWriter(object):
     _goodFastq   = None
     _junkFastq   = None
     _summaryCsv  = None
+    _failureCsv  = None
     _subreadRoot = None
 
     # Secondary class-variables for writing out subread matrices
     _currBarcode = None
-    _subreadCols = []
-    _subreadData = defaultdict(lambda : defaultdict(int))
+    _subreads    = None
+
+    def __init__(self, directory, compress=False, threads=1, subreadFormat="dense", resultDb=None,
+                 barcodeOutputs=False):
+        self._currBarcode = None
+        self._subreads    = SubreadMatrix( None )
+        self._handles     = []
+        self._partitions  = {} if barcodeOutputs else None
+        self._counts      = defaultdict(lambda : {"results": 0, "failures": 0})
+
+        # Compressed outputs are BGZF, and so readable by any gzip reader
+        self._compress    = compress
+        self._pool        = compressionPool( threads ) if compress else None
 
-    def __init__(self, directory):
         self._directory   = self._validateDirectory( directory )
         self._goodFastq   = self._openFastqWriter( "loci_analysis.fastq" )
         self._junkFastq   = self._openFastqWriter( "loci_analysis_chimeras_noise.fastq" )
         self._summaryCsv  = self._openCsvWriter( "loci_analysis_summary.csv" )
-        self._subreadRoot = op.join( self._directory, "loci_analysis_subreads." )
+        self._failureCsv  = self._openCsvWriter( "loci_analysis_failures.csv" )
+        self._subreadRoot = SUBREAD_ROOTS[subreadFormat]
+        self._subreadFmt  = subreadFormat
+        self._resultDb    = resultDb
 
         self._writerSummaryCsvHeader()
+        self._failureCsv.writerow( FAILURE_HEADER )
 
     def _validateDirectory( self, directory ):
         if not op.exists( directory ):
             try:
-                os.mkdirs( directory )
+                os.makedirs( directory )
             except:
                 msg = "Could not create result directory: {0}".format( directory )
                 logging.error( msg )
@@ -51,26 +152,89 @@ class ResultWriter(object):
             raise RuntimeError( msg )
         return directory
 
+    def outputPath( self, filename ):
+        suffix = SUFFIX if self._compress else ""
+        return op.join( self._directory, filename + suffix )
+
+    def _openHandle( self, filename ):
+        filepath = self.outputPath( filename )
+        if self._compress:
+            return BgzfWriter( filepath, pool=self._pool )
+        return open( filepath, 'wb' )
+
     def _openFastqWriter( self, filename ):
-        filepath = op.join( self._directory, filename )
         try:
-            writer = FastqWriter( filepath )
+            if self._compress:
+                writer = FastqWriter( self._openHandle( filename ) )
+            else:
+                writer = FastqWriter( self.outputPath( filename ) )
         except:
             msg = "Could not open FASTQ output for writing: {0}".format( filename )
             logging.error( msg )
             raise RuntimeError( msg )
         return writer
 
-    def _openCsvWriter( self, filename ):
+    def _openCsvHandle( self, filename ):
+        try:
+            handle = self._openHandle( filename )
+        except:
+            msg = "Could not open CSV output for writing: {0}".format( filename )
+            logging.error( msg )
+            raise RuntimeError( msg )
+        return handle
+
+    def _openBinaryHandle( self, filename ):
         filepath = op.join( self._directory, filename )
         try:
             handle = open( filepath, 'wb' )
-            writer = csv.writer( handle )
         except:
-            msg = "Could not open CSV output for writing: {0}".format( filename )
+            msg = "Could not open output for writing: {0}".format( filename )
             logging.error( msg )
             raise RuntimeError( msg )
-        return writer
+        return handle
+
+    def _openCsvWriter( self, filename ):
+        handle = self._openCsvHandle( filename )
+        self._handles.append( handle )
+        return csv.writer( handle )
+
+    def _partition( self, barcode ):
+        """
+        The writer of the outputs of one barcode, if we're writing them
+        """
+        if self._partitions is None:
+            return None
+        barcode = "0" if barcode is None else barcode
+        partition = self._partitions.get( barcode )
+        if partition is None:
+            directory = op.join( self._directory, BARCODE_ROOT, barcode )
+            # Any marker from an earlier run no longer describes what's there
+            if op.isfile( op.join( directory, BARCODE_MARKER ) ):
+                os.remove( op.join( directory, BARCODE_MARKER ) )
+            partition = ResultWriter( directory, compress=self._compress, subreadFormat=self._subreadFmt )
+            self._partitions[barcode] = partition
+        return partition
+
+    def finishBarcode( self, barcode ):
+        """
+        Close the outputs of a barcode whose results have all been written,
+        and atomically mark them as complete
+        """
+        if self._partitions is None:
+            return
+        barcode = "0" if barcode is None else barcode
+        partition = self._partition( barcode )
+        with profiler.stage("results.barcode", unit=barcode):
+            partition.close()
+        del self._partitions[barcode]
+
+        marker = op.join( partition._directory, BARCODE_MARKER )
+        status = dict(self._counts.pop( barcode, {"results": 0, "failures": 0} ),
+                      barcode=barcode, finished=time.time())
+        with open( marker + ".tmp", 'w' ) as handle:
+            json.dump( status, handle, indent=2, sort_keys=True )
+        os.rename( marker + ".tmp", marker )
+        logging.debug("Finished the outputs of barcode '{0}'".format(barcode))
 
     def _writerSummaryCsvHeader( self ):
         self._summaryCsv.writerow( SUMMARY_HEADER )
@@ -86,56 +250,104 @@ class ResultWriter(object):
             self._currBarcode = barcode
 
     def _writeSummary( self, result ):
-        row = [result.barcode, result.id, result.summary["cluster"], result.summary["phase"],
-               result.summary["coverage"], str(len(result.sequence)), result.summary["readQuality"],
-               result.summary["didConverge"], result.summary["isNoise"], result.summary["isDup"],
-               result.summary["dupOf"], result.summary["isChimera"], result.summary["chimeraScore"],
-               result.summary["parentA"], result.summary["parentB"], result.summary["crossover"]]
+        s = result.summary
+        row = [result.barcode, result.id, s.cluster, s.phase, s.coverage, str(len(result.sequence)),
+               s.readQuality, s.didConverge, s.isNoise, s.isDup, s.dupOf, s.isChimera,
+               s.chimeraScore, s.parentA, s.parentB, s.crossover]
         self._summaryCsv.writerow( row )
 
-    def _addSubreadData( self, result ):
-        # All columns (ResultIds) must be unique for us to store data correctly
-        if result.id in self._subreadCols:
-            msg = "Duplicate Result Id: {0}".format(result.id)
-            logging.error( msg )
-            raise RuntimeError( msg )
-        else:
-            self._subreadCols.append( result.id )
-
-        # We store the weight for a subread-result pair with the subread first
-        #  for fast row-wise access during writing
-        for subread, weight in result.subreads.iteritems():
-            self._subreadData[subread][result.id] = weight
-
     def finalizeSubreadCsv( self ):
-        # If we have a barcode, we have subread data that needs to be written out
-        if self._currBarcode:
-            csv = self._openCsvWriter( self._subreadRoot + self._currBarcode + ".csv" )
-
-            # Header is "SubreadId" followed by result ids in descending order
-            cols = ["SubreadId"] + sorted(self._subreadCols, key=NumReadsLambda, reverse=True)
-            csv.writerow( cols )
-
-            # Each row is the data for one subread
-            for subread, colData in self._subreadData.iteritems():
-                row = [subread] + [colData[rid] for rid in cols[1:]]
-                csv.writerow( row )
+        self._subreads.barcode = self._currBarcode
+        self.writeSubreadMatrix( self._subreads )
+        if self._currBarcode is not None:
+            self.finishBarcode( self._currBarcode )
 
         # Finally, reset subread-related class variables for the next sample
         self._currBarcode = None
-        self._subreadCols = []
-        self._subreadData = defaultdict(lambda : defaultdict(int))
+        self._subreads    = SubreadMatrix( None )
 
-    def writeResult( self, result ):
-        # First check that the barcode for this result is sensible
-        self._checkBarcode( result.barcode )
+    def writeSubreadMatrix( self, matrix ):
+        # If we have a barcode, we have subread data that needs to be written out
+        if not matrix.barcode:
+            return
+        partition = self._partition( matrix.barcode )
+        if partition is not None:
+            partition.writeSubreadMatrix( matrix )
+        with profiler.stage("results.finalize", unit=matrix.barcode,
+                            subreads=len(matrix), results=len(matrix.columns)):
+            filename = self._subreadRoot + matrix.barcode + SUBREAD_SUFFIX[self._subreadFmt]
+            if self._subreadFmt == "sparse":
+                # Never compressed, so that it can be memory-mapped
+                with self._openBinaryHandle( filename ) as handle:
+                    matrix.writeSparse( handle )
+            else:
+                with self._openCsvHandle( filename ) as handle:
+                    if self._subreadFmt == "long":
+                        matrix.writeLong( csv.writer( handle ) )
+                    else:
+                        matrix.write( csv.writer( handle ) )
 
-        # If so, write the FASTQ and Summary data to our current handles
+    def writeRecord( self, result ):
+        """
+        Write the FASTQ and Summary data of a result, leaving its subread
+        data to the caller
+        """
         if not result.isJunk:
             self._goodFastq.writeRecord( result.record )
         else:
             self._junkFastq.writeRecord( result.record )
         self._writeSummary( result )
+        if self._resultDb is not None:
+            self._resultDb.addResult( result )
+        partition = self._partition( result.barcode )
+        if partition is not None:
+            partition.writeRecord( result )
+            self._counts[result.barcode]["results"] += 1
+
+    def writeResult( self, result ):
+        # First check that the barcode for this result is sensible
+        self._checkBarcode( result.barcode )
+
+        # If so, write the FASTQ and Summary data to our current handles
+        self.writeRecord( result )
 
         # Finally, add the subread data to the current store
-        self._addSubreadData( result )
+        self._subreads.add( result )
+
+    def writeFailure( self, barcode, locus, attempts, kwargs, error ):
+        """
+        Record a locus that could not be phased even after retrying, with
+        the settings of the final attempt and the error that ended it
+        """
+        barcode = "0" if barcode is None else barcode
+        row = [barcode, locus, str(attempts), kwargs.get("maxReads", "N/A"),
+               kwargs.get("maxClusteringReads", "N/A"), str(error).strip()]
+        self._failureCsv.writerow( row )
+        if self._resultDb is not None:
+            self._resultDb.addFailure( *row )
+        partition = self._partition( barcode )
+        if partition is not None:
+            partition.writeFailure( barcode, locus, attempts, kwargs, error )
+            self._counts[barcode]["failures"] += 1
+
+    def close( self ):
+        with profiler.stage("results.close", unit=self._directory):
+            self._close()
+
+    def _close( self ):
+        # Barcodes left open weren't finished, so they get no marker
+        for partition in (self._partitions or {}).values():
+            partition.close()
+        self._partitions = {} if self._partitions is not None else None
+        self._goodFastq.close()
+        self._junkFastq.close()
+        for handle in self._handles:
+            handle.close()
+        self._handles = []
+        if self._resultDb is not None:
+            self._resultDb.close()
+            self._resultDb = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,110 @@
+
+import struct
+
+# A compact binary file of the subread weights of one sample, as a sparse
+#  matrix in compressed-row (CSR) form with one row per subread and one
+#  column per result.  All values are little-endian and every section
+#  starts on an 8-byte boundary, so each can be memory-mapped as an array:
+#
+#    header          MAGIC, the number of subreads, results and non-zero
+#                    weights, then the offset of each section below
+#    rowStart        uint64[subreads+1], row i's weights are [rowStart[i], rowStart[i+1])
+#    column          uint32[nonZero], the result of each weight
+#    weight          float64[nonZero]
+#    subreadOffsets  uint64[subreads+1], subread i's id is subreadNames[offsets[i]:offsets[i+1]]
+#    subreadNames    the subread ids, concatenated
+#    resultOffsets   uint64[results+1]
+#    resultNames     the result ids, concatenated
+MAGIC    = "LASPARS1"
+SECTIONS = ["rowStart", "column", "weight", "subreadOffsets", "subreadNames", "resultOffsets", "resultNames"]
+HEADER   = struct.Struct("<8s3Q7Q")
+CHUNK    = 65536        # Values packed per write
+
+def _pad( handle ):
+    handle.write( "\0" * (-handle.tell() % 8) )
+
+def _writeValues( handle, code, values ):
+    values = list(values)
+    for start in range(0, len(values), CHUNK):
+        chunk = values[start:start+CHUNK]
+        handle.write( struct.pack("<{0}{1}".format(len(chunk), code), *chunk) )
+
+def _nameOffsets( names ):
+    offsets, total = [0], 0
+    for name in names:
+        total += len(name)
+        offsets.append( total )
+    return offsets
+
+def writeSparseMatrix( handle, subreads, results, rows ):
+    """
+    Write a matrix given the ids of its 'subreads' and 'results' and, for
+    each subread in turn, a list of its (result index, weight) pairs
+    """
+    rowStart, columns, weights = [0], [], []
+    for row in rows:
+        for column, weight in row:
+            columns.append( column )
+            weights.append( weight )
+        rowStart.append( len(columns) )
+
+    offsets = {}
+    handle.write( "\0" * HEADER.size )
+    for section, code, values in (("rowStart", "Q", rowStart),
+                                  ("column",   "I", columns),
+                                  ("weight",   "d", weights)):
+        _pad( handle )
+        offsets[section] = handle.tell()
+        _writeValues( handle, code, values )
+    for section, names in (("subread", subreads), ("result", results)):
+        _pad( handle )
+        offsets[section + "Offsets"] = handle.tell()
+        _writeValues( handle, "Q", _nameOffsets( names ) )
+        _pad( handle )
+        offsets[section + "Names"] = handle.tell()
+        handle.write( "".join(names) )
+
+    handle.seek( 0 )
+    handle.write( HEADER.pack(MAGIC, len(subreads), len(results), len(columns),
+                              *[offsets[section] for section in SECTIONS]) )
+
+class SparseSubreadMatrix(object):
+    """
+    A memory-mapped sparse subread weight file.  'rowStart', 'column' and
+    'weight' are numpy arrays backed by the file, so nothing is parsed or
+    read until it's used
+    """
+
+    def __init__(self, filename):
+        import numpy as np
+        with open( filename, 'rb' ) as handle:
+            header = HEADER.unpack( handle.read( HEADER.size ) )
+        if header[0] != MAGIC:
+            raise ValueError("Not a sparse subread weight file: {0}".format(filename))
+        self.nSubreads, self.nResults, self.nonZero = header[1:4]
+        offsets = dict(zip(SECTIONS, header[4:]))
+
+        data = np.memmap( filename, dtype=np.uint8, mode='r' )
+        def array( section, dtype, count ):
+            start = offsets[section]
+            return data[start:start + count * np.dtype(dtype).itemsize].view( dtype )
+        self.rowStart        = array("rowStart", "<u8", self.nSubreads + 1)
+        self.column          = array("column", "<u4", self.nonZero)
+        self.weight          = array("weight", "<f8", self.nonZero)
+        self._subreadOffsets = array("subreadOffsets", "<u8", self.nSubreads + 1)
+        self._resultOffsets  = array("resultOffsets", "<u8", self.nResults + 1)
+        self._subreadNames   = data[offsets["subreadNames"]:]
+        self._resultNames    = data[offsets["resultNames"]:]
+
+    def subread( self, i ):
+        return self._subreadNames[self._subreadOffsets[i]:self._subreadOffsets[i+1]].tostring()
+
+    def result( self, j ):
+        return self._resultNames[self._resultOffsets[j]:self._resultOffsets[j+1]].tostring()
+
+    def row( self, i ):
+        """
+        The non-zero weights of subread 'i', by result id
+        """
+        start, end = self.rowStart[i], self.rowStart[i+1]
+        return dict((self.result(j), w) for j, w in zip(self.column[start:end], self.weight[start:end]))
@@ -0,0 +1,4 @@
+from .history   import RuntimeHistory
+from .memory    import MemoryModel
+from .planner   import Planner
+from .scheduler import PhasingScheduler, PhasingUnit
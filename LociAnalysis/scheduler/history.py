@@ -0,0 +1,140 @@
+
+import os
+import json
+import time
+import logging
+import os.path as op
+import threading
+
+from collections import defaultdict
+
+MAX_RECORDS = 20000   # Only the most recent records are used for predictions
+
+# Priors for loci with no history at all, in seconds and seconds/kb of input
+DEFAULT_OVERHEAD   = 30.0
+DEFAULT_SEC_PER_KB = 0.2
+
+def linearFit( points ):
+    """
+    Ordinary least-squares fit of y = a + b*x to a list of (x, y) points,
+    returning (a, b), or None if there aren't two distinct x-values
+    """
+    n = len(points)
+    if n < 2:
+        return None
+    meanX = sum(x for x, _ in points) / float(n)
+    meanY = sum(y for _, y in points) / float(n)
+    varX  = sum((x - meanX) ** 2 for x, _ in points)
+    if varX <= 0:
+        return None
+    slope = sum((x - meanX) * (y - meanY) for x, y in points) / varX
+    return (meanY - slope * meanX, slope)
+
+def effectiveReads( nReads, maxReads ):
+    """
+    LAA never uses more than maxReads reads, however many are available
+    """
+    if maxReads is None:
+        return int(nReads)
+    return min(int(nReads), int(maxReads))
+
+class RuntimeHistory(object):
+    """
+    A local, append-only record of the wall time, CPU time and peak memory
+    of every LAA run, keyed by locus and input size, used to predict the
+    cost of future runs.  Stored as one JSON object per line, so that
+    concurrent runs can safely append to the same file
+    """
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._lock     = threading.Lock()
+        self._byLocus  = defaultdict(list)
+        self._records  = []
+
+        if filename is not None:
+            self._load()
+
+    def _load( self ):
+        if not op.isfile( self._filename ):
+            return
+        records = []
+        with open( self._filename ) as handle:
+            for line in handle:
+                try:
+                    records.append( json.loads(line) )
+                except ValueError:
+                    continue   # e.g. a line truncated by a killed run
+        for record in records[-MAX_RECORDS:]:
+            self._add( record )
+        logging.debug("Loaded {0} historical LAA runs from '{1}'".format(len(self._records), self._filename))
+
+    def _add( self, record ):
+        self._records.append( record )
+        self._byLocus[record["locus"]].append( record )
+
+    def record( self, unit ):
+        """
+        Add the measurements from a successfully phased unit
+        """
+        proc = unit.process
+        record = {"locus":    unit.locus,
+                  "barcode":  unit.barcode,
+                  "reads":    effectiveReads(unit.nReads, unit.kwargs.get("maxReads")),
+                  "length":   unit.length,
+                  "nproc":    unit.nproc,
+                  "wallTime": round(proc.wallTime, 3),
+                  "cpuTime":  round(proc.userTime + proc.systemTime, 3),
+                  "maxRss":   proc.maxRss,
+                  "time":     int(time.time())}
+        with self._lock:
+            self._add( record )
+            if self._filename is None:
+                return
+            try:
+                dirname = op.dirname( self._filename )
+                if dirname and not op.isdir( dirname ):
+                    os.makedirs( dirname )
+                with open( self._filename, 'a' ) as handle:
+                    handle.write( json.dumps(record, sort_keys=True) + "\n" )
+            except (IOError, OSError):
+                logging.warn("Could not append to runtime history '{0}'".format(self._filename))
+
+    def memoryObservations( self ):
+        """
+        (bases, maxRss) pairs for calibrating a MemoryModel
+        """
+        with self._lock:
+            return [(r["reads"] * r["length"], r["maxRss"]) for r in self._records]
+
+    def _predict( self, records, key, kb ):
+        """
+        Fit 'key' against the kb of input for a set of records, falling back
+        to their mean rate per kb if they don't span two input sizes
+        """
+        points = [(r["reads"] * r["length"] / 1000.0, r[key]) for r in records]
+        fit = linearFit( points )
+        if fit is not None and fit[1] > 0:
+            return max(0.0, fit[0] + fit[1] * kb)
+        inputKb = sum(x for x, _ in points)
+        if inputKb > 0:
+            return sum(y for _, y in points) / inputKb * kb
+        return None
+
+    def predict( self, locus, reads, length, nproc=1, key="wallTime" ):
+        """
+        Predicted wall time (or cpuTime) in seconds of an LAA run, using in
+        order of preference the history of this locus at this nproc, of
+        this locus at any nproc, of all loci, and finally our priors
+        """
+        kb = reads * length / 1000.0
+        with self._lock:
+            locusRecords = self._byLocus.get(locus, [])
+            for records in ([r for r in locusRecords if r.get("nproc") == nproc],
+                            locusRecords, self._records):
+                if not records:
+                    continue
+                predicted = self._predict( records, key, kb )
+                if predicted is not None:
+                    return predicted
+        return DEFAULT_OVERHEAD + DEFAULT_SEC_PER_KB * kb
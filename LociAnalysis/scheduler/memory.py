@@ -0,0 +1,91 @@
+
+import json
+import logging
+import os.path as op
+import threading
+
+from LociAnalysis.scheduler.history import linearFit, effectiveReads
+
+MB = 1024 * 1024
+
+# Priors used until we have observations of our own, deliberately on the
+#  generous side since under-estimating is what gets a node OOM-killed
+DEFAULT_BASELINE       = 256 * MB
+DEFAULT_BYTES_PER_BASE = 400.0
+SAFETY_FACTOR          = 1.25
+MAX_OBSERVATIONS       = 500
+
+class MemoryModel(object):
+    """
+    A linear model of the peak memory used by a single LAA process, as a
+    function of the number of bases it will actually load, i.e. the number
+    of reads (capped by maxReads) times the length of the amplicon
+    """
+
+    def __init__(self, filename=None, observations=None):
+        self._filename     = filename
+        self._observations = list(observations or [])[-MAX_OBSERVATIONS:]
+        self._lock         = threading.Lock()
+        self._baseline     = DEFAULT_BASELINE
+        self._bytesPerBase = DEFAULT_BYTES_PER_BASE
+
+        if filename is not None and op.isfile(filename):
+            self._load()
+        else:
+            self._fit()
+
+    def _load( self ):
+        try:
+            with open( self._filename ) as handle:
+                for obs in json.load( handle ):
+                    self._observations.append( (int(obs["bases"]), int(obs["maxRss"])) )
+        except (IOError, ValueError, KeyError, TypeError):
+            logging.warn("Could not read memory model observations from '{0}', ignoring them".format(self._filename))
+            self._observations = []
+        self._observations = self._observations[-MAX_OBSERVATIONS:]
+        self._fit()
+        logging.debug("Loaded {0} memory observations from '{1}'".format(len(self._observations), self._filename))
+
+    def save( self ):
+        if self._filename is None:
+            return
+        with self._lock:
+            data = [{"bases": b, "maxRss": m} for b, m in self._observations]
+        try:
+            with open( self._filename, 'w' ) as handle:
+                json.dump( data, handle )
+        except IOError:
+            logging.warn("Could not write memory model observations to '{0}'".format(self._filename))
+
+    def _fit( self ):
+        """
+        Least-squares fit of maxRss against bases, keeping our priors until
+        we have observations of at least two different input sizes
+        """
+        fit = linearFit( self._observations )
+        if fit is None or fit[1] <= 0:
+            return
+        self._baseline     = max(0.0, fit[0])
+        self._bytesPerBase = fit[1]
+
+    @staticmethod
+    def bases( nReads, length, maxReads ):
+        return effectiveReads(nReads, maxReads) * int(length)
+
+    def estimate( self, nReads, length, maxReads=None ):
+        """
+        Predicted peak memory in bytes of an LAA run on 'nReads' reads from
+        an amplicon of 'length' bp
+        """
+        with self._lock:
+            predicted = self._baseline + self._bytesPerBase * self.bases(nReads, length, maxReads)
+        return int(predicted * SAFETY_FACTOR)
+
+    def observe( self, nReads, length, maxReads, maxRss ):
+        """
+        Record the measured peak memory of a finished LAA run and re-fit
+        """
+        with self._lock:
+            self._observations.append( (self.bases(nReads, length, maxReads), int(maxRss)) )
+            del self._observations[:-MAX_OBSERVATIONS]
+            self._fit()
@@ -0,0 +1,59 @@
+
+import heapq
+
+from LociAnalysis.scheduler.history import effectiveReads
+
+def formatDuration( seconds ):
+    seconds = int(round(seconds))
+    hours, seconds   = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return "{0}h{1:02d}m{2:02d}s".format(hours, minutes, seconds)
+
+class Planner(object):
+    """
+    Predict the cost of each PhasingUnit from the RuntimeHistory and order
+    them longest-first, so the slowest units don't start last and leave
+    the rest of the node idle while they finish
+    """
+
+    def __init__(self, history, slots=1):
+        self._history = history
+        self._slots   = max(1, slots)
+
+    def _predict( self, unit ):
+        reads = effectiveReads(unit.nReads, unit.kwargs.get("maxReads"))
+        return self._history.predict(unit.locus, reads, unit.length, unit.nproc)
+
+    def plan( self, units ):
+        """
+        Annotate the units with their predicted wall time and return them
+        in the order they should be started: longest first, ties broken by
+        their output order
+        """
+        for unit in units:
+            unit.predicted = self._predict( unit )
+        return sorted(units, key=lambda u: (-u.predicted, u.index))
+
+    def makespan( self, units ):
+        """
+        Simulate running the planned units on our slots, assigning each in
+        turn to the slot that frees up first
+        """
+        slots = [0.0] * self._slots
+        for unit in units:
+            heapq.heapreplace(slots, slots[0] + unit.predicted)
+        return max(slots)
+
+    def report( self, units ):
+        """
+        A human-readable summary of the plan, e.g. for a dry run
+        """
+        ordered = self.plan( units )
+        total = sum(u.predicted for u in ordered)
+        lines = ["Planned {0} LAA run(s) on {1} concurrent slot(s)".format(len(ordered), self._slots),
+                 "  Estimated total LAA time : {0}".format(formatDuration(total)),
+                 "  Estimated wall time      : {0}".format(formatDuration(self.makespan(ordered))),
+                 "  Longest runs:"]
+        for unit in ordered[:10]:
+            lines.append("    {0:>10}  {1} ({2} reads)".format(formatDuration(unit.predicted), unit.name, unit.nReads))
+        return "\n".join(lines)
@@ -0,0 +1,193 @@
+
+import os
+import sys
+import signal
+import logging
+import threading
+
+from LociAnalysis.process import currentRss
+from LociAnalysis.profiling import profiler
+
+ADMISSION_POLL = 1.0    # Seconds between re-checks of memory usage while a unit waits
+MB = 1024 * 1024
+
+class PhasingUnit(object):
+    """
+    A single LAA run - one locus from one barcode - along with everything
+    needed to run it, and its outcome once it has been run
+    """
+
+    def __init__(self, index, barcode, locus, whitelist, kwargs, nReads=0, length=0, nproc=1, job=None,
+                 inputFn=None):
+        self.index     = index      # Position of the unit in the output order
+        self.job       = job        # The analysis (input dataset) the unit belongs to
+        self.inputFn   = inputFn if inputFn is not None or job is None else job.inputFn
+        self.barcode   = barcode
+        self.locus     = locus
+        self.whitelist = whitelist
+        self.kwargs    = kwargs
+        self.nReads    = nReads
+        self.length    = length
+        self.nproc     = nproc
+        self.memory    = 0          # Estimated peak memory, in bytes
+        self.predicted = None       # Predicted wall time, in seconds
+        self.pid       = None       # PID of the running LAA process, if any
+        self.attempts  = 0
+        self.process   = None       # ProcessResult of the successful LAA run
+        self.results   = None
+        self.error     = None
+        self.excInfo   = None
+
+    def started( self, pid ):
+        self.pid = pid
+
+    @property
+    def name(self):
+        if self.barcode is None:
+            return "locus '{0}'".format(self.locus)
+        return "locus '{0}' for barcode '{1}'".format(self.locus, self.barcode)
+
+class PhasingScheduler(object):
+    """
+    Run PhasingUnits concurrently, starting a new unit only while both the
+    number of running units and their estimated memory usage are within
+    our limits, and hand back the finished units in the order of their
+    indices regardless of the order in which they completed.  The memory
+    charged against the limit for a running unit is the larger of its
+    estimate and the actual RSS of its LAA process.  If given, units are
+    also held back while 'scratch' is short of disk space, and 'monitor'
+    is told as each unit starts and finishes
+    """
+
+    def __init__(self, runUnit, maxUnits=1, memoryLimit=0, memoryModel=None, history=None, monitor=None,
+                 scratch=None):
+        self._runUnit     = runUnit
+        self._maxUnits    = max(1, maxUnits)
+        self._memoryLimit = memoryLimit
+        self._memoryModel = memoryModel
+        self._history     = history
+        self._monitor     = monitor
+        self._scratch     = scratch
+        self._cond        = threading.Condition()
+        self._running     = []
+        self._finished    = {}
+        self._dispatched  = 0
+        self._exhausted   = False
+        self._stop        = False
+        self._excInfo     = None
+
+    def _memoryInUse( self ):
+        used = 0
+        for unit in self._running:
+            rss = currentRss(unit.pid) if unit.pid is not None else None
+            used += max(unit.memory, rss or 0)
+        return used
+
+    def _admits( self, unit ):
+        # Always allow one unit to run, or a single large unit could never start
+        if not self._running:
+            return True
+        if len(self._running) >= self._maxUnits:
+            return False
+        if self._scratch is not None and not self._scratch.hasRoom():
+            logging.debug("Waiting for space in '{0}' to start {1}".format(self._scratch.root, unit.name))
+            return False
+        if self._memoryLimit <= 0:
+            return True
+        return self._memoryInUse() + unit.memory <= self._memoryLimit
+
+    def _estimate( self, unit ):
+        if self._memoryModel is None:
+            return 0
+        return self._memoryModel.estimate(unit.nReads, unit.length, unit.kwargs.get("maxReads"))
+
+    def _dispatch( self, units ):
+        try:
+            for unit in units:
+                unit.memory = self._estimate( unit )
+                with self._cond:
+                    while not self._stop and not self._admits( unit ):
+                        self._cond.wait( ADMISSION_POLL )
+                    if self._stop:
+                        return
+                    if 0 < self._memoryLimit < unit.memory:
+                        logging.warn("Estimated memory for {0} ({1}MB) exceeds the memory limit, running it alone".format(
+                                     unit.name, unit.memory // MB))
+                    logging.debug("Starting {0} with an estimated {1}MB, {2} unit(s) already running".format(
+                                  unit.name, unit.memory // MB, len(self._running)))
+                    self._running.append( unit )
+                    self._dispatched += 1
+                if self._monitor is not None:
+                    self._monitor.unitStarted( unit )
+                worker = threading.Thread(target=self._work, args=(unit,))
+                worker.daemon = True
+                worker.start()
+        except Exception:
+            self._excInfo = sys.exc_info()
+        finally:
+            with self._cond:
+                self._exhausted = True
+                self._cond.notify_all()
+
+    def _work( self, unit ):
+        try:
+            with profiler.threadProfile():
+                self._runUnit( unit )
+            if unit.process is not None:
+                if self._memoryModel is not None:
+                    self._memoryModel.observe(unit.nReads, unit.length, unit.kwargs.get("maxReads"), unit.process.maxRss)
+                if self._history is not None:
+                    self._history.record( unit )
+        except Exception:
+            unit.excInfo = sys.exc_info()
+        finally:
+            if self._monitor is not None:
+                self._monitor.unitFinished( unit )
+            with self._cond:
+                unit.pid = None
+                self._running.remove( unit )
+                self._finished[unit.index] = unit
+                self._cond.notify_all()
+
+    def _terminateRunning( self ):
+        with self._cond:
+            self._stop = True
+            for unit in self._running:
+                if unit.pid is not None:
+                    logging.warn("Terminating LAA for {0}".format(unit.name))
+                    try:
+                        os.kill(unit.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+            self._cond.notify_all()
+
+    def run( self, units ):
+        """
+        Generator over the finished units.  Units are pulled lazily from
+        'units' as capacity becomes available, and must be indexed 0..N-1
+        """
+        dispatcher = threading.Thread(target=self._dispatch, args=(iter(units),))
+        dispatcher.daemon = True
+        dispatcher.start()
+
+        nextIndex = 0
+        try:
+            while True:
+                with self._cond:
+                    while nextIndex not in self._finished and self._excInfo is None and \
+                            not (self._exhausted and nextIndex >= self._dispatched):
+                        self._cond.wait( ADMISSION_POLL )
+                    if self._excInfo is not None:
+                        raise self._excInfo[0], self._excInfo[1], self._excInfo[2]
+                    if nextIndex not in self._finished:
+                        break
+                    unit = self._finished.pop( nextIndex )
+                if unit.excInfo is not None:
+                    raise unit.excInfo[0], unit.excInfo[1], unit.excInfo[2]
+                yield unit
+                nextIndex += 1
+        finally:
+            # If the caller gave up on us early, don't leave LAA running
+            if not (self._exhausted and nextIndex >= self._dispatched):
+                self._terminateRunning()
+                dispatcher.join( 2 * ADMISSION_POLL )
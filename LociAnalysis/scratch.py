@@ -0,0 +1,72 @@
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import os.path as op
+
+MB = 1024 * 1024
+
+class ScratchManager(object):
+    """
+    Hands out workspaces for LAA runs under one root directory, ideally a
+    fast local disk or tmpfs, and tracks them so that none are left behind.
+    Units are only admitted while the root has more than 'minFree' bytes
+    free, and with 'keepFailed' the workspaces of failed runs are kept
+    for debugging instead of being deleted
+    """
+
+    def __init__(self, root=None, minFree=0, keepFailed=False):
+        self.root        = root or tempfile.gettempdir()
+        self._minFree    = minFree
+        self._keepFailed = keepFailed
+        self._lock       = threading.Lock()
+        self._active     = set()
+        if not op.isdir( self.root ):
+            try:
+                os.makedirs( self.root )
+            except OSError:
+                msg = "Could not create scratch directory: {0}".format(self.root)
+                logging.error( msg )
+                raise RuntimeError( msg )
+
+    def freeBytes( self ):
+        stat = os.statvfs( self.root )
+        return stat.f_bavail * stat.f_frsize
+
+    def hasRoom( self ):
+        return self._minFree <= 0 or self.freeBytes() >= self._minFree
+
+    def alignmentDir( self, inputFn ):
+        """
+        A directory for the alignments and whitelists of an input, named
+        after the input but unique to its full path.  Unlike workspaces,
+        these are kept, so later runs on the same input can reuse them
+        """
+        key = hashlib.md5( op.abspath( inputFn ) ).hexdigest()[:8]
+        return op.join( self.root, "{0}.{1}_aln".format(op.basename( inputFn ), key) )
+
+    def create( self, prefix="laa." ):
+        path = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+        with self._lock:
+            self._active.add( path )
+        return path
+
+    def release( self, path, failed=False ):
+        with self._lock:
+            self._active.discard( path )
+        if failed and self._keepFailed:
+            logging.warn("Keeping the workspace of a failed LAA run: {0}".format(path))
+            return
+        shutil.rmtree( path, ignore_errors=True )
+
+    def cleanup( self ):
+        """
+        Remove any workspaces still in use, e.g. after a run was aborted
+        """
+        with self._lock:
+            active, self._active = self._active, set()
+        for path in active:
+            shutil.rmtree( path, ignore_errors=True )
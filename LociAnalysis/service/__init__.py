@@ -0,0 +1 @@
+from .service import AnalysisService, LruCache, WarmAnalysis, main
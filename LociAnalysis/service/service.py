@@ -0,0 +1,547 @@
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import hashlib
+import signal
+import logging
+import argparse
+import threading
+import os.path as op
+
+from collections import OrderedDict, deque
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn, UnixStreamServer
+
+from LociAnalysis.options import parseOptions
+from LociAnalysis.refdb import RefDb
+from LociAnalysis.scratch import ScratchManager
+from LociAnalysis.whitelistdb import WhitelistDb, getAligner
+from LociAnalysis.main import LociAnalysis   # Also enables TRACE-level logging
+
+POLL        = 0.5       # Seconds between checks on running jobs
+MAX_JOBS    = 1000      # Finished jobs remembered for status queries
+STATES      = ["queued", "binning", "running", "done", "failed", "cancelled"]
+
+class LruCache(object):
+    """
+    A thread-safe mapping that evicts its least-recently used entries
+    once it holds more than 'maxSize' of them.  Each value is only built
+    once, however many threads ask for it while it's being built
+    """
+
+    def __init__(self, maxSize):
+        self._maxSize   = max(1, maxSize)
+        self._entries   = OrderedDict()
+        self._lock      = threading.Lock()
+        self._building  = {}
+        self.hits       = 0
+        self.misses     = 0
+        self.evictions  = 0
+
+    def get( self, key, build ):
+        """
+        Return the value for 'key', calling 'build' to create it if needed
+        """
+        with self._lock:
+            if key in self._entries:
+                return self._hit( key )
+            building = self._building.setdefault( key, threading.Lock() )
+        # Only one thread builds a key, the rest wait here for its value
+        with building:
+            with self._lock:
+                if key in self._entries:
+                    return self._hit( key )
+                self.misses += 1
+            try:
+                value = build()
+            except:
+                with self._lock:
+                    self._building.pop( key, None )
+                raise
+            with self._lock:
+                self._building.pop( key, None )
+                self._entries[key] = value
+                while len(self._entries) > self._maxSize:
+                    self._entries.popitem( last=False )
+                    self.evictions += 1
+            return value
+
+    def _hit( self, key ):
+        self.hits += 1
+        value = self._entries.pop( key )
+        self._entries[key] = value
+        return value
+
+    def stats( self ):
+        with self._lock:
+            return {"size":      len(self._entries),
+                    "maxSize":   self._maxSize,
+                    "hits":      self.hits,
+                    "misses":    self.misses,
+                    "evictions": self.evictions}
+
+class ServiceJob(object):
+    """
+    One LociAnalysis run submitted to the service
+    """
+
+    def __init__(self, jobId, args, opts):
+        self.id         = jobId
+        self.args       = args
+        self.options    = opts
+        self.state      = "queued"
+        self.cancelled  = False
+        self.pid        = None
+        self.returncode = None
+        self.error      = None
+        self.submitted  = time.time()
+        self.started    = None
+        self.finished   = None
+
+    @property
+    def outputs(self):
+        directory = self.options.outputDirectory
+        if not op.isdir( directory ):
+            return []
+        return sorted(op.join(directory, fn) for fn in os.listdir( directory ) if fn.startswith("loci_analysis"))
+
+    def toDict( self ):
+        return {"id":              self.id,
+                "state":           self.state,
+                "args":            self.args,
+                "input":           self.options.inputFilename,
+                "outputDirectory": self.options.outputDirectory,
+                "outputs":         self.outputs if self.state in ("done", "failed") else [],
+                "log":             op.join(self.options.outputDirectory, "loci_analysis.log"),
+                "pid":             self.pid,
+                "returncode":      self.returncode,
+                "error":           self.error,
+                "submitted":       self.submitted,
+                "started":         self.started,
+                "finished":        self.finished}
+
+class WarmAnalysis(LociAnalysis):
+    """
+    A LociAnalysis that uses the reference and bins already built by the
+    service, rather than building its own
+    """
+
+    def __init__(self, refDb, whitelistDb):
+        super(WarmAnalysis, self).__init__()
+        self._warmRefDb       = refDb
+        self._warmWhitelistDb = whitelistDb
+
+    def _buildRefDb(self):
+        return self._warmRefDb
+
+    def _buildWhitelistDb(self, job):
+        return self._warmWhitelistDb
+
+def _fork():
+    """
+    fork(), holding the logging locks so that the child can't inherit
+    one that another thread of the service held at the time
+    """
+    handlers = list(logging.getLogger().handlers)
+    logging._acquireLock()
+    for handler in handlers:
+        handler.acquire()
+    try:
+        return os.fork()
+    finally:
+        for handler in reversed(handlers):
+            handler.release()
+        logging._releaseLock()
+
+class AnalysisService(object):
+    """
+    Queue submitted LociAnalysis jobs and run them, at most 'workers' at a
+    time.  Each job's reads are binned in the service, on a thread of its
+    own, so that the RefDb and WhitelistDb can be cached across jobs, and
+    it is then phased in a forked child process that inherits them along
+    with its own options
+    """
+
+    def __init__(self, workers=2, refCacheSize=4, binCacheSize=8):
+        self._workers   = max(1, workers)
+        self._refDbs    = LruCache( refCacheSize )
+        self._bins      = LruCache( binCacheSize )
+        self._cond      = threading.Condition()
+        self._jobs      = OrderedDict()
+        self._queue     = deque()
+        self._running   = {}
+        self._binning   = 0
+        self._binners   = []
+        self._nextId    = 1
+        self._stop      = False
+        self._started   = time.time()
+
+        self._dispatcher = threading.Thread(target=self._dispatch)
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def submit( self, args ):
+        """
+        Queue a job given the command-line arguments of a LociAnalysis
+        run, raising a ValueError if they are invalid
+        """
+        if not isinstance(args, list) or not all(isinstance(a, basestring) for a in args):
+            raise ValueError("'args' must be a list of command-line arguments")
+        # JSON strings are unicode, but the command-line never is
+        args = [a.encode("utf-8") if isinstance(a, unicode) else a for a in args]
+        try:
+            opts = parseOptions( args, argparse.Namespace() )
+        except SystemExit:
+            raise ValueError("invalid arguments: {0}".format(" ".join(args)))
+        if opts.batch:
+            raise ValueError("batch mode is not supported by the service, submit each dataset as a job")
+        if opts.watch:
+            raise ValueError("watch mode is not supported by the service, submit each dataset as a job")
+        if opts.dryRun or opts.writeShards:
+            raise ValueError("planning runs (--dryRun, --writeShards) are not supported by the service")
+
+        with self._cond:
+            job = ServiceJob( self._nextId, args, opts )
+            self._nextId += 1
+            self._jobs[job.id] = job
+            self._queue.append( job )
+            self._pruneJobs()
+            self._cond.notify_all()
+        logging.info("Queued job {0} for '{1}'".format(job.id, opts.inputFilename))
+        return job.toDict()
+
+    def cancel( self, jobId ):
+        with self._cond:
+            job = self._jobs.get( jobId )
+            if job is None:
+                return None
+            if job.state == "queued":
+                self._queue.remove( job )
+                job.cancelled = True
+                self._finish( job, "cancelled" )
+            elif job.state == "binning":
+                # Binning can't be interrupted, but its bins are cached for
+                #  other jobs anyway, so let it finish and never start the job
+                job.cancelled = True
+                job.error = "cancelled"
+                self._finish( job, "cancelled" )
+            elif job.state == "running":
+                logging.info("Cancelling job {0}".format(job.id))
+                job.cancelled = True
+                try:
+                    os.killpg( job.pid, signal.SIGTERM )
+                except OSError:
+                    pass
+                job.error = "cancelled"
+            return job.toDict()
+
+    def job( self, jobId ):
+        with self._cond:
+            job = self._jobs.get( jobId )
+            return None if job is None else job.toDict()
+
+    def jobs( self ):
+        with self._cond:
+            return [job.toDict() for job in self._jobs.values()]
+
+    def status( self ):
+        with self._cond:
+            counts = dict((state, 0) for state in STATES)
+            for job in self._jobs.values():
+                counts[job.state] += 1
+            return {"pid":      os.getpid(),
+                    "uptime":   time.time() - self._started,
+                    "workers":  self._workers,
+                    "jobs":     counts,
+                    "caches":   {"refDb":       self._refDbs.stats(),
+                                 "whitelistDb": self._bins.stats()}}
+
+    def shutdown( self ):
+        with self._cond:
+            self._stop = True
+            for job in self._running.values():
+                try:
+                    os.killpg( job.pid, signal.SIGTERM )
+                except OSError:
+                    pass
+            self._cond.notify_all()
+        self._dispatcher.join()
+        for binner in self._binners:
+            binner.join()
+        with self._cond:
+            while self._running:
+                self._cond.wait( POLL )
+                self._reap()
+
+    def _pruneJobs( self ):
+        finished = [j for j in self._jobs.values() if j.finished is not None]
+        for job in finished[:max(0, len(finished) - MAX_JOBS)]:
+            del self._jobs[job.id]
+
+    def _finish( self, job, state ):
+        job.state    = state
+        job.finished = time.time()
+        logging.info("Job {0} {1}".format(job.id, state))
+
+    def _reap( self ):
+        for pid, job in self._running.items():
+            try:
+                waited, status = os.waitpid(pid, os.WNOHANG)
+            except OSError as error:
+                if error.errno != errno.ECHILD:
+                    raise
+                waited, status = pid, 0
+            if waited == 0:
+                continue
+            del self._running[pid]
+            job.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            if job.finished is not None:
+                # Cancelled while its child was being forked
+                continue
+            elif job.cancelled:
+                self._finish( job, "cancelled" )
+            elif job.returncode == 0:
+                self._finish( job, "done" )
+            else:
+                job.error = job.error or "exited with code {0}, see '{1}'".format(job.returncode, job.toDict()["log"])
+                self._finish( job, "failed" )
+        self._cond.notify_all()
+
+    def _dispatch( self ):
+        while True:
+            with self._cond:
+                self._reap()
+                # Jobs being binned count against the workers too, as binning runs the aligner
+                while not self._stop and (not self._queue or len(self._running) + self._binning >= self._workers):
+                    self._cond.wait( POLL )
+                    self._reap()
+                if self._stop:
+                    return
+                job = self._queue.popleft()
+                job.state   = "binning"
+                job.started = time.time()
+                self._binning += 1
+                self._binners = [binner for binner in self._binners if binner.is_alive()]
+            binner = threading.Thread(target=self._bin, args=(job,), name="Binner-{0}".format(job.id))
+            binner.daemon = True
+            binner.start()
+            self._binners.append( binner )
+
+    def _bin( self, job ):
+        try:
+            self._start( job )
+        except Exception as error:
+            logging.exception("Job {0} failed while binning".format(job.id))
+            with self._cond:
+                if job.finished is None:
+                    job.error = str(error)
+                    self._finish( job, "failed" )
+        finally:
+            with self._cond:
+                self._binning -= 1
+                self._cond.notify_all()
+
+    def _refDb( self, opts ):
+        directory = op.realpath( opts.referenceDirectory )
+        return self._refDbs.get( directory, lambda : RefDb( directory ) )
+
+    def _whitelistDb( self, opts, refDb ):
+        inputFn  = op.realpath( opts.inputFilename )
+        combined = tuple(sorted((k, tuple(v)) for k, v in (opts.combineLoci or {}).iteritems()))
+        aligner  = getAligner( opts.aligner, opts.alignmentFormat )
+        key = (inputFn, os.stat(inputFn).st_mtime, op.realpath(opts.referenceDirectory), combined, aligner.key)
+        # The whitelists are written to the alignment directory, so each reference set, aligner
+        #  and combination of loci binned from the same input needs a directory of its own
+        alnDir = ScratchManager( opts.scratchDir ).alignmentDir( opts.inputFilename ) if opts.scratchDir \
+                 else opts.inputFilename + "_aln"
+        alnDir += "." + hashlib.md5( repr(key[2:]) ).hexdigest()[:8]
+        return self._bins.get( key, lambda : WhitelistDb(refDb, opts.inputFilename, alnDir=alnDir,
+                                                         combined=opts.combineLoci, nproc=opts.nproc,
+                                                         aligner=aligner) )
+
+    def _start( self, job ):
+        refDb       = self._refDb( job.options )
+        whitelistDb = self._whitelistDb( job.options, refDb )
+        with self._cond:
+            if job.cancelled or self._stop:
+                if job.finished is None:
+                    job.error = "cancelled"
+                    self._finish( job, "cancelled" )
+                return
+        # Fork without holding the lock, which the child would inherit held
+        pid = _fork()
+        if pid == 0:
+            self._runChild( job, refDb, whitelistDb )
+        # The child does this too, but a cancel can reach us before it has
+        try:
+            os.setpgid( pid, pid )
+        except OSError:
+            pass
+        with self._cond:
+            job.pid = pid
+            self._running[pid] = job
+            if job.cancelled or self._stop:
+                # Cancelled, or the service stopped, while it was forked
+                job.cancelled = True
+                try:
+                    os.killpg( pid, signal.SIGTERM )
+                except OSError:
+                    pass
+                return
+            job.state = "running"
+        logging.info("Started job {0} in process {1}".format(job.id, pid))
+
+    def _runChild( self, job, refDb, whitelistDb ):
+        """
+        Run a job in a freshly forked child, never returning
+        """
+        code = 1
+        try:
+            # Make the child the leader of a process group, so cancelling
+            #  the job also stops its LAA processes
+            os.setpgid(0, 0)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            handler = logging.FileHandler( op.join(job.options.outputDirectory, "loci_analysis.log") )
+            handler.setFormatter( logging.Formatter(">|> %(asctime)s -|- %(levelname)s -|- %(lineno)d -|--|- %(message)s") )
+            logging.getLogger().addHandler( handler )
+            WarmAnalysis( refDb, whitelistDb ).main( job.args )
+            code = 0
+        except SystemExit as error:
+            code = error.code if isinstance(error.code, int) else 1
+        except BaseException:
+            logging.exception("Job {0} failed".format(job.id))
+        finally:
+            logging.shutdown()
+            os._exit( code )
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """
+    A small JSON API over the service:
+        GET    /status      Service, queue and cache statistics
+        GET    /jobs        Every job
+        POST   /jobs        Submit a job, with body {"args": [...]}
+        GET    /jobs/<id>   One job, with its outputs once finished
+        DELETE /jobs/<id>   Cancel a job
+    """
+
+    JOB_PATH = re.compile(r"^/jobs/(\d+)$")
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logging.debug("{0} {1}".format(self.address_string(), format % args))
+
+    def _reply( self, code, body ):
+        content = json.dumps(body, indent=2, sort_keys=True) + "\n"
+        self.send_response( code )
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write( content )
+
+    def _jobId( self ):
+        match = self.JOB_PATH.match( self.path.rstrip('/') )
+        return int(match.group(1)) if match else None
+
+    def do_GET(self):
+        service = self.server.service
+        path = self.path.rstrip('/')
+        if path == "/status":
+            return self._reply(200, service.status())
+        if path == "/jobs":
+            return self._reply(200, service.jobs())
+        jobId = self._jobId()
+        job = service.job( jobId ) if jobId is not None else None
+        if job is None:
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, job)
+
+    def do_POST(self):
+        if self.path.rstrip('/') != "/jobs":
+            return self._reply(404, {"error": "not found"})
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            request = json.loads( self.rfile.read( length ) )
+            job = self.server.service.submit( request.get("args") )
+        except (ValueError, AttributeError) as error:
+            return self._reply(400, {"error": str(error)})
+        self._reply(201, job)
+
+    def do_DELETE(self):
+        jobId = self._jobId()
+        job = self.server.service.cancel( jobId ) if jobId is not None else None
+        if job is None:
+            return self._reply(404, {"error": "not found"})
+        self._reply(200, job)
+
+class ServiceHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ServiceUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def parseArguments( args=None ):
+    desc = "Serve LociAnalysis runs from a job queue, keeping references and read bins in memory"
+    parser = argparse.ArgumentParser(description=desc)
+    parser.add_argument("--host", default="127.0.0.1", metavar="STRING",
+                        help="Address to listen on. Default = 127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765, metavar="INT",
+                        help="HTTP port to listen on. Default = 8765")
+    parser.add_argument("--socket", metavar="STRING",
+                        help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--workers", type=int, default=2, metavar="INT",
+                        help="Jobs to run concurrently. Default = 2")
+    parser.add_argument("--refCacheSize", type=int, default=4, metavar="INT",
+                        help="Reference databases to keep in memory. Default = 4")
+    parser.add_argument("--binCacheSize", type=int, default=8, metavar="INT",
+                        help="Datasets' read bins to keep in memory. Default = 8")
+    parser.add_argument("--verbose", "-v", dest="verbosity", action="count", default=0,
+                        help="Set the verbosity level")
+    return parser.parse_args( args )
+
+def main( args=None ):
+    opts = parseArguments( args )
+    logLevel = [logging.WARNING, logging.INFO, logging.DEBUG, logging.TRACE][min(opts.verbosity, 3)]
+    logging.basicConfig(level=logLevel, format=">|> %(asctime)s -|- %(levelname)s -|- %(lineno)d -|--|- %(message)s")
+
+    service = AnalysisService(opts.workers, opts.refCacheSize, opts.binCacheSize)
+    if opts.socket:
+        if op.exists( opts.socket ):
+            os.unlink( opts.socket )
+        server = ServiceUnixServer( opts.socket, ServiceRequestHandler )
+        address = opts.socket
+    else:
+        server = ServiceHTTPServer( (opts.host, opts.port), ServiceRequestHandler )
+        address = "http://{0}:{1}".format(opts.host, server.server_port)
+    server.service = service
+
+    def stop( signum, frame ):
+        # shutdown() blocks until serve_forever() returns, so call it elsewhere
+        threading.Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.warn("LociAnalysis service listening on {0}".format(address))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        service.shutdown()
+        if opts.socket and op.exists( opts.socket ):
+            os.unlink( opts.socket )
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+
+import os
+import csv
+import glob
+import gzip
+import heapq
+import json
+import logging
+import argparse
+import itertools
+import os.path as op
+
+from LociAnalysis.results.bgzf import BgzfWriter, SUFFIX, compressionPool
+from LociAnalysis.results.result_writer import (SUMMARY_HEADER, FAILURE_HEADER,
+                                                SUBREAD_ROOTS, NumReadsLambda)
+
+UNITS_FILE  = "loci_analysis_units.csv"
+SHARD_FILE  = "loci_analysis_shard.json"
+UNITS_HEADER = ["Index", "BarcodeName", "Locus", "Results", "NoiseResults", "Failures"]
+
+def assignShards( units, shards ):
+    """
+    Split planned units between shards, giving each unit in turn (longest
+    predicted first) to the shard with the least predicted work so far.
+    Returns a list of unit lists, each in output order
+    """
+    loads = [(0.0, shard) for shard in range(shards)]
+    assigned = [[] for _ in range(shards)]
+    for unit in sorted(units, key=lambda u: (-(u.predicted or 0.0), u.index)):
+        load, shard = heapq.heappop( loads )
+        assigned[shard].append( unit )
+        heapq.heappush( loads, (load + (unit.predicted or 0.0), shard) )
+    return [sorted(shardUnits, key=lambda u: u.index) for shardUnits in assigned]
+
+def writeShardSpecs( directory, assigned, totalUnits, inputFn, referenceDirectory ):
+    """
+    Write one JSON specification per shard, listing the units it should run
+    """
+    if not op.isdir( directory ):
+        os.makedirs( directory )
+    filenames = []
+    for shard, units in enumerate(assigned):
+        spec = {"shard":              shard,
+                "shards":             len(assigned),
+                "inputFilename":      inputFn,
+                "referenceDirectory": referenceDirectory,
+                "totalUnits":         totalUnits,
+                "predicted":          sum(u.predicted or 0.0 for u in units),
+                "units":              [[u.index, u.barcode, u.locus] for u in units]}
+        filename = op.join(directory, "shard_{0}.json".format(shard))
+        with open(filename, 'w') as handle:
+            json.dump(spec, handle, indent=2, sort_keys=True)
+        filenames.append( filename )
+    return filenames
+
+def readShardSpec( filename ):
+    try:
+        with open( filename ) as handle:
+            return json.load( handle )
+    except (IOError, OSError, ValueError) as error:
+        msg = "Could not read shard specification '{0}': {1}".format(filename, error)
+        logging.error( msg )
+        raise RuntimeError( msg )
+
+def selectShardUnits( spec, units, inputFn, referenceDirectory ):
+    """
+    Pick the units of a shard out of the full list of units, checking that
+    the list is the one the shards were planned from, of the same input and
+    references.  Returns the units, re-indexed in output order, and their
+    indices in the full list
+    """
+    for key, value in (("inputFilename", inputFn), ("referenceDirectory", referenceDirectory)):
+        if op.realpath( spec[key] ) != op.realpath( value ):
+            msg = "Shard specification was planned with {0} '{1}', but this run has '{2}'".format(key, spec[key], value)
+            logging.error( msg )
+            raise RuntimeError( msg )
+    if spec["totalUnits"] != len(units):
+        msg = "Shard specification is for {0} units, but found {1}; was it planned with different options?".format(
+              spec["totalUnits"], len(units))
+        logging.error( msg )
+        raise RuntimeError( msg )
+    selected, indices = [], []
+    for index, barcode, locus in spec["units"]:
+        unit = units[index]
+        if (unit.barcode, unit.locus) != (barcode, locus):
+            msg = "Shard unit {0} should be locus '{1}' for barcode '{2}', but is {3}".format(index, locus, barcode, unit.name)
+            logging.error( msg )
+            raise RuntimeError( msg )
+        unit.index = len(selected)
+        selected.append( unit )
+        indices.append( index )
+    return selected, indices
+
+class ShardIndexWriter(object):
+    """
+    Record which results in a shard's outputs came from which unit, so that
+    the outputs of every shard can later be merged in output order
+    """
+
+    def __init__(self, directory, spec, indices):
+        self._directory = directory
+        self._spec      = spec
+        self._indices   = indices
+        self._handle    = open(op.join(directory, UNITS_FILE), 'wb')
+        self._writer    = csv.writer( self._handle )
+        self._writer.writerow( UNITS_HEADER )
+        self._written   = 0
+
+    def writeUnit( self, unit ):
+        results = unit.results or []
+        noise = sum(1 for r in results if r.isJunk)
+        self._writer.writerow([self._indices[unit.index], unit.barcode or "", unit.locus,
+                               len(results) - noise, noise, int(unit.error is not None)])
+        self._written += 1
+
+    def close( self ):
+        """
+        Mark the shard as complete
+        """
+        self._handle.close()
+        marker = dict(self._spec)
+        marker["completedUnits"] = self._written
+        with open(op.join(self._directory, SHARD_FILE), 'w') as handle:
+            json.dump(marker, handle, indent=2, sort_keys=True)
+
+def _readShard( directory ):
+    marker = op.join(directory, SHARD_FILE)
+    if not op.isfile( marker ):
+        msg = "Shard output '{0}' is incomplete or not a shard".format(directory)
+        logging.error( msg )
+        raise RuntimeError( msg )
+    with open( marker ) as handle:
+        spec = json.load( handle )
+    if spec["completedUnits"] != len(spec["units"]):
+        msg = "Shard output '{0}' has {1} of its {2} units".format(directory, spec["completedUnits"], len(spec["units"]))
+        logging.error( msg )
+        raise RuntimeError( msg )
+    return spec
+
+def _unitRows( directory, shard ):
+    with open(op.join(directory, UNITS_FILE)) as handle:
+        reader = csv.reader( handle )
+        next(reader)
+        for row in reader:
+            yield int(row[0]), shard, int(row[3]), int(row[4]), int(row[5])
+
+def _isCompressed( directory ):
+    return op.isfile(op.join(directory, "loci_analysis_summary.csv" + SUFFIX))
+
+def _openInput( directory, filename ):
+    # Shards may have been run with or without --compress
+    if _isCompressed( directory ):
+        return gzip.open(op.join(directory, filename + SUFFIX), 'rb')
+    return open(op.join(directory, filename), 'rb')
+
+def _fastqRecords( handle, count ):
+    for _ in range(4 * count):
+        yield next(handle)
+
+def _csvRows( directory, filename ):
+    handle = _openInput( directory, filename )
+    reader = csv.reader( handle )
+    next(reader)
+    return handle, reader
+
+def _denseRows( shard, header, reader ):
+    for row in reader:
+        yield row[0], shard, dict(zip(header[1:], row[1:]))
+
+def _longRows( shard, header, reader ):
+    for subread, rows in itertools.groupby(reader, key=lambda row: row[0]):
+        yield subread, shard, dict((row[1], row[2]) for row in rows)
+
+def _mergeSubreads( openOutput, shardDirs, barcodeFile, resultOrder, isLong=False ):
+    """
+    Merge one barcode's subread CSVs, dense or long, each sorted by subread,
+    with a k-way merge so that only one subread of each shard is held at a
+    time.  Results are ordered as a single run orders them: by read count,
+    then by the order the results were written
+    """
+    handles, streams, columns = [], [], []
+    for directory in shardDirs:
+        suffix = SUFFIX if _isCompressed( directory ) else ""
+        if not op.isfile( op.join(directory, barcodeFile + suffix) ):
+            continue
+        handle = _openInput( directory, barcodeFile )
+        reader = csv.reader( handle )
+        header = next(reader)
+        handles.append( handle )
+        streams.append( (_longRows if isLong else _denseRows)(len(streams), header, reader) )
+        if not isLong:
+            columns.extend( header[1:] )
+    order = lambda c: (-NumReadsLambda(c), resultOrder.get(c, len(resultOrder)))
+    columns = sorted(columns, key=order)
+
+    with openOutput( barcodeFile ) as handle:
+        writer = csv.writer( handle )
+        writer.writerow( ["SubreadId", "ResultId", "Weight"] if isLong else ["SubreadId"] + columns )
+        for subread, group in itertools.groupby(heapq.merge(*streams), key=lambda row: row[0]):
+            weights = {}
+            for _, _, values in group:
+                weights.update( values )
+            if isLong:
+                writer.writerows( [subread, c, weights[c]] for c in sorted(weights, key=order) )
+            else:
+                writer.writerow( [subread] + [weights.get(c, 0) for c in columns] )
+    for handle in handles:
+        handle.close()
+
+def mergeShards( outputDir, shardDirs, threads=4 ):
+    """
+    Combine the outputs of every shard of a run into the outputs the run
+    would have written on its own, streaming through them in output order
+    """
+    specs = [_readShard( directory ) for directory in shardDirs]
+    totals = set(spec["totalUnits"] for spec in specs)
+    indices = sorted(index for spec in specs for index, _, _ in spec["units"])
+    if len(totals) != 1 or indices != list(range(totals.pop())):
+        msg = "Shard outputs don't cover every unit of one run exactly once"
+        logging.error( msg )
+        raise RuntimeError( msg )
+    if any(glob.glob(op.join(d, SUBREAD_ROOTS["sparse"] + "*")) for d in shardDirs):
+        msg = "Sparse subread weights can't be merged, run the shards with '--subreadFormat long' instead"
+        logging.error( msg )
+        raise RuntimeError( msg )
+    if not op.isdir( outputDir ):
+        os.makedirs( outputDir )
+
+    # The merged outputs are compressed if the shards' outputs were
+    compress = _isCompressed( shardDirs[0] )
+    pool = compressionPool( threads ) if compress else None
+    def openOutput( filename ):
+        if compress:
+            return BgzfWriter(op.join(outputDir, filename + SUFFIX), pool=pool)
+        return open(op.join(outputDir, filename), 'wb')
+
+    good    = [_openInput(d, "loci_analysis.fastq") for d in shardDirs]
+    noise   = [_openInput(d, "loci_analysis_chimeras_noise.fastq") for d in shardDirs]
+    summary = [_csvRows(d, "loci_analysis_summary.csv") for d in shardDirs]
+    failure = [_csvRows(d, "loci_analysis_failures.csv") for d in shardDirs]
+
+    with openOutput("loci_analysis.fastq") as goodOut, \
+         openOutput("loci_analysis_chimeras_noise.fastq") as noiseOut, \
+         openOutput("loci_analysis_summary.csv") as summaryHandle, \
+         openOutput("loci_analysis_failures.csv") as failureHandle:
+        summaryOut = csv.writer( summaryHandle )
+        failureOut = csv.writer( failureHandle )
+        summaryOut.writerow( SUMMARY_HEADER )
+        failureOut.writerow( FAILURE_HEADER )
+
+        resultOrder = {}
+        units = heapq.merge(*[_unitRows(d, shard) for shard, d in enumerate(shardDirs)])
+        for index, shard, nGood, nNoise, nFailures in units:
+            goodOut.writelines( _fastqRecords(good[shard], nGood) )
+            noiseOut.writelines( _fastqRecords(noise[shard], nNoise) )
+            for _ in range(nGood + nNoise):
+                row = next(summary[shard][1])
+                resultOrder[row[1]] = len(resultOrder)
+                summaryOut.writerow( row )
+            for _ in range(nFailures):
+                failureOut.writerow( next(failure[shard][1]) )
+
+    for handle in good + noise + [s[0] for s in summary] + [f[0] for f in failure]:
+        handle.close()
+
+    barcodeFiles = set()
+    for directory in shardDirs:
+        for root in (SUBREAD_ROOTS["dense"], SUBREAD_ROOTS["long"]):
+            for fn in glob.glob(op.join(directory, root + "*.csv*")):
+                name = op.basename(fn)[:-len(SUFFIX)] if fn.endswith(SUFFIX) else op.basename(fn)
+                barcodeFiles.add( (root, name) )
+    for root, barcodeFile in sorted(barcodeFiles):
+        _mergeSubreads( openOutput, shardDirs, barcodeFile, resultOrder,
+                        isLong=(root == SUBREAD_ROOTS["long"]) )
+    if pool is not None:
+        pool.close()
+        pool.join()
+    logging.info("Merged {0} shard(s) into '{1}'".format(len(shardDirs), outputDir))
+
+def mergeMain( args=None ):
+    desc = "Merge the partial outputs of a sharded LociAnalysis run"
+    parser = argparse.ArgumentParser(prog="LociAnalysis merge", description=desc)
+    parser.add_argument("outputDirectory", help="The output folder for the combined results")
+    parser.add_argument("shardDirectories", nargs="+", help="The output folders of every shard")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Log progress")
+    opts = parser.parse_args( args )
+    logging.basicConfig(level=logging.INFO if opts.verbose else logging.WARNING,
+                        format=">|> %(asctime)s -|- %(levelname)s -|- %(lineno)d -|--|- %(message)s")
+    mergeShards( op.abspath(opts.outputDirectory), [op.abspath(d) for d in opts.shardDirectories] )
+    return 0
@@ -0,0 +1,123 @@
+
+import re
+import csv
+import json
+import logging
+import itertools
+
+from collections import namedtuple, OrderedDict
+
+MB = 1024 * 1024
+
+SWEEP_TABLE = "loci_analysis_sweep.csv"
+
+# One set of LAA options to try: 'overrides' maps option names to either a
+#  value for every locus or a dict of per-locus values
+SweepConfig = namedtuple("SweepConfig", ["label", "overrides"])
+
+def _formatValue( value ):
+    if isinstance(value, dict):
+        return "+".join("{0}{1}".format(locus, value[locus]) for locus in sorted(value))
+    return str(value)
+
+def _defaultLabel( overrides ):
+    label = "_".join("{0}-{1}".format(opt, _formatValue( overrides[opt] )) for opt in sorted(overrides))
+    # Labels name output directories, so keep them to safe characters
+    return re.sub(r"[^\w.+-]", "", label) or "default"
+
+def _checkOverrides( filename, overrides, optionNames ):
+    if not isinstance(overrides, dict):
+        msg = "Invalid sweep '{0}', expected an object of option values: {1}".format(filename, overrides)
+        logging.error( msg )
+        raise RuntimeError( msg )
+    unknown = sorted(set(overrides) - set(optionNames))
+    if unknown:
+        msg = "Invalid sweep '{0}', unknown option(s): {1}".format(filename, ", ".join(unknown))
+        logging.error( msg )
+        raise RuntimeError( msg )
+
+def readSweep( filename, optionNames ):
+    """
+    Read the configurations of a parameter sweep from a JSON file, either
+    an object mapping each option to a list of values, every combination
+    of which is one configuration, or a list of configurations, each an
+    object of option values with an optional "label".  Any value may also
+    be an object of per-locus values, and loci it leaves out keep the
+    value they would have had without the sweep
+    """
+    try:
+        with open( filename ) as handle:
+            sweep = json.load( handle )
+    except (IOError, ValueError) as error:
+        msg = "Could not read sweep '{0}': {1}".format(filename, error)
+        logging.error( msg )
+        raise RuntimeError( msg )
+
+    configs = []
+    if isinstance(sweep, dict):
+        _checkOverrides( filename, sweep, optionNames )
+        grid = [(opt, values if isinstance(values, list) else [values]) for opt, values in sorted(sweep.items())]
+        for combination in itertools.product( *[values for opt, values in grid] ):
+            overrides = dict(zip([opt for opt, values in grid], combination))
+            configs.append( SweepConfig(_defaultLabel( overrides ), overrides) )
+    elif isinstance(sweep, list):
+        for entry in sweep:
+            overrides = dict(entry) if isinstance(entry, dict) else entry
+            label = overrides.pop("label", None) if isinstance(overrides, dict) else None
+            _checkOverrides( filename, overrides, optionNames )
+            label = re.sub(r"[^\w.+-]", "", str(label)) if label is not None else _defaultLabel( overrides )
+            configs.append( SweepConfig(label, overrides) )
+
+    labels = [config.label for config in configs]
+    duplicates = sorted(set(label for label in labels if labels.count(label) > 1))
+    if duplicates:
+        msg = "Sweep '{0}' has configurations with the same label: {1}".format(filename, ", ".join(duplicates))
+        logging.error( msg )
+        raise RuntimeError( msg )
+    if not configs:
+        msg = "Sweep '{0}' has no configurations".format(filename)
+        logging.error( msg )
+        raise RuntimeError( msg )
+    return configs
+
+class SweepReport(object):
+    """
+    Tally the runtime and yield of each configuration of a sweep as its
+    units finish, for a table comparing them.  Runtimes are those of LAA
+    alone, so units restored from a phasing cache are counted separately
+    """
+    FIELDS = ["Label", "Units", "Phased", "Failed", "Restored", "Sequences", "Noise",
+              "WallTime", "CpuTime", "MaxRssMB", "Options"]
+
+    def __init__(self, configs):
+        self._configs = OrderedDict((config.label, config) for config in configs)
+        self._stats   = OrderedDict((config.label, dict.fromkeys(self.FIELDS[1:-1], 0)) for config in configs)
+
+    def addUnit( self, label, unit ):
+        stats = self._stats[label]
+        stats["Units"] += 1
+        if unit.error is not None:
+            stats["Failed"] += 1
+            return
+        sequences = sum(1 for result in unit.results if not result.isJunk)
+        stats["Sequences"] += sequences
+        stats["Noise"]     += len(unit.results) - sequences
+        if sequences:
+            stats["Phased"] += 1
+        if unit.process is None:
+            stats["Restored"] += 1
+            return
+        stats["WallTime"] += unit.process.wallTime
+        stats["CpuTime"]  += unit.process.userTime + unit.process.systemTime
+        stats["MaxRssMB"]  = max(stats["MaxRssMB"], (unit.process.maxRss or 0) // MB)
+
+    def write( self, filename ):
+        with open( filename, 'w' ) as handle:
+            writer = csv.writer( handle )
+            writer.writerow( self.FIELDS )
+            for label, stats in self._stats.iteritems():
+                row = [label] + [stats[field] for field in self.FIELDS[1:-1]]
+                row[self.FIELDS.index("WallTime")] = round(stats["WallTime"], 3)
+                row[self.FIELDS.index("CpuTime")]  = round(stats["CpuTime"], 3)
+                writer.writerow( row + [json.dumps(self._configs[label].overrides, sort_keys=True)] )
+        return filename
@@ -1,19 +1,31 @@
 
+import os
+import json
 import logging
-from subprocess import Popen, PIPE
+import tempfile
+import threading
+import os.path as op
 
 from LociAnalysis.which import which
+from LociAnalysis.process import runProcess
+
+# Detecting the version means launching LAA, so the result is cached on
+#  disk and in the environment (where worker processes will inherit it),
+#  keyed by the path and modification time of the executable
+CACHE_FILE  = op.join(op.expanduser("~"), ".LociAnalysis", "laa_version.json")
+ENV_VAR     = "LOCI_ANALYSIS_LAA_VERSION"
+
+log = logging.getLogger(__name__)
+
+_lock    = threading.Lock()
+_version = {}
 
 def LongAmpliconAnalysisRawString():
     laa = which('laa')
     if not laa:
         raise RuntimeError("laa not on PATH")
     cmd = [laa, "--version"]
-    proc = Popen(cmd, stdout=PIPE, stderr=PIPE, close_fds=True)
-    proc.wait()
-    if proc.returncode != 0:
-        raise RuntimeError("`{0}` failed with exit code {1}:\n{2}".format(' '.join(cmd), proc.returncode, proc.stderr.read()))
-    return proc.stdout.read()
+    return runProcess(cmd, tool="laa", captureStdout=True, check=True).stdout
 
 def LongAmpliconAnalysisVersion( raw ):
     return raw.splitlines()[0].split('|')[0].strip()[4:]
@@ -28,6 +40,61 @@ def SmrtAnalysisVersion( laa_version ):
     else:
         return "3.2"
 
-_LONG_AMPLICON_RAW_STR = LongAmpliconAnalysisRawString()
-LONG_AMPLICON_VERSION = LongAmpliconAnalysisVersion(_LONG_AMPLICON_RAW_STR)
-SMRT_ANALYSIS_VERSION = SmrtAnalysisVersion(LONG_AMPLICON_VERSION)
+def _cacheKey( laa ):
+    path = op.realpath( laa )
+    return "{0}:{1}".format(path, os.stat(path).st_mtime)
+
+def _readCache():
+    try:
+        with open( CACHE_FILE ) as handle:
+            return json.load( handle )
+    except (IOError, OSError, ValueError):
+        return {}
+
+def _writeCache( key, raw ):
+    cache = _readCache()
+    cache[key] = raw
+    try:
+        directory = op.dirname( CACHE_FILE )
+        if not op.isdir( directory ):
+            os.makedirs( directory )
+        handle, tmpName = tempfile.mkstemp(prefix=".laa_version.", dir=directory)
+        with os.fdopen(handle, 'w') as tmp:
+            json.dump(cache, tmp, indent=2, sort_keys=True)
+        os.rename(tmpName, CACHE_FILE)
+    except (IOError, OSError) as error:
+        log.debug("Could not cache the LAA version in '{0}': {1}".format(CACHE_FILE, error))
+
+def _rawVersion():
+    laa = which('laa')
+    if not laa:
+        raise RuntimeError("laa not on PATH")
+    key = _cacheKey( laa )
+
+    inherited = os.environ.get( ENV_VAR )
+    if inherited:
+        try:
+            inheritedKey, raw = json.loads( inherited )
+            if inheritedKey == key:
+                return raw
+        except ValueError:
+            pass
+
+    raw = _readCache().get( key )
+    if raw is None:
+        raw = LongAmpliconAnalysisRawString()
+        _writeCache( key, raw )
+    os.environ[ENV_VAR] = json.dumps([key, raw])
+    return raw
+
+def getLongAmpliconVersion():
+    """
+    The version of the LAA on our PATH, detected the first time it's needed
+    """
+    with _lock:
+        if "laa" not in _version:
+            _version["laa"] = LongAmpliconAnalysisVersion( _rawVersion() )
+        return _version["laa"]
+
+def getSmrtAnalysisVersion():
+    return SmrtAnalysisVersion( getLongAmpliconVersion() )
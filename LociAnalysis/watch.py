@@ -0,0 +1,142 @@
+
+import os
+import time
+import fnmatch
+import logging
+import os.path as op
+
+from collections import defaultdict
+
+POLL_INTERVAL = 60      # Seconds between scans of the run directory
+IDLE_TIMEOUT  = 3600    # Seconds without a new chunk before the run is considered finished
+
+class Chunk(object):
+    """
+    One BAM of a sequencing run, e.g. a movie or a chunk of one, once it
+    has been binned
+    """
+    def __init__(self, filename, barcodes, whitelistDb):
+        self.filename    = filename
+        self.barcodes    = barcodes
+        self.whitelistDb = whitelistDb
+
+    @property
+    def name(self):
+        return op.basename( self.filename )
+
+class RunWatcher(object):
+    """
+    Poll a run directory for the BAMs of a sequencing run as they are
+    written, and generate each one once it's ready: once its .pbi index
+    exists and its size has stopped changing.  The run is finished once
+    'expected' BAMs have been found, once the 'done' marker file exists,
+    or once nothing new has appeared for 'idle' seconds
+    """
+
+    def __init__(self, directory, pattern="*.subreads.bam", done=None, expected=None,
+                 idle=IDLE_TIMEOUT, poll=POLL_INTERVAL, exclude=None):
+        self.directory = directory
+        self._pattern  = pattern
+        self._done     = op.join(directory, done) if done else None
+        self._expected = expected
+        self._idle     = idle
+        self._poll     = poll
+        self._exclude  = op.abspath( exclude ) if exclude else None
+        self._sizes    = {}
+        self._seen     = set()
+
+    def _candidates( self ):
+        for root, dirs, files in os.walk( self.directory ):
+            # Don't mistake our own outputs for part of the run
+            dirs[:] = [d for d in dirs if op.abspath(op.join(root, d)) != self._exclude]
+            for filename in sorted(fnmatch.filter(files, self._pattern)):
+                yield op.join(root, filename)
+
+    def _scan( self, final=False ):
+        """
+        The new BAMs that are ready, or when 'final' every new BAM that
+        has an index, since nothing is still being written
+        """
+        ready = []
+        for filename in self._candidates():
+            if filename in self._seen or not op.isfile( filename + ".pbi" ):
+                continue
+            size = op.getsize( filename )
+            if final or self._sizes.get( filename ) == size:
+                ready.append( filename )
+            self._sizes[filename] = size
+        self._seen.update( ready )
+        return sorted(ready)
+
+    def _finished( self, lastChange ):
+        if self._expected is not None and len(self._seen) >= self._expected:
+            return True
+        if self._done is not None and op.exists( self._done ):
+            logging.info("Found '{0}', the run is finished".format(self._done))
+            return True
+        if self._idle and time.time() - lastChange >= self._idle:
+            logging.warn("Nothing new in '{0}' for {1}s, assuming the run is finished".format(self.directory,
+                                                                                            self._idle))
+            return True
+        return False
+
+    def __iter__( self ):
+        lastChange = time.time()
+        while True:
+            ready = self._scan()
+            for filename in ready:
+                yield filename
+            if ready:
+                lastChange = time.time()
+            if self._finished( lastChange ):
+                break
+            time.sleep( self._poll )
+        for filename in self._scan( final=True ):
+            yield filename
+
+class ChunkBins(object):
+    """
+    The bins of several chunks, read as though they were of one dataset.
+    The whitelist of each locus is the concatenation of the chunks' own,
+    written to 'directory'
+    """
+
+    def __init__(self, chunks, directory):
+        self._chunks     = chunks
+        self._whitelists = {}
+        if not op.isdir( directory ):
+            os.makedirs( directory )
+
+        loci = defaultdict(list)
+        for chunk in chunks:
+            for locus, whitelist in chunk.whitelistDb.iteritems():
+                loci[locus].append( whitelist )
+        for locus, whitelists in loci.iteritems():
+            outputTxt = op.join( directory, locus + ".subreads.txt" )
+            with open( outputTxt, 'w' ) as handle:
+                for whitelist in whitelists:
+                    with open( whitelist ) as chunkHandle:
+                        for line in chunkHandle:
+                            handle.write( line )
+            self._whitelists[locus] = outputTxt
+
+    def readCount( self, barcode, locus ):
+        return sum(chunk.whitelistDb.readCount( barcode, locus ) for chunk in self._chunks)
+
+    @property
+    def binnedReads(self):
+        return sum(chunk.whitelistDb.binnedReads for chunk in self._chunks)
+
+    def keys(self):
+        return sorted(self._whitelists.keys())
+
+    def items(self):
+        return [(locus, self._whitelists[locus]) for locus in self.keys()]
+
+def writeChunkDataSet( chunks, outputXml ):
+    """
+    A SubreadSet of several chunks, to be phased as one input
+    """
+    from pbcore.io import SubreadSet
+    SubreadSet( *[chunk.filename for chunk in chunks] ).write( outputXml )
+    return outputXml
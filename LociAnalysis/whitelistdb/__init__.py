@@ -1 +1,2 @@
 from .whitelistdb import WhitelistDb
+from .aligners import Aligner, BlasrAligner, Minimap2Aligner, getAligner
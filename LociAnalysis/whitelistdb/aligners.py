@@ -0,0 +1,211 @@
+
+import re
+import logging
+import os.path as op
+
+from LociAnalysis.process import runProcess, checkProcess
+
+# Each parser generates the (subread, score, native) triples of the lines
+#  of one alignment file, skipping anything that isn't a usable alignment.
+#  Native scores are the aligner's own, and it's up to the Aligner that
+#  wrote them to say whether higher or lower is better; scores the parser
+#  falls back on when there isn't one, such as a count of aligned bases,
+#  are always higher-is-better
+
+CIGAR = re.compile(r"(\d+)([MIDNSHP=X])")
+
+def _subreadName( qName ):
+    # Aligners may append the aligned interval to the subread's name
+    return '/'.join(qName.split('/')[:3])
+
+def _tag( fields, prefix ):
+    for field in fields:
+        if field.startswith( prefix ):
+            return field[len(prefix):]
+    return None
+
+def parseM1( lines ):
+    """
+    BLASR's default summary format: qName tName qStrand tStrand score ...
+    """
+    for line in lines:
+        parts = line.split()
+        try:
+            yield _subreadName( parts[0] ), int(parts[4]), True
+        except (IndexError, ValueError):
+            continue
+
+def parseM4( lines ):
+    """
+    BLASR's long tabular format: qName tName score percentSimilarity ...
+    """
+    for line in lines:
+        parts = line.split()
+        try:
+            yield _subreadName( parts[0] ), int(parts[2]), True
+        except (IndexError, ValueError):
+            continue
+
+def parsePaf( lines ):
+    """
+    minimap2's PAF, scored by the DP alignment score (AS:i) when it was
+    computed and otherwise by the number of matching bases
+    """
+    for line in lines:
+        parts = line.rstrip("\r\n").split("\t")
+        if len(parts) < 12 or _tag( parts[12:], "tp:A:" ) in ("S", "i"):
+            continue
+        score = _tag( parts[12:], "AS:i:" )
+        try:
+            yield _subreadName( parts[0] ), int(parts[9] if score is None else score), score is not None
+        except ValueError:
+            continue
+
+def parseSam( lines ):
+    """
+    SAM primary alignments, scored by AS:i or, without it, by the number
+    of aligned bases in the CIGAR
+    """
+    for line in lines:
+        if line.startswith("@"):
+            continue
+        parts = line.rstrip("\r\n").split("\t")
+        try:
+            if len(parts) < 11 or int(parts[1]) & 0x904:  # Unmapped, secondary or supplementary
+                continue
+            score = _tag( parts[11:], "AS:i:" )
+            if score is None:
+                aligned = sum(int(n) for n, code in CIGAR.findall( parts[5] ) if code in "M=X")
+                yield _subreadName( parts[0] ), aligned, False
+            else:
+                yield _subreadName( parts[0] ), int(score), True
+        except ValueError:
+            continue
+
+PARSERS = {"m1":  parseM1,
+           "m4":  parseM4,
+           "paf": parsePaf,
+           "sam": parseSam}
+
+class Aligner(object):
+    """
+    A backend for binning reads by locus: how to align a query to the
+    reference of one locus, the format of what it writes, and how to read
+    back the best score of each subread.  Subclasses set 'name', the
+    'formats' they can write (the first being the default) and whether
+    their scores are costs, and build the command line
+    """
+    name          = None
+    formats       = ()
+    lowerIsBetter = False
+
+    def __init__(self, format=None):
+        self.format = format or self.formats[0]
+        if self.format not in self.formats:
+            msg = "Aligner '{0}' cannot write '{1}' output, only: {2}".format(self.name, self.format,
+                                                                             ", ".join(self.formats))
+            logging.error( msg )
+            raise RuntimeError( msg )
+
+    @property
+    def key(self):
+        return "{0}.{1}".format(self.name, self.format)
+
+    def outputFilename( self, query, outputPath, locus ):
+        suffix = "{0}.{1}".format(locus, self.format)
+        if query.endswith(".subreadset.xml"):
+            return op.join(outputPath, re.sub("subreadset.xml$", suffix, op.basename( query )))
+        elif query.endswith(".bam"):
+            return op.join(outputPath, re.sub("bam$", suffix, op.basename( query )))
+        return op.join(outputPath, op.basename( query ) + "." + suffix)
+
+    def prepare( self, query, outputPath ):
+        """
+        The query to align, for aligners that can't read it as it is
+        """
+        return query
+
+    def command( self, query, refFn, refSa, output, nproc ):
+        raise NotImplementedError
+
+    def align( self, query, refFn, refSa=None, outputPath=None, locus=None, nproc=None ):
+        locus  = op.basename( refFn ).split('.')[0] if locus is None else locus
+        output = self.outputFilename( query, outputPath, locus )
+        if op.isfile(output) and op.getsize(output) > 0:
+            logging.debug("Existing output file for for locus '{0}', skipping alignment".format(locus))
+            return output
+
+        cmd = self.command( self.prepare( query, outputPath ), refFn, refSa, output, nproc )
+        logging.trace("Calling {0} with command line '{1}'".format(self.name, ' '.join(cmd)))
+        result = runProcess(cmd, tool=self.name, unit=locus, nproc=nproc or 1)
+        logging.trace("Finished running {0}".format(self.name))
+
+        if result.returncode != 0 or result.timedOut is not None:
+            logging.error("{0} alignment failed. Stderr was {1}".format(self.name, result.stderr))
+            checkProcess( result )
+
+        return output
+
+    def scores( self, lines ):
+        """
+        Generate the (subread, score) pairs of an alignment file, where
+        higher scores are always better
+        """
+        for subread, score, native in PARSERS[self.format]( lines ):
+            yield subread, (-score if native and self.lowerIsBetter else score)
+
+class BlasrAligner(Aligner):
+    name          = "blasr"
+    formats       = ("m1", "m4", "sam")
+    lowerIsBetter = True
+    FORMAT_ARGS   = {"m1": [], "m4": ["-m", "4"], "sam": ["--sam"]}
+
+    def command( self, query, refFn, refSa, output, nproc ):
+        cmd = ['blasr', query, refFn, '--bestn', '1', '--out', output, '--fastSDP',
+                                      '--minSubreadLength', '1000', '--minAlnLength', '1000']
+        cmd.extend( self.FORMAT_ARGS[self.format] )
+        if nproc is not None:
+            cmd.extend(['--nproc', str(nproc)])
+        if refSa is not None:
+            cmd.extend(["--sa", refSa])
+        return cmd
+
+class Minimap2Aligner(Aligner):
+    """
+    minimap2 only reads FASTA and FASTQ, so subreads are first extracted
+    from the query with bam2fasta, once per query
+    """
+    name    = "minimap2"
+    formats = ("paf", "sam")
+
+    def prepare( self, query, outputPath ):
+        prefix = op.join(outputPath, re.sub(r"(\.subreadset\.xml|\.bam)$", "", op.basename( query )))
+        fasta  = prefix + ".fasta"
+        if op.isfile(fasta) and op.getsize(fasta) > 0:
+            return fasta
+
+        cmd = ['bam2fasta', '-u', '-o', prefix, query]
+        logging.trace("Calling bam2fasta with command line '{0}'".format(' '.join(cmd)))
+        result = runProcess(cmd, tool="bam2fasta", nproc=1)
+        if result.returncode != 0 or result.timedOut is not None:
+            logging.error("bam2fasta failed. Stderr was {0}".format(result.stderr))
+            checkProcess( result )
+        return fasta
+
+    def command( self, query, refFn, refSa, output, nproc ):
+        cmd = ['minimap2', '-x', 'map-pb', '-c', '--secondary=no', '-o', output]
+        if self.format == "sam":
+            cmd.append('-a')
+        if nproc is not None:
+            cmd.extend(['-t', str(nproc)])
+        return cmd + [refFn, query]
+
+ALIGNERS = {"blasr":    BlasrAligner,
+            "minimap2": Minimap2Aligner}
+
+def getAligner( name="blasr", format=None ):
+    if name not in ALIGNERS:
+        msg = "Unknown aligner '{0}', expected one of: {1}".format(name, ", ".join(sorted(ALIGNERS)))
+        logging.error( msg )
+        raise RuntimeError( msg )
+    return ALIGNERS[name]( format )
@@ -1,20 +1,26 @@
 
 import re
 import os
+import json
+import hashlib
+import itertools
 import os.path as op
 import logging
-import subprocess
 import time
 import copy
 
 from collections import defaultdict
 
-from pbcore.io import openDataSet, DataSet
-
 import LociAnalysis.refdb as refdb
+from LociAnalysis.process import runProcess, checkProcess
+from LociAnalysis.profiling import profiler
+from LociAnalysis.whitelistdb.aligners import Aligner, getAligner
 
 NPROC = 1
 
+MANIFEST = "whitelistdb.json"      # What the saved scores and whitelists were built from
+SCORES   = "whitelistdb.scores"    # The best score and loci of every binned read
+
 def CallDataSetCreate( inputBam ):
     outputPath = op.dirname( inputBam )
 
@@ -24,80 +30,77 @@ def CallDataSetCreate( inputBam ):
     datasetCmd = ['dataset', 'create', outputXml, op.abspath(inputBam)]
 
     logging.trace("Calling dataset-create with command line '%s'", ' '.join(datasetCmd))
-    proc = subprocess.Popen(datasetCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
+    result = runProcess(datasetCmd, tool="dataset")
     logging.trace("Finished running dataset-create")
 
-    if proc.returncode != 0:
-        logging.error("dataset-create failed. Stderr was %s", stderr)
-        raise RuntimeError(" exited with returncode {e}"
-                           .format(e=proc.returncode))
+    if result.returncode != 0 or result.timedOut is not None:
+        logging.error("dataset-create failed. Stderr was %s", result.stderr)
+        checkProcess( result )
 
     return outputXml
 
-def CallBlasr( query, refFn, refSa=None, outputPath=None, name=None, nproc=None ):
-
-    locus = op.basename( refFn ).split('.')[0] if name is None else name
-
-    if query.endswith(".subreadset.xml"):
-        outputM1 = op.join(outputPath,
-                           re.sub("subreadset.xml$", "{0}.m1".format(locus), op.basename( query )))
-    elif query.endswith(".bam"):
-        outputM1 = op.join(outputPath,
-                           re.sub("bam$", "{0}.m1".format(locus), op.basename( query )))
-    else:
-        outputM1 = op.join(outputPath, op.basename(query) + ".{0}.m1".format(locus))
-
-    if op.isfile(outputM1) and op.getsize(outputM1) > 0:
-        logging.debug("Existing output file for for locus '{0}', skipping alignment".format(locus))
-        return outputM1
-
-    blasrCmd = ['blasr', query, refFn, '--bestn', '1', '--out', outputM1, '--fastSDP',
-                             '--minSubreadLength', '1000', '--minAlnLength', '1000']
-
-    if nproc is not None:
-        blasrCmd.extend(['--nproc', str(nproc)])
-    if refSa is not None:
-        blasrCmd.extend(["--sa", refSa])
-
-    logging.trace("Calling Blasr with command line '%s'", ' '.join(blasrCmd))
-    proc = subprocess.Popen(blasrCmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    stdout, stderr = proc.communicate()
-    logging.trace("Finished running Blasr")
-
-    if proc.returncode != 0:
-        logging.error("Blasr alignment failed. Stderr was %s", stderr)
-        raise RuntimeError(" exited with returncode {e}"
-                           .format(e=proc.returncode))
-
-    return outputM1
+def _fingerprint( filename ):
+    digest = hashlib.md5()
+    with open( filename, 'rb' ) as handle:
+        for chunk in iter(lambda : handle.read( 1 << 20 ), ""):
+            digest.update( chunk )
+    return digest.hexdigest()
 
 
 class WhitelistDb(object):
-
-    _files      = []    # Track temporary files to be deleted
-    _scores     = defaultdict(int)
-    _reads      = defaultdict(list)
-    _loci       = defaultdict(list)
-    _whitelists = {}
-
-    def __init__( self, refDb, query, dataset=None, alnDir=None, combined=None, nproc=NPROC ):
+    """
+    Bins the subreads of a dataset by the locus they align best to, writing
+    one whitelist of subreads per locus.  The scores and whitelists are saved
+    alongside the alignments, so that when the reference set changes only
+    the new or changed loci are aligned, only the reads whose best loci were
+    changed or removed are re-scored, and only the whitelists whose members
+    changed are rewritten
+    """
+
+    def __init__( self, refDb, query, dataset=None, alnDir=None, combined=None, nproc=NPROC, aligner=None ):
         logging.info("Building whitelist database for '{0}'".format(query))
         tStart = time.time()
 
+        # Per-instance, as one process may bin several datasets
+        self._files      = []    # Track temporary files to be deleted
+        self._scores     = defaultdict(int)
+        self._reads      = defaultdict(list)
+        self._loci       = defaultdict(list)
+        self._whitelists = {}
+        self._digests    = {}
+
         self._refDb    = self._getRefDb( refDb )
         self._queryFn  = self._getQuery( query )
         self._queryDs  = self._getDataSet( dataset )
         self._alnDir   = self._getAlnDir( alnDir )
         self._combined = self._getCombinations( combined )
         self._nproc    = nproc
+        self._aligner  = self._getAligner( aligner )
+        self._counts   = None
+
+        references = dict((locus, _fingerprint( refFn )) for locus, (refFn, _) in self._refDb.iteritems())
+        previous   = self._readManifest()
+        changed    = self._rescoreLoci( references, previous )
 
         for locus, (refFn, refSa) in self._refDb.iteritems():
-            m1 = CallBlasr(self._queryFn, refFn, refSa, self._alnDir, locus, self._nproc)
-            self._updateMapping(m1, locus)
-        self._createLociReference()
-        self._combineLoci()
-        self._writeWhitelists()
+            if previous is not None and locus not in changed:
+                continue
+            alignments = self._alignmentFilename( locus )
+            if previous is not None and op.isfile( alignments ):
+                # Aligned to another version of the reference, or to nothing we have a record of
+                os.remove( alignments )
+            with profiler.stage("whitelistdb.align", unit=locus):
+                alignments = self._aligner.align(self._queryFn, refFn, refSa, self._alnDir, locus, self._nproc)
+            with profiler.stage("whitelistdb.parse", unit=locus) as stage:
+                stage.count("alignments", self._updateMapping(alignments, locus))
+        with profiler.stage("whitelistdb.write") as stage:
+            self._createLociReference()
+            self._combineLoci()
+            written = self._writeWhitelists( previous )
+            if previous is None or changed or written:
+                self._writeScores()
+                self._writeManifest( references )
+            stage.count("reads", len(self._reads))
 
         tEnd = time.time()
         logging.info("Finished building whitelist database in {0}s".format(round(tEnd - tStart, 3)))
@@ -108,21 +111,105 @@ class WhitelistDb(object):
     def __exit__( self, exception_type, exception_value, traceback ):
         return True
 
-    def _updateMapping(self, m1, locus):
-        with open( m1 ) as handle:
+    def _rescoreLoci( self, references, previous ):
+        """
+        Restore the scores of the last binning, forget those of any read
+        whose best alignment was to a changed or removed locus and re-score
+        it against the unchanged loci, and return the loci that have to be
+        aligned again.  Without a previous binning, every locus has to be
+        """
+        if previous is None or not self._readScores():
+            return set(references.keys())
+        changed = set(locus for locus in references if previous["references"].get(locus) != references[locus])
+        stale   = set(locus for locus in previous["references"] if references.get(locus) != previous["references"][locus])
+        if not changed and not stale:
+            logging.info("Reference set unchanged since the last binning, reusing its whitelists")
+            return changed
+        logging.info("Re-binning reads for {0} new or changed and {1} removed loci".format(len(changed),
+                                                                                             len(stale - changed)))
+
+        affected = set(read for read, loci in self._reads.iteritems() if stale.intersection( loci ))
+        for read in affected:
+            del self._scores[read]
+            del self._reads[read]
+        for locus in stale - changed:
+            alignments = self._alignmentFilename( locus )
+            if op.isfile( alignments ):
+                os.remove( alignments )
+        logging.debug("Re-scoring {0} subreads whose best locus changed".format(len(affected)))
+        if affected:
+            for locus in self._refDb:
+                if locus in changed:
+                    continue
+                with profiler.stage("whitelistdb.parse", unit=locus) as stage:
+                    stage.count("alignments", self._updateMapping(self._alignmentFilename( locus ), locus, affected))
+        return changed
+
+    def _readManifest( self ):
+        manifestFn = op.join( self._alnDir, MANIFEST )
+        if not op.isfile( manifestFn ):
+            return None
+        try:
+            with open( manifestFn ) as handle:
+                manifest = json.load( handle )
+        except ValueError:
+            logging.warn("Ignoring an unreadable binning manifest: {0}".format(manifestFn))
+            return None
+        if manifest.get("query") != self._queryStat() or manifest.get("aligner") != self._aligner.key:
+            logging.info("Input or aligner has changed since the last binning, realigning all loci")
+            for locus in self._refDb:
+                alignments = self._alignmentFilename( locus )
+                if op.isfile( alignments ):
+                    os.remove( alignments )
+            return None
+        return manifest
+
+    def _writeManifest( self, references ):
+        manifestFn = op.join( self._alnDir, MANIFEST )
+        manifest = {"query":      self._queryStat(),
+                    "aligner":    self._aligner.key,
+                    "references": references,
+                    "whitelists": self._digests}
+        with open( manifestFn + ".tmp", 'w' ) as handle:
+            json.dump( manifest, handle, indent=2, sort_keys=True )
+        os.rename( manifestFn + ".tmp", manifestFn )
+
+    def _queryStat( self ):
+        stat = os.stat( self._queryFn )
+        return [op.abspath( self._queryFn ), stat.st_size, int(stat.st_mtime)]
+
+    def _readScores( self ):
+        scoresFn = op.join( self._alnDir, SCORES )
+        if not op.isfile( scoresFn ):
+            return False
+        with open( scoresFn ) as handle:
             for line in handle:
-                parts = line.strip().split()
-                query = '/'.join(parts[0].split('/')[:3])
-                try:
-                    score = abs(int(parts[4]))
-                except:
+                read, score, loci = line.rstrip("\n").split("\t")
+                self._scores[read] = int(score)
+                self._reads[read]  = loci.split(",")
+        return True
+
+    def _writeScores( self ):
+        scoresFn = op.join( self._alnDir, SCORES )
+        with open( scoresFn + ".tmp", 'w' ) as handle:
+            for read in sorted(self._reads):
+                handle.write( "{0}\t{1}\t{2}\n".format(read, self._scores[read], ",".join(sorted(self._reads[read]))) )
+        os.rename( scoresFn + ".tmp", scoresFn )
+
+    def _updateMapping(self, alignments, locus, reads=None):
+        count = 0
+        with open( alignments ) as handle:
+            for query, score in self._aligner.scores( handle ):
+                count += 1
+                if reads is not None and query not in reads:
                     continue
                 refScore = self._scores[query]
                 if score > refScore:
                     self._scores[query] = score
                     self._reads[query] = [locus]
-                elif score == refScore:
+                elif score == refScore and locus not in self._reads[query]:
                     self._reads[query].append( locus )
+        return count
 
     def _combineLoci( self ):
         if self._combined is None:
@@ -153,6 +240,7 @@ class WhitelistDb(object):
         return query
 
     def _getDataSet( self, ds ):
+        from pbcore.io import openDataSet, DataSet
         if isinstance( ds, DataSet ):
             return ds
         elif ds is not None:
@@ -180,6 +268,16 @@ class WhitelistDb(object):
                 raise RuntimeError( msg )
         return alnDir
 
+    def _getAligner( self, aligner ):
+        if aligner is None:
+            return getAligner()
+        elif isinstance(aligner, Aligner):
+            return aligner
+        return getAligner( *aligner.split('.', 1) )
+
+    def _alignmentFilename( self, locus ):
+        return self._aligner.outputFilename( self._queryFn, self._alnDir, locus )
+
     def _getCombinations( self, combinations ):
         if combinations is None:
             return None
@@ -193,23 +291,30 @@ class WhitelistDb(object):
 
     def _createLociReference( self ):
         count = 0
-        for read, vals in self._reads.iteritems():
+        for read in sorted(self._reads):
             count += 1
-            for locus in vals:
+            for locus in self._reads[read]:
                 self._loci[locus].append( read )
         logging.debug("Found {0} subreads with at least one good alignment".format(count))
 
-    def _writeWhitelist( self, locus ):
+    def _writeWhitelist( self, locus, previous=None ):
+        """
+        Write the whitelist of a locus unless the last binning already
+        wrote one with the same members, and return whether it was written
+        """
         outputTxt = op.join( self._alnDir, locus + ".subreads.txt" )
-        if op.isfile(outputTxt) and op.getsize(outputTxt) > 0:
-            logging.debug("Existing locus-specific whitelist file found for '{0}', skipping filtering".format(locus))
-            return outputTxt
+        self._whitelists[locus] = outputTxt
+        digest = hashlib.md5( "\n".join(self._loci[locus]) ).hexdigest()
+        self._digests[locus] = digest
+        if previous is not None and previous["whitelists"].get(locus) == digest and op.isfile(outputTxt):
+            logging.debug("Whitelist for '{0}' is unchanged since the last binning, skipping filtering".format(locus))
+            return False
 
         with open( outputTxt, 'w' ) as handle:
             for qname in self._loci[locus]:
                 handle.write( qname + "\n" )
 
-        return outputTxt
+        return True
 
     def _writeWhitelistDataset( self, locus ):
         subreads = self._loci[locus]
@@ -226,16 +331,68 @@ class WhitelistDb(object):
 
         return outputXml
 
-    def _writeWhitelists( self ):
-        for locus in self._loci.keys():
-            self._whitelists[locus] = self._writeWhitelist( locus )
-        logging.debug("Found an existing whitelist for {0} loci".format(len(self._whitelists.keys())))
+    def _writeWhitelists( self, previous=None ):
+        written = [locus for locus in self._loci.keys() if self._writeWhitelist( locus, previous )]
+        if previous is not None:
+            for locus in set(previous["whitelists"]) - set(self._loci.keys()):
+                outputTxt = op.join( self._alnDir, locus + ".subreads.txt" )
+                if op.isfile( outputTxt ):
+                    os.remove( outputTxt )
+                    written.append( locus )
+        logging.debug("Rewrote {0} whitelist(s), {1} unchanged".format(len(written),
+                                                                     len(set(self._loci.keys()) - set(written))))
+        return written
 
     def _writeWhitelistDatasets( self ):
         for locus in self._loci.keys():
             self._whitelists[locus] = self._writeWhitelistDataset( locus )
         logging.debug("Found a whitelisted SubreadSet for {0} loci".format(len(self._whitelists.keys())))
 
+    def _countReadsByBarcode( self ):
+        """
+        Tally the whitelisted subreads of each locus by barcode, using the
+        barcode calls from the index of the query DataSet
+        """
+        counts = defaultdict(lambda : defaultdict(int))
+        if not self._queryDs.isBarcoded:
+            for locus, reads in self._loci.iteritems():
+                counts[None][locus] = len(reads)
+            return counts
+
+        rgTable = self._queryDs.readGroupTable
+        movies  = dict(itertools.izip(rgTable.ID, rgTable.MovieName))
+        index   = self._queryDs.index
+        for qId, hn, qs, qe, bcF, bcR in itertools.izip(index.qId, index.holeNumber, index.qStart,
+                                                          index.qEnd, index.bcForward, index.bcReverse):
+            loci = self._reads.get("{0}/{1}/{2}_{3}".format(movies[qId], hn, qs, qe))
+            if loci:
+                barcode = "{0}--{1}".format(bcF, bcR)
+                for locus in loci:
+                    counts[barcode][locus] += 1
+
+        # Combined loci pool the reads of their constituents
+        if self._combined is not None:
+            for barcodeCounts in counts.itervalues():
+                for name, loci in self._combined.iteritems():
+                    barcodeCounts[name] += sum(barcodeCounts[locus] for locus in loci)
+        return counts
+
+    def readCount( self, barcode, locus ):
+        """
+        The number of whitelisted subreads for a locus from one barcode, or
+        from the whole dataset if it isn't barcoded
+        """
+        if self._counts is None:
+            self._counts = self._countReadsByBarcode()
+        return self._counts[barcode][locus]
+
+    @property
+    def binnedReads(self):
+        """
+        The number of subreads assigned to at least one locus
+        """
+        return len(self._reads)
+
     def keys(self):
         return sorted(self._whitelists.keys())
 
@@ -12,6 +12,8 @@ DESC = 'Tools for analyzing complex HLA data from SMRT Sequencing'
 
 scripts = [
     "bin/LociAnalysis",
+    "bin/LociAnalysisBenchmark",
+    "bin/LociAnalysisService",
 ]
 
 required = [
@@ -0,0 +1,84 @@
+
+import unittest
+
+from LociAnalysis.whitelistdb.aligners import (parseM1, parseM4, parsePaf, parseSam,
+                                               BlasrAligner, Minimap2Aligner)
+
+# Recorded alignments of the same two subreads to one locus, in every
+#  format we read, plus lines each parser must skip
+
+M1 = """\
+m54006_160504_020705/4194497/0_3051 A*01:01:01:01 0 0 -14783 89.3939 30 3110 3503 0 3051 3051 1011010
+m54006_160504_020705/4194498/3098_6120/0_3022 A*01:01:01:01 0 1 -12011 87.1200 12 3040 3503 0 3022 3022 998812
+m54006_160504_020705/4194499/0_2500 A*01:01:01:01 0 0 notAScore 80.0 0 2500 3503 0 2500 2500 1
+truncated/line
+"""
+
+M4 = """\
+m54006_160504_020705/4194497/0_3051 A*01:01:01:01 -14783 89.3939 0 0 3051 3051 0 30 3110 3503 254
+m54006_160504_020705/4194498/3098_6120/0_3022 A*01:01:01:01 -12011 87.12 0 0 3022 3022 1 12 3040 3503 254
+m54006_160504_020705/4194499/0_2500 A*01:01:01:01
+"""
+
+PAF = "\n".join("\t".join(fields) for fields in [
+    ["m54006_160504_020705/4194497/0_3051", "3051", "10", "3040", "+", "A*01:01:01:01", "3503", "30", "3110",
+     "2870", "3080", "60", "tp:A:P", "cm:i:480", "s1:i:2710", "AS:i:5214"],
+    # Aligned without -c, so without a DP score
+    ["m54006_160504_020705/4194498/3098_6120", "3022", "0", "3022", "-", "A*01:01:01:01", "3503", "12", "3040",
+     "2655", "3028", "60", "tp:A:P", "cm:i:412", "s1:i:2401"],
+    ["m54006_160504_020705/4194497/0_3051", "3051", "10", "900", "+", "A*01:01:01:01", "3503", "30", "920",
+     "600", "890", "0", "tp:A:S", "AS:i:1040"],
+    ["m54006_160504_020705/4194499/0_2500", "2500", "0", "2500", "+", "A*01:01:01:01"],
+]) + "\n"
+
+SAM = "\n".join("\t".join(fields) for fields in [
+    ["@HD", "VN:1.5", "SO:unsorted"],
+    ["@SQ", "SN:A*01:01:01:01", "LN:3503"],
+    ["m54006_160504_020705/4194497/0_3051", "0", "A*01:01:01:01", "31", "254", "10S3040M1S", "*", "0", "0",
+     "*", "*", "AS:i:-14783"],
+    # No AS:i, so scored by its 2990 M, 50 = and 5 X bases
+    ["m54006_160504_020705/4194498/3098_6120", "16", "A*01:01:01:01", "13", "254", "2990M4I50=5X3D", "*", "0", "0",
+     "*", "*", "NM:i:12"],
+    ["m54006_160504_020705/4194497/0_3051", "256", "A*01:01:01:01", "31", "0", "3051M", "*", "0", "0",
+     "*", "*", "AS:i:-9000"],
+    ["m54006_160504_020705/4194499/0_2500", "4", "*", "0", "0", "*", "*", "0", "0", "*", "*"],
+]) + "\n"
+
+FIRST  = "m54006_160504_020705/4194497/0_3051"
+SECOND = "m54006_160504_020705/4194498/3098_6120"
+
+class ParserTests(unittest.TestCase):
+
+    def parse( self, parser, text ):
+        return list(parser( text.splitlines(True) ))
+
+    def test_m1( self ):
+        self.assertEqual( self.parse( parseM1, M1 ), [(FIRST, -14783, True), (SECOND, -12011, True)] )
+
+    def test_m4( self ):
+        self.assertEqual( self.parse( parseM4, M4 ), [(FIRST, -14783, True), (SECOND, -12011, True)] )
+
+    def test_paf( self ):
+        self.assertEqual( self.parse( parsePaf, PAF ), [(FIRST, 5214, True), (SECOND, 2655, False)] )
+
+    def test_sam( self ):
+        self.assertEqual( self.parse( parseSam, SAM ), [(FIRST, -14783, True), (SECOND, 3045, False)] )
+
+class AlignerScoreTests(unittest.TestCase):
+
+    def scores( self, aligner, text ):
+        return list(aligner.scores( text.splitlines(True) ))
+
+    def test_blasr_costs_are_negated( self ):
+        for format, text in (("m1", M1), ("m4", M4)):
+            self.assertEqual( self.scores( BlasrAligner( format ), text ), [(FIRST, 14783), (SECOND, 12011)] )
+
+    def test_blasr_sam_fallback_keeps_its_direction( self ):
+        self.assertEqual( self.scores( BlasrAligner( "sam" ), SAM ), [(FIRST, 14783), (SECOND, 3045)] )
+
+    def test_minimap2_scores_are_kept( self ):
+        self.assertEqual( self.scores( Minimap2Aligner( "paf" ), PAF ), [(FIRST, 5214), (SECOND, 2655)] )
+        self.assertEqual( self.scores( Minimap2Aligner( "sam" ), SAM ), [(FIRST, -14783), (SECOND, 3045)] )
+
+if __name__ == "__main__":
+    unittest.main()